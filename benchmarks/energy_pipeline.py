@@ -0,0 +1,85 @@
+'''
+    Times the energy workflow of bilana on a synthetic bilayer with the fake gmx of fakegmx.py
+    bilana has to be importable (e.g. pip install -e .), gromacs is not needed:
+        python benchmarks/energy_pipeline.py [--ngrid 4] [--nframes 11] [--fragsize 40] [--sleep 0] [--workdir DIR]
+    Stages:
+        setup      leaflet assignment, neighbor_info (synthetic_system.write_neighbor_info) and
+                   index file (gmx select, make_ndx)
+        reruns     Energy.run_calculation: create_MDP, create_TPR (grompp), do_Energyrun (mdrun -rerun),
+                   write_XVG (energy) for all residues
+        table      Energy.write_energyfile (parsing of all .xvg tables), serial and parallel
+    The fake gmx sleeps FAKEGMX_SLEEP* seconds per call (see fakegmx.py), with --sleep 0 the reruns stage
+    measures the orchestration overhead of bilana and the start up of the fake gmx processes only.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakegmx
+
+def timed(label, timings, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.append((label, time.perf_counter() - start))
+    print("{: <25}{: >10.2f} s".format(label, timings[-1][1]), flush=True)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ngrid', type=int, default=4, help="Lipids per leaflet are ngrid**2")
+    parser.add_argument('--nframes', type=int, default=11)
+    parser.add_argument('--fragsize', type=int, default=None, help="Neighbors per energy run")
+    parser.add_argument('--part', default="complete")
+    parser.add_argument('--sleep', type=float, default=0., help="Seconds every fake gmx call sleeps")
+    parser.add_argument('--workdir', default=None, help="Keep all files in workdir instead of a temporary folder")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix="bilana_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ["PATH"] = os.path.dirname(fakegmx.install(os.path.join(workdir, "bin"))) + os.pathsep + os.environ["PATH"]
+    os.environ["FAKEGMX_SLEEP"] = str(args.sleep)
+
+    # bilana looks up gmx on import, so it is imported after PATH is set
+    import synthetic_system
+    from bilana.systeminfo import SysInfo
+    from bilana.analysis import leaflets
+    from bilana.analysis.neighbors import Neighbors
+    from bilana.analysis.energy import Energy
+
+    inputfile = synthetic_system.write_system(workdir, ngrid=args.ngrid, nframes=args.nframes)
+    os.chdir(workdir)
+    sysinfo = SysInfo(inputfile)
+    with open(sysinfo.tprpath, "w") as tpr:
+        print(fakegmx.TPR_MAGIC, file=tpr)
+        print(json.dumps({"structure":sysinfo.gropath, "topology":None, "index":None, "energygrps":[]}), file=tpr)
+
+    timings = []
+    timed("leaflet assignment", timings, leaflets.create_leaflet_assignment_file, sysinfo)
+    neibs = Neighbors(inputfile)
+    timed("neighbor_info", timings, synthetic_system.write_neighbor_info, neibs)
+    timed("index file", timings, neibs.create_indexfile)
+
+    energy = Energy(args.part, inputfilename=inputfile, denominator=args.fragsize, verbosity="WARNING")
+    nruns = sum([-(-len(set([neib for t in energy.neiblist[res] for neib in energy.neiblist[res][t]])) // energy.denominator)
+        for res in energy.MOLRANGE])
+    timed("reruns", timings, energy.run_calculation, energy.MOLRANGE)
+    timed("table serial", timings, energy.write_energyfile, submit_missing_data=False, parallel=False)
+    timed("table parallel", timings, energy.write_energyfile, submit_missing_data=False, parallel=True)
+
+    with open(energy.all_energies, "r") as table:
+        nrows = sum(1 for _ in table) - 1
+    rerun_time = dict(timings)["reruns"]
+    print("{} lipids, {} frames, {} energy runs ({:.3f} s per run), {} table rows".format(
+        len(energy.MOLRANGE), args.nframes, nruns, rerun_time / max(nruns, 1), nrows))
+    if not args.workdir:
+        shutil.rmtree(workdir)
+    return timings
+
+if __name__ == '__main__':
+    main()
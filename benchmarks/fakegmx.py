@@ -0,0 +1,262 @@
+'''
+    Stand-in for the gmx executable to test and benchmark the gromacs based workflows without gromacs
+    Supported commands are grompp, mdrun -rerun, energy, select and make_ndx. The outputs have the
+    same layout as the gromacs outputs that are parsed by bilana, all values are synthetic but deterministic.
+    This module does not import bilana so that each call stays cheap. Install it with
+        python benchmarks/fakegmx.py install <bindir>
+    which writes an executable <bindir>/gmx. Put <bindir> in front of PATH before importing bilana.
+    benchmarks/energy_pipeline.py does this and times the energy workflow with it.
+
+    Environment variables:
+        FAKEGMX_SLEEP            Seconds every command sleeps (default 0)
+        FAKEGMX_SLEEP_<COMMAND>  Seconds a specific command sleeps, e.g. FAKEGMX_SLEEP_GROMPP
+        FAKEGMX_SLEEP_PER_FRAME  Seconds mdrun sleeps per frame (default 0)
+        FAKEGMX_NFRAMES          Number of frames if trajectory can not be read (default 11)
+        FAKEGMX_DT               Time step in ps if trajectory can not be read (default 1000)
+'''
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import numpy as np
+
+EDR_MAGIC = b'FAKEGMX-EDR\n'
+TPR_MAGIC = 'FAKEGMX-TPR'
+ETYPES = ["Coul-SR", "LJ-SR", "Coul-14", "LJ-14"]
+
+def parse_args(args):
+    ''' Returns dict of gromacs style options -opt value (flags without value get True) '''
+    options = {}
+    key = None
+    for arg in args:
+        if arg.startswith('-') and not re.match(r'^-\d', arg):
+            key = arg[1:]
+            options[key] = True
+        elif key is not None:
+            options[key] = arg if options[key] is True else options[key]+' '+arg
+    return options
+
+def sleep(command, nframes=0):
+    seconds = float(os.environ.get("FAKEGMX_SLEEP_"+command.upper(), os.environ.get("FAKEGMX_SLEEP", 0)))
+    seconds += nframes * float(os.environ.get("FAKEGMX_SLEEP_PER_FRAME", 0))
+    if seconds > 0:
+        time.sleep(seconds)
+
+def synthetic_energies(names, times):
+    ''' Deterministic values for energy terms names at times, shape (len(times), len(names)) '''
+    seeds = np.array([zlib.crc32(name.encode()) for name in names], dtype=float)
+    base = -(seeds % 2000) / 10.
+    phase = (seeds % 628) / 100.
+    return base + 5*np.sin(np.asarray(times, dtype=float)[:, None]/1000. + phase)
+
+def read_gro(grofile):
+    ''' Returns list of (resid, resname, atomname) of all atoms in grofile '''
+    atoms = []
+    with open(grofile, "r") as gro:
+        gro.readline()
+        natoms = int(gro.readline())
+        for _ in range(natoms):
+            line = gro.readline()
+            atoms.append((int(line[0:5]), line[5:10].strip(), line[10:15].strip()))
+    return atoms
+
+def read_tpr(tprfile):
+    ''' Returns header of a tpr written by grompp or None if tprfile is not a fake tpr '''
+    try:
+        with open(tprfile, "r") as tpr:
+            if tpr.readline().strip() != TPR_MAGIC:
+                return None
+            return json.loads(tpr.readline())
+    except (OSError, UnicodeDecodeError, ValueError):
+        return None
+
+def structure_of(options):
+    ''' Structure file (.gro) that belongs to -s or -f '''
+    header = read_tpr(options.get('s', ''))
+    if header is not None:
+        return header["structure"]
+    for key in ('f', 's'):
+        if isinstance(options.get(key), str) and options[key].endswith('.gro'):
+            return options[key]
+    return options.get('s', options.get('f'))
+
+def trajectory_times(structure, trajectory):
+    ''' Times of all frames of trajectory, MDAnalysis is used if possible '''
+    try:
+        import MDAnalysis as mda
+        universe = mda.Universe(structure, trajectory)
+        return [float(ts.time) for ts in universe.trajectory]
+    except Exception: # Any failure of reading falls back to environment
+        nframes = int(os.environ.get("FAKEGMX_NFRAMES", 11))
+        dt = float(os.environ.get("FAKEGMX_DT", 1000))
+        return [float(t) for t in np.arange(nframes) * dt]
+
+def write_ndx(ndxfile, groups):
+    ''' groups is list of (name, 0-based indices) '''
+    with open(ndxfile, "w") as ndx:
+        for name, indices in groups:
+            print('[ {} ]'.format(name), file=ndx)
+            indices = [i+1 for i in indices]
+            for i in range(0, len(indices), 15):
+                print(' '.join(['{:>4}'.format(ind) for ind in indices[i:i+15]]), file=ndx)
+
+def grompp(options):
+    ''' Writes a tpr that stores energy groups of mdp and paths of inputs '''
+    energygroups = []
+    with open(options['f'], "r") as mdp:
+        for line in mdp:
+            key, _, val = line.partition('=')
+            if key.strip().replace('-', '_') == 'energygrps':
+                energygroups = val.split()
+    header = {"structure":options['c'], "topology":options.get('p'), "index":options.get('n'), "energygrps":energygroups}
+    with open(options.get('o', 'topol.tpr'), "w") as tpr:
+        print(TPR_MAGIC, file=tpr)
+        print(json.dumps(header), file=tpr)
+    sleep("grompp")
+    return "Fake grompp: {} energy groups\n".format(len(energygroups))
+
+def mdrun(options):
+    ''' Rerun writes an edr with all group pair terms of all frames of the trajectory '''
+    header = read_tpr(options['s'])
+    if header is None:
+        raise ValueError("{} was not written by fake grompp".format(options['s']))
+    if 'rerun' not in options:
+        raise ValueError("Fake mdrun supports only -rerun")
+    times = trajectory_times(header["structure"], options['rerun'])
+    groups = header["energygrps"] + ["rest"]
+    names = ["Potential"] + ['{}:{}-{}'.format(etype, grp1, grp2)\
+        for etype in ETYPES for i, grp1 in enumerate(groups) for grp2 in groups[i:]]
+    values = synthetic_energies(names, times).astype(np.float32)
+    with open(options.get('e', 'ener.edr'), "wb") as edr:
+        edr.write(EDR_MAGIC)
+        edr.write((json.dumps({"names":names, "times":times})+'\n').encode())
+        values.tofile(edr)
+    with open(options.get('g', 'md.log'), "w") as logf:
+        print("Fake mdrun -rerun of {} frames with {} energy terms".format(len(times), len(names)), file=logf)
+    sleep("mdrun", len(times))
+    return "Fake mdrun: {} frames\n".format(len(times))
+
+def energy(options, stdin):
+    ''' Writes xvg of all terms selected in stdin (names or numbers, 0 ends the selection) '''
+    with open(options['f'], "rb") as edr:
+        if edr.readline() != EDR_MAGIC:
+            edr.seek(0)
+            header = None
+        else:
+            header = json.loads(edr.readline().decode())
+            values = np.fromfile(edr, dtype=np.float32).reshape(len(header["times"]), len(header["names"]))
+    if header is None: # Any other edr file (e.g. of a real simulation)
+        nframes = int(os.environ.get("FAKEGMX_NFRAMES", 11))
+        header = {"names":[], "times":list(np.arange(nframes)*float(os.environ.get("FAKEGMX_DT", 1000)))}
+        values = np.empty((nframes, 0))
+    name_to_col = {name:col for col, name in enumerate(header["names"])}
+
+    selection = []
+    for item in stdin.split():
+        if item == '0':
+            break
+        if item.isdigit() and int(item)-1 < len(header["names"]):
+            item = header["names"][int(item)-1]
+        if header["names"] and item not in name_to_col:
+            sys.stderr.write("Energy term {} not found, skipping\n".format(item))
+            continue
+        selection.append(item)
+
+    columns = [values[:, name_to_col[name]] if name in name_to_col else\
+        synthetic_energies([name], header["times"])[:, 0] for name in selection]
+    with open(options.get('o', 'energy.xvg'), "w") as xvg:
+        print("# This file was created by fakegmx", file=xvg)
+        print('@    title "GROMACS Energies"', file=xvg)
+        print('@    xaxis  label "Time (ps)"', file=xvg)
+        print('@    yaxis  label "(kJ/mol)"', file=xvg)
+        print('@TYPE xy', file=xvg)
+        for i, name in enumerate(selection):
+            print('@ s{} legend "{}"'.format(i, name), file=xvg)
+        table = np.column_stack([header["times"]] + columns)
+        np.savetxt(xvg, table, fmt=['%.6f'] + ['%12.6f']*len(columns))
+    sleep("energy")
+    return "Fake energy: {} terms\n".format(len(selection))
+
+def select(options):
+    ''' Writes ndx of selections "name=expr; name;" with MDAnalysis selection syntax '''
+    import MDAnalysis as mda
+    universe = mda.Universe(structure_of(options))
+    if 'sf' in options:
+        with open(options['sf'], "r") as sf:
+            selectionstr = sf.read()
+    else:
+        selectionstr = options['select']
+    definitions = {}
+    groups = []
+    for statement in [stm.strip() for stm in selectionstr.split(';') if stm.strip()]:
+        if '=' in statement:
+            name, expr = [item.strip() for item in statement.split('=', 1)]
+            expr = expr.replace('name ".*"', 'all')
+            definitions[name] = expr
+        else:
+            expr = definitions.get(statement, statement)
+            groups.append((statement, list(universe.select_atoms(expr).indices)))
+    write_ndx(options['on'], groups)
+    sleep("select")
+    return "Fake select: {} groups\n".format(len(groups))
+
+def make_ndx(options, stdin):
+    ''' Supports "keep <n>", "r <resids>", "a <atomnames>" and "q" '''
+    atoms = read_gro(structure_of(options))
+    groups = [("System", list(range(len(atoms))))]
+    for line in stdin.splitlines():
+        cmd = line.split()
+        if not cmd or cmd[0] == 'q':
+            break
+        if cmd[0] == 'keep':
+            groups = [groups[int(cmd[1])]]
+        elif cmd[0] == 'r':
+            resids = set([int(res) for res in cmd[1:]])
+            groups.append(('r_'+'_'.join(cmd[1:]), [i for i, atm in enumerate(atoms) if atm[0] in resids]))
+        elif cmd[0] == 'a':
+            groups.append(('_'.join(cmd[1:]), [i for i, atm in enumerate(atoms) if atm[2] in cmd[1:]]))
+    write_ndx(options.get('o', 'index.ndx'), groups)
+    sleep("make_ndx")
+    return "Fake make_ndx: {} groups\n".format(len(groups))
+
+def install(bindir):
+    ''' Writes executable bindir/gmx that calls this module '''
+    os.makedirs(bindir, exist_ok=True)
+    gmxpath = os.path.join(bindir, 'gmx')
+    with open(gmxpath, "w") as gmx:
+        print('#!/bin/sh\nexec "{}" "{}" "$@"'.format(sys.executable, os.path.abspath(__file__)), file=gmx)
+    os.chmod(gmxpath, 0o755)
+    return gmxpath
+
+def main(argv):
+    if not argv:
+        sys.stderr.write("Usage: gmx <command> [options]\n")
+        return 1
+    command, options = argv[0], parse_args(argv[1:])
+    if command == 'install':
+        print(install(argv[1]))
+        return 0
+    try:
+        if command == 'grompp':
+            out = grompp(options)
+        elif command == 'mdrun':
+            out = mdrun(options)
+        elif command == 'energy':
+            out = energy(options, sys.stdin.read())
+        elif command == 'select':
+            out = select(options)
+        elif command == 'make_ndx':
+            out = make_ndx(options, sys.stdin.read())
+        else:
+            sys.stderr.write("Fake gmx does not support {}\n".format(command))
+            return 1
+    except (OSError, KeyError, ValueError) as err:
+        sys.stderr.write("Fake gmx {} failed: {!r}\n".format(command, err))
+        return 1
+    sys.stdout.write(out)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+'''
+    Times the flip flop detection of bilana (leaflets.get_flipflop_events) on a synthetic leaflet matrix
+    bilana has to be importable (e.g. pip install -e .):
+        python benchmarks/flipflop.py [--nframes 1000000] [--nlipids 1000] [--nchanges 400000] [--workdir DIR]
+    The (frame, residue) int8 matrix is written as memory map in the format of
+    leaflets.leaflet_assignment_time_evolution (about nframes*nlipids bytes on disk), residues change their
+    leaflet about nchanges times at random frames. Every second change away from a leaflet is reverted after
+    a few frames, so the tables contain short excursions as well as complete flip flops.
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from bilana.analysis.leaflets import get_flipflop_events
+
+def write_matrix(matrixfilename, nframes, nlipids, nchanges, dt=100.0, chunksize=10000, seed=0):
+    ''' Writes leaflet matrix with nchanges leaflet changes and its _times, _resids and _resnames files '''
+    rng = np.random.default_rng(seed)
+    # Each excursion adds the change back, so 2/3 of nchanges are drawn at random
+    nflips = 2 * nchanges // 3
+    frames = rng.integers(1, nframes, size=nflips)
+    residues = rng.integers(0, nlipids, size=nflips)
+    # Every second change is an excursion that is reverted after 1 to 20 frames
+    excursion = np.arange(nflips) % 2 == 1
+    backframes = np.minimum(frames[excursion] + rng.integers(1, 21, size=excursion.sum()), nframes-1)
+    frames = np.concatenate([frames, backframes])
+    residues = np.concatenate([residues, residues[excursion]])
+    order = np.argsort(frames, kind="stable")
+    frames, residues = frames[order], residues[order]
+    matrix = np.lib.format.open_memmap(matrixfilename, mode="w+", dtype=np.int8, shape=(nframes, nlipids))
+    current = (np.arange(nlipids) % 2).astype(np.int8)
+    for first in range(0, nframes, chunksize):
+        last = min(first+chunksize, nframes)
+        toggles = np.zeros((last-first, nlipids), dtype=np.int8)
+        inchunk = slice(np.searchsorted(frames, first), np.searchsorted(frames, last))
+        np.add.at(toggles, (frames[inchunk]-first, residues[inchunk]), 1)
+        block = current ^ (np.cumsum(toggles, axis=0, dtype=np.int8) % 2).astype(np.int8)
+        matrix[first:last] = block
+        current = block[-1]
+    matrix.flush()
+    del matrix
+    prefix = os.path.splitext(matrixfilename)[0]
+    np.save(prefix+"_times.npy", np.arange(nframes) * dt)
+    np.save(prefix+"_resids.npy", np.arange(1, nlipids+1))
+    np.save(prefix+"_resnames.npy", np.array(["DPPC"] * nlipids))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nframes', type=int, default=1000000)
+    parser.add_argument('--nlipids', type=int, default=1000)
+    parser.add_argument('--nchanges', type=int, default=400000, help="Number of leaflet changes of all residues")
+    parser.add_argument('--min_dwell', type=float, default=10000., help="Minimum dwell time (ps) of stable runs")
+    parser.add_argument('--workdir', default=None, help="Keep all files in workdir instead of a temporary folder")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix="bilana_flipflop_")
+    os.makedirs(workdir, exist_ok=True)
+    matrixfilename = os.path.join(workdir, "leaflet_trajectory.npy")
+    try:
+        start = time.perf_counter()
+        write_matrix(matrixfilename, args.nframes, args.nlipids, args.nchanges)
+        print("{: <25}{: >10.2f} s".format("write matrix", time.perf_counter() - start), flush=True)
+        start = time.perf_counter()
+        events, complete = get_flipflop_events(matrixfilename, os.path.join(workdir, "flipflop_events.csv"),
+            min_dwell=args.min_dwell)
+        elapsed = time.perf_counter() - start
+        print("{: <25}{: >10.2f} s".format("get_flipflop_events", elapsed), flush=True)
+        print("{} frames x {} lipids, {} leaflet changes, {} complete flip flops, {:.2e} entries/s".format(
+            args.nframes, args.nlipids, len(events), len(complete), args.nframes * args.nlipids / elapsed))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+'''
+    Writes a small synthetic DPPC/CHL1 bilayer with the folder layout that SysInfo expects
+        <root>/inputfile
+        <root>/mdfiles/initial_coords/<system>.gro, md_trj/<system>_<T>.xtc and _whole.xtc
+    Lipids sit on a square grid in both leaflets and move randomly, a few water oxygens (SOL) sit below
+    the bilayer. The raw trajectory is wrapped into the box.
+    Topology and tpr are empty placeholders, they are only read by (fake) gromacs.
+'''
+import os
+import numpy as np
+import MDAnalysis as mda
+from MDAnalysis.lib.distances import self_capped_distance
+from bilana.definitions import lipidmolecules
+
+SYSTEM, TEMPERATURE = "dppc_chol20", 290
+STEROL_ATOMS = ['O3', 'C3', 'C1', 'C2', 'C13', 'C14', 'C15', 'C16', 'C17', 'C20', 'C22', 'C23', 'C24', 'C25']
+
+def dppc_atoms(x, y, z, sign):
+    ''' (name, x, y, z) of a DPPC with head at z pointing to sign '''
+    tail1, tail2 = lipidmolecules.TAILCARBS['DP']
+    atoms = [("P", x, y, z), ("N", x, y, z + 2*sign)]
+    atoms += [(name, x, y + 0.5*i, z - 1.5*sign) for i, name in enumerate(["C1", "C2", "C3"])]
+    atoms += [(name, x - 1 + 0.3*(i % 2), y, z - sign*(3 + 1.25*i)) for i, name in enumerate(tail1)]
+    atoms += [(name, x + 1 + 0.3*(i % 2), y, z - sign*(3 + 1.25*i)) for i, name in enumerate(tail2)]
+    return atoms
+
+def sterol_atoms(x, y, z, sign):
+    return [(name, x, y + 0.2*i, z - 1.2*i*sign) for i, name in enumerate(STEROL_ATOMS)]
+
+def write_system(root, ngrid=4, nframes=6, dt=1000.0, nsolvent=20, seed=0):
+    ''' Writes system with 2*ngrid**2 lipids (every fourth is CHL1), nsolvent waters and nframes frames
+        Returns path of inputfile
+    '''
+    rng = np.random.default_rng(seed)
+    length, height = 10.0 * ngrid, 80.0
+    atoms = []
+    resid = 0
+    for sign in (1, -1):
+        for i in range(ngrid):
+            for j in range(ngrid):
+                resid += 1
+                x, y = (i + 0.5) * 10.0, (j + 0.5) * 10.0
+                if (i + j) % 4 == 3:
+                    atoms += [(resid, "CHL1") + atm for atm in sterol_atoms(x, y, height/2 + sign*16, sign)]
+                else:
+                    atoms += [(resid, "DPPC") + atm for atm in dppc_atoms(x, y, height/2 + sign*18, sign)]
+    for _ in range(nsolvent):
+        resid += 1
+        atoms.append((resid, "SOL", "OW", rng.uniform(0, length), rng.uniform(0, length), rng.uniform(0, 10)))
+    natoms = len(atoms)
+    resnames = {atm[0]:atm[1] for atm in atoms}
+    u = mda.Universe.empty(natoms, n_residues=resid, atom_resindex=[atm[0]-1 for atm in atoms], trajectory=True)
+    u.add_TopologyAttr("names", [atm[2] for atm in atoms])
+    u.add_TopologyAttr("resnames", [resnames[res] for res in range(1, resid+1)])
+    u.add_TopologyAttr("resids", list(range(1, resid+1)))
+    u.add_TopologyAttr("masses", [12.0]*natoms)
+    reference = np.array([atm[3:] for atm in atoms], dtype=np.float32)
+    u.atoms.positions = reference
+    u.dimensions = [length, length, height, 90, 90, 90]
+
+    mdfiles = os.path.join(root, "mdfiles")
+    for subdir in ("initial_coords", "psf", "tpr", "md_trj", "enr"):
+        os.makedirs(os.path.join(mdfiles, subdir), exist_ok=True)
+    u.atoms.write(os.path.join(mdfiles, "initial_coords", "{}.gro".format(SYSTEM)))
+    open(os.path.join(mdfiles, "psf", "{}.top".format(SYSTEM)), "w").close()
+    open(os.path.join(mdfiles, "tpr", "{}_{}.tpr".format(SYSTEM, TEMPERATURE)), "w").close()
+    trjname = os.path.join(mdfiles, "md_trj", "{}_{}".format(SYSTEM, TEMPERATURE))
+    residue_of_atom = np.array([atm[0]-1 for atm in atoms])
+    with mda.Writer(trjname+".xtc", natoms) as raw, mda.Writer(trjname+"_whole.xtc", natoms) as whole:
+        drift = np.zeros((resid, 2))
+        for frame in range(nframes):
+            drift += rng.normal(0, 0.7, drift.shape)
+            positions = reference + rng.normal(0, 0.2, reference.shape).astype(np.float32)
+            positions[:, :2] += drift[residue_of_atom]
+            u.trajectory.ts.time = frame * dt
+            u.atoms.positions = positions
+            whole.write(u.atoms)
+            positions[:, :2] %= length
+            u.atoms.positions = positions
+            raw.write(u.atoms)
+    inputfile = os.path.join(root, "inputfile")
+    with open(inputfile, "w") as inpf:
+        print("System: {}\nLipidmolecules: DPPC,CHL1\nTemperature: {}\nTimeframe: 0,{},{}\ncutoff: 1.2\n"
+            "refatomselection: (resname DPPC and name P) or (resname CHL1 and name O3)\nmdfiles: {}".format(
+            SYSTEM, TEMPERATURE, int((nframes-1)*dt), int(dt), mdfiles), file=inpf)
+    return inputfile
+
+def write_neighbor_info(sysinfo, outputfilename="neighbor_info"):
+    ''' Writes neighbor_info with all reference atoms of the same leaflet within the cutoff (xy plane) '''
+    refatoms = sysinfo.universe.select_atoms(sysinfo.reference_atom_selection)
+    resids = refatoms.resids
+    leaflets = sysinfo.res_to_leaflet.leaflets_of(resids)
+    lines = []
+    for ts in sysinfo.universe.trajectory:
+        positions = refatoms.positions.copy()
+        positions[:, 2] = 0
+        pairs = self_capped_distance(positions, sysinfo.cutoff*10, box=ts.dimensions, return_distances=False)
+        pairs = pairs[leaflets[pairs[:, 0]] == leaflets[pairs[:, 1]]]
+        neighbors = {res:[] for res in resids}
+        for i, j in pairs:
+            neighbors[resids[i]].append(resids[j])
+            neighbors[resids[j]].append(resids[i])
+        lines += [(res, ts.time, sorted(neibs)) for res, neibs in neighbors.items()]
+    with open(outputfilename, "w") as outf:
+        print("{: <20}{: <20}{: <20}{: <20}".format("Resid", "Time", "Number_of_neighbors", "List_of_Neighbors"), file=outf)
+        for res, time, neibs in sorted(lines, key=lambda line: line[:2]):
+            print("{: <20}{: <20}{: <20}{: <20}".format(res, time, len(neibs), ','.join([str(neib) for neib in neibs])), file=outf)
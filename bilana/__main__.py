@@ -8,7 +8,7 @@ import argparse
 from . import log
 from . import command_line as cmd
 
-commandline_modules = ["initialize", "energy", "assemble_energies", "nofscd", "eofscd", "order", "selfinteraction", "leafletinteraction"]
+commandline_modules = ["initialize", "energy", "energyplan", "assemble_energies", "compact_energies", "nofscd", "eofscd", "order", "selfinteraction", "leafletinteraction"]
 
 LOGGER = log.LOGGER
 
@@ -33,6 +33,9 @@ PARSER.add_argument('-i', '--inputfile',    action="store", nargs='?', metavar='
 # Arguments only for energy calculations
 PARSER.add_argument('-p',         action="store", metavar="complete", required=False, default="complete", help="Sets which part of the lipid should be taken into account for interaction energy calculation")
 PARSER.add_argument('--divisor',  action="store", metavar="#divisor", required=False, default=80, type=int, help="Sets the number by which the system should be divided for the energy calculation")
+PARSER.add_argument('--fragsize', action="store", metavar="#neighbors", required=False, default=None, type=int, help="Sets the number of neighbors per energy run")
+PARSER.add_argument('--walltime', action="store", metavar="hours",      required=False, default=48, type=float, help="Wall clock budget per job used by energyplan")
+PARSER.add_argument('--calibrate', action="store_true", required=False, help="If set, energyplan times one energy run to estimate the wall time")
 
 # On/Off flags
 PARSER.add_argument('--overwrite', action="store_true", required=False, help="If this flag is set all files will be overwritten")
@@ -57,7 +60,9 @@ LOGGER.debug("Arguments of argparse: %s", ARGS)
 COMMAND = {
     "initialize":cmd.initialize_system,
     "energy":cmd.submit_energycalcs,
+    "energyplan":cmd.plan_energycalcs,
     "assemble_energies":cmd.check_and_write,
+    "compact_energies":cmd.compact_energyfiles,
     "nofscd":cmd.write_nofscd,
     "eofscd":cmd.write_eofscd,
     "order":cmd.calc_scd,
@@ -79,6 +84,9 @@ def run_cmd():
         overwrite=ARGS.overwrite,
         startdivisor=ARGS.divisor,
         dry=ARGS.dryrun,
+        fragsize=ARGS.fragsize,
+        walltime=ARGS.walltime,
+        calibrate=ARGS.calibrate,
         **kwargs,
         )
 
@@ -1,10 +1,13 @@
 ''' Import everything in analysis folder '''
 from . import energy
+from . import interaction_network
 from . import neighbors
 from . import lateraldistribution
 from . import leaflets
 from . import msd
+from . import diffusion
 from . import order
+from . import order_dynamics
 from . import rdf
 from . import protein
 from . import area_per_lipid
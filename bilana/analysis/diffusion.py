@@ -0,0 +1,126 @@
+'''
+    This module calculates lateral diffusion coefficients of lipids without gmx msd
+        - Centers of mass (or reference atoms) of all lipids are read in one trajectory pass,
+          unwrapped and corrected for leaflet drift (see msd.lateral_positions)
+        - MSD curves of each lipid over all time origins (see msd.msd_fft)
+        - D from a linear fit MSD = 4 D t + c in a window of lag times
+        - Confidence intervals of D from bootstrapping the lipids of each type and leaflet
+    Diffusion coefficients are given in 1e-5 cm^2/s like in gmx msd.
+'''
+import numpy as np
+import pandas as pd
+
+from .. import log
+from ..common import loop_to_pool
+from .msd import LateralMSD
+
+LOGGER = log.LOGGER
+
+NM2_PER_PS_IN_1E5_CM2_PER_S = 1e3
+BOOTSTRAP_TASKSIZE = 100
+
+def fit_window(lags, fitrange=(0.1, 0.9)):
+    ''' Mask of lags between fitrange[0] and fitrange[1] (fractions of the largest lag) '''
+    lags = np.asarray(lags)
+    window = (lags >= fitrange[0] * lags[-1]) & (lags <= fitrange[1] * lags[-1])
+    if np.count_nonzero(window) < 2:
+        raise ValueError("Fit range {} contains less than 2 lag times".format(fitrange))
+    return window
+
+def fit_diffusion(lags, msd, window=None):
+    ''' Diffusion coefficient of each row of msd (lipid, lag) from a linear fit MSD = 4 D t + c
+        in window (mask of lags), D has the unit of msd per unit of lags
+    '''
+    if window is None:
+        window = fit_window(lags)
+    slope = np.polyfit(np.asarray(lags)[window], np.atleast_2d(msd)[:, window].T, 1)[0]
+    return slope / 4
+
+def _bootstrap_diffusion(msd, lags, nsamples, seed):
+    ''' Diffusion coefficients of nsamples mean MSD curves of lipids drawn with replacement from msd (lipid, lag)
+        Defined on module level to be picklable for parallelization.
+    '''
+    rng = np.random.default_rng(seed)
+    nlipids = len(msd)
+    counts = rng.multinomial(nlipids, np.full(nlipids, 1 / nlipids), size=nsamples)
+    return fit_diffusion(lags, counts @ msd / nlipids, np.ones(len(lags), dtype=bool))
+
+def bootstrap_diffusion(msd, lags, window, nboot=1000, confidence=0.95, seed=None, parallel=True):
+    ''' Confidence interval of D of the mean MSD of lipids msd (lipid, lag)
+        The samples are split into tasks of BOOTSTRAP_TASKSIZE with independent random streams,
+        so the result for a given seed does not depend on parallel.
+        Returns lower and upper bound
+    '''
+    msd = np.asarray(msd[:, window], dtype=float)
+    lags = np.asarray(lags)[window]
+    tasksizes = [min(BOOTSTRAP_TASKSIZE, nboot - start) for start in range(0, nboot, BOOTSTRAP_TASKSIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasksizes))
+    inpargs = [(msd, lags, nsamples, taskseed) for nsamples, taskseed in zip(tasksizes, seeds)]
+    if parallel and len(inpargs) > 1:
+        samples = loop_to_pool(_bootstrap_diffusion, inpargs)
+    else:
+        samples = [_bootstrap_diffusion(*inp) for inp in inpargs]
+    return tuple(np.percentile(np.concatenate(samples), [50 * (1 - confidence), 50 * (1 + confidence)]))
+
+class Diffusion(LateralMSD):
+    ''' Lateral diffusion of all lipids, by default from their centers of mass (reference com, see msd.LateralMSD) '''
+
+    def __init__(self, inputfilename="inputfile", memmapfile=None, reference="com"):
+        super().__init__(inputfilename, memmapfile=memmapfile, reference=reference)
+
+    def lipid_diffusion(self, msd, fitrange=(0.1, 0.9)):
+        ''' DataFrame with diffusion coefficient of each lipid '''
+        lags = self.times - self.times[0]
+        diffusion = fit_diffusion(lags, msd, fit_window(lags, fitrange)) * NM2_PER_PS_IN_1E5_CM2_PER_S
+        return pd.DataFrame({
+            "resid":self.resids,
+            "type":[self.resid_to_lipid[res] for res in self.resids],
+            "leaflet":self.res_to_leaflet.leaflets_of(self.resids),
+            "D":diffusion,
+            })
+
+    def diffusion_coefficients(self, msd=None, fitrange=(0.1, 0.9), nboot=1000, confidence=0.95, seed=None, parallel=True):
+        ''' DataFrame with D of the mean MSD per lipid type and leaflet and its bootstrap confidence interval '''
+        if msd is None:
+            msd = self.lipid_msd()
+        lags = self.times - self.times[0]
+        window = fit_window(lags, fitrange)
+        types = np.array([self.resid_to_lipid[res] for res in self.resids])
+        leaflets = self.res_to_leaflet.leaflets_of(self.resids)
+        rows = []
+        for lipid in np.unique(types):
+            for leaflet in np.unique(leaflets):
+                ingroup = (types == lipid) & (leaflets == leaflet)
+                if not ingroup.any():
+                    continue
+                group_msd = np.asarray(msd[ingroup])
+                diffusion = fit_diffusion(lags, group_msd.mean(axis=0), window)[0]
+                low, high = bootstrap_diffusion(group_msd, lags, window, nboot=nboot, confidence=confidence,
+                    seed=seed, parallel=parallel)
+                rows.append({"type":str(lipid), "leaflet":int(leaflet), "nlipids":np.count_nonzero(ingroup),
+                    "D":diffusion * NM2_PER_PS_IN_1E5_CM2_PER_S,
+                    "D_low":low * NM2_PER_PS_IN_1E5_CM2_PER_S,
+                    "D_high":high * NM2_PER_PS_IN_1E5_CM2_PER_S})
+        return pd.DataFrame(rows)
+
+    def write_diffusion(self, outputprefix="diffusion", fitrange=(0.1, 0.9), nboot=1000, confidence=0.95,
+        seed=None, displacements=False, parallel=True):
+        ''' Writes
+                <outputprefix>_msd.dat:          MSD per lipid type and leaflet over lag time
+                <outputprefix>_lipids.dat:       D of each lipid
+                <outputprefix>_coefficients.dat: D per lipid type and leaflet with confidence interval
+            and if displacements <outputprefix>_alpha2.dat and <outputprefix>_vanhove.dat (see msd.LateralMSD)
+        '''
+        if self.positions is None:
+            self.build_positions(parallel=parallel)
+        accumulator = self.displacement_accumulator() if displacements else None
+        msd = self.lipid_msd(accumulator=accumulator)
+        if displacements:
+            self.write_displacements(accumulator, outputprefix)
+        self.write_msd(outputprefix+"_msd.dat", msd=msd)
+        self.lipid_diffusion(msd, fitrange).to_csv(outputprefix+"_lipids.dat", sep=' ', index=False, float_format="%.8f")
+        coefficients = self.diffusion_coefficients(msd, fitrange=fitrange, nboot=nboot, confidence=confidence,
+            seed=seed, parallel=parallel)
+        coefficients.to_csv(outputprefix+"_coefficients.dat", sep=' ', index=False, float_format="%.8f")
+        LOGGER.info("Diffusion coefficients (1e-5 cm^2/s):\n%s", coefficients)
+        return coefficients
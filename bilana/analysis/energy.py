@@ -2,17 +2,32 @@
     This module stores all functions that are needed to calculate the interaction energy of lipids or its parts
 '''
 import os
+import time
+import re
+import glob
 import subprocess
+import numpy as np
+import pandas as pd
 from . import neighbors
 from .. import log
-from ..common import exec_gromacs, GMXNAME, write_submitfile
+from ..common import exec_gromacs, loop_to_pool, GMXNAME, write_submitfile, get_minmaxdiv
 from ..systeminfo import SysInfo
 from ..definitions import lipidmolecules
 from ..command_line import submit_missing_energycalculation
+from .energy_storage import open_energyfile, energyfile_exists, energyfile_size, extracted_energyfile, read_lastline, compact_energyfiles
 
 LOGGER = log.LOGGER
 LOGGER = log.create_filehandler("bilana_energy.log", LOGGER)
 
+# Layout of the binary chunks written by write_energyfile
+CHUNK_MANIFEST = 'manifest{}.dat'
+ENERGY_DTYPE = np.dtype([
+    ("time", "f8"), ("host", "i4"), ("neib", "i4"), ("inter", "U16"),
+    ("vdw", "f8"), ("coul", "f8"), ("etot", "f8"),
+    ])
+ENERGY_HEADER = '{: <10}{: <10}{: <10}{: <20}{: <20}{: <20}{: <20}'.format("Time", "Host", "Neighbor", "Molparts", "VdW", "Coul", "Etot")
+ENERGY_LINE = '%-10s%-10d%-10d%-20s%-20.5f%-20.5f%-20.5f\n'
+
 
 class Energy(SysInfo):
     '''
@@ -23,6 +38,9 @@ class Energy(SysInfo):
     '''
 
     DENOMINATOR = 40
+    MAXENERGYGROUPS = 256 # Limit of energy groups in one gromacs run
+    EDR_BYTES_PER_TERM = 12 # Estimate: value, average and sum are stored per term
+    XVG_BYTES_PER_VALUE = 15
     LOGGER = LOGGER
 
     def __init__(self,
@@ -32,6 +50,7 @@ class Energy(SysInfo):
         resindex_all='resindex_all',
         overwrite=True,
         verbosity="INFO",
+        denominator=None,
         ):
         super().__init__(inputfilename)
         log.set_verbosity(verbosity)
@@ -67,6 +86,8 @@ class Energy(SysInfo):
             self.denominator = int(self.DENOMINATOR/10)
             self.molparts_short = ['C{}_'.format(i) for i in range(7)]
             self.all_energies = "all_energies_carbons.dat"
+        if denominator is not None:
+            self.denominator = int(denominator)
         print('\n Calculating for energygroups:', self.molparts)
 
     def run_calculation(self, resids):
@@ -115,14 +136,15 @@ class Energy(SysInfo):
                 # Run functions
                 self.create_MDP(mdpout, energygroups)
                 self.create_TPR(mdpout, tprout)
-                if os.path.isfile(energyf_output) and not self.overwrite:
+                if energyfile_exists(energyf_output) and not self.overwrite:
                     LOGGER.info("Edrfile for lipid %s part %s already exists. Will skip this calculation.", res, groupfragment)
                 else:
                     self.do_Energyrun(res, groupfragment, tprout, energyf_output)
-                if os.path.isfile(g_energy_output) and not self.overwrite:
+                if energyfile_exists(g_energy_output) and not self.overwrite:
                     LOGGER.info("Xvgtable for lipid %s part %s already exists. Will skip this calculation.", res, groupfragment)
                 else:
-                    self.write_XVG(energyf_output, tprout, relev_energies, xvg_out)
+                    with extracted_energyfile(energyf_output, self.temppath) as edrfile:
+                        self.write_XVG(edrfile, tprout, relev_energies, xvg_out)
         return 1
 
     def run_lip_leaflet_interaction(self, resids):
@@ -170,14 +192,15 @@ class Energy(SysInfo):
             # Run functions
             self.create_MDP(mdpout, energygroups)
             self.create_TPR(mdpout, tprout)
-            if os.path.isfile(energyf_output) and not self.overwrite:
+            if energyfile_exists(energyf_output) and not self.overwrite:
                 LOGGER.info("Edrfile for lipid %s part %s already exists. Will skip this calculation.", res)
             else:
                 self.do_Energyrun(res, 0, tprout, energyf_output)
-            if os.path.isfile(g_energy_output) and not self.overwrite:
+            if energyfile_exists(g_energy_output) and not self.overwrite:
                 LOGGER.info("Xvgtable for lipid %s part %s already exists. Will skip this calculation.", res)
             else:
-                self.write_XVG(energyf_output, tprout, relev_energies, xvg_out)
+                with extracted_energyfile(energyf_output, self.temppath) as edrfile:
+                    self.write_XVG(edrfile, tprout, relev_energies, xvg_out)
         return 1
 
     def create_lipid_water_interaction_file(self, outputfilename="water_interaction.dat"):
@@ -191,7 +214,7 @@ class Energy(SysInfo):
             resname = self.resid_to_lipid[resid]
             xvgfilename = self.energypath+'xvgtables/energies_residue'+str(resid)+'_0.xvg'
 
-            with open(xvgfilename,"r") as xvgfile:
+            with open_energyfile(xvgfilename) as xvgfile:
                 res_to_rowindex = {}
 
                 for energyline in xvgfile: #folderlayout is: <time> <Coul_resHost_resNeib> <LJ_resHost_resNeib> ...
@@ -233,7 +256,7 @@ class Energy(SysInfo):
             leaflet = self.res_to_leaflet[resid]
             xvgfilename = self.energypath+'xvgtables/energies_residue'+str(resid)+'_leaflet.xvg'
 
-            with open(xvgfilename,"r") as xvgfile:
+            with open_energyfile(xvgfilename) as xvgfile:
                 res_to_rowindex = {}
 
                 for energyline in xvgfile: #folderlayout is: <time> <Coul_resHost_resNeib> <LJ_resHost_resNeib> ...
@@ -277,11 +300,12 @@ class Energy(SysInfo):
             relev_energies = self.get_relev_self_interaction(res)
             tprout = ''.join([self.energypath, 'tprfiles/mdrerun_resid', str(res), '_', '0', self.part, '.tpr'])
             energyf_output = ''.join([self.energypath, 'edrfiles/energyfile_resid', str(res), '_'+'0', self.part, '.edr'])
-            if not os.path.isfile(energyf_output):
+            if not energyfile_exists(energyf_output):
                 missing_edr.append(energyf_output)
                 continue
             xvg_out = ''.join([self.energypath, 'xvgtables/energies_residue', str(res), '_selfinteraction', self.part, '.xvg'])
-            self.write_XVG(energyf_output, tprout, relev_energies, xvg_out)
+            with extracted_energyfile(energyf_output, self.temppath) as edrfile:
+                self.write_XVG(edrfile, tprout, relev_energies, xvg_out)
         if missing_edr:
             raise FileNotFoundError("Following files are missing: {}".format(missing_edr))
 
@@ -300,7 +324,7 @@ class Energy(SysInfo):
             for resid in self.MOLRANGE:
                 xvg_out = ''.join([self.energypath, 'xvgtables/energies_residue', str(resid), '_selfinteraction', self.part, '.xvg'])
                 restype = self.resid_to_lipid[resid]
-                with open(xvg_out,"r") as xvgfile:
+                with open_energyfile(xvg_out) as xvgfile:
                     res_to_row = {}
 
                     for energyline in xvgfile: #folderlayout is: time Coul_resHost_resNeib LJ_resHost_resNeib ...
@@ -480,166 +504,87 @@ class Energy(SysInfo):
     def write_XVG(self, energyf_in, tprrerun_in, all_relev_energies, xvg_out):
         ''' Create XVG-TABLE with all relevant energies '''
         os.makedirs(self.energypath+'xvgtables', exist_ok=True)
-        g_energy_arglist=[GMXNAME, 'energy', '-f', energyf_in,
-                          '-s', tprrerun_in,'-o', xvg_out,
-                          ]
+        g_energy_arglist=[GMXNAME, 'energy', '-f', energyf_in, '-o', xvg_out]
+        if os.path.isfile(tprrerun_in): # .tpr files may be removed by compact_storage
+            g_energy_arglist += ['-s', tprrerun_in]
         inp_str=all_relev_energies.encode()
         out, err = exec_gromacs(g_energy_arglist, inp_str)
         with open("gmx_energy.log","a") as logfile:
             logfile.write(err)
             logfile.write(out)
 
-    def write_energyfile(self, submit_missing_data=True):
-        ''' Creates files: "all_energies_<interaction>.dat
-            NOTE: This function is too long. It should be separated into smaller parts.
+    def write_energyfile(self, submit_missing_data=True, parallel=True):
+        ''' Creates file "all_energies_<interaction>.dat"
+            1. Each residue is a separate task (_assemble_energies_of_residue): all .xvg fragments
+               of the residue are read and stored as binary chunk in energyfiles/chunks/
+            2. The chunks of this run are concatenated into the final table (_merge_energy_chunks)
+            Chunks of earlier runs are removed first, the chunks of this run are listed in
+            energyfiles/chunks/manifest<part>.dat. The rows keep the order host, fragment, time, neighbor;
+            VdW and Coul are written with 5 decimals like Etot (instead of the text of the .xvg tables).
+
+            Residues with missing, truncated (not ending at the last frame of the trajectory) or
+            inconsistent data are left out of the table.
+            Returns a list of issues, each entry is a dict with keys
+                resid, fragment, issue, detail
+            An empty list means that the table is complete.
         '''
-        missing_energydata = []
         LOGGER.info('Create energy file')
-        with open(self.all_energies, "w") as energyoutput:
-            print(
-                  '{: <10}{: <10}{: <10}{: <20}'
-                  '{: <20}{: <20}{: <20}'\
-                  .format("Time", "Host", "Neighbor", "Molparts",\
-                                           "VdW", "Coul", "Etot"),\
-                  file=energyoutput)
-
-            for resid in self.MOLRANGE:
-                LOGGER.info("Working on residue %s ...", resid)
-
-                # Get neighborhood of resid
-                residtype        = self.resid_to_lipid[resid]
-                all_neibs_of_res = list(set([neibs for t in self.neiblist[resid].keys() for neibs in self.neiblist[resid][t]]))
-                n_neibs          = len(all_neibs_of_res)
-                LOGGER.debug("All neibs of res %s are %s", resid, all_neibs_of_res)
-
-                # Get number of fragments (how many runs per residue)
-                if n_neibs % self.denominator == 0:
-                    number_of_groupfragments = (n_neibs//self.denominator)
-                else:
-                    number_of_groupfragments = (n_neibs//self.denominator)+1
-                LOGGER.debug("Nneibs: %s Nfrags: %s", n_neibs, number_of_groupfragments)
-
-                all_neibs_of_res = [ all_neibs_of_res[ ( i*self.denominator ):( (i+1)*self.denominator ) ] for i in range(number_of_groupfragments) ]
-
-                for part in range(number_of_groupfragments):
-                    LOGGER.debug("At part %s", part)
-                    xvgfilename = self.energypath+'xvgtables/energies_residue'+str(resid)+'_'+str(part)+self.part+'.xvg'
-
-                    with open(xvgfilename,"r") as xvgfile:
-                        res_to_rowindex = {}
-
-                        for energyline in xvgfile: #folderlayout is: <time> <Coul_resHost_resNeib> <LJ_resHost_resNeib> ...
-                            energyline_cols = energyline.split()
-
-                            if '@ s' in energyline:                     #creating a dict to know which column(energies) belong to which residue
-                                rowindex  = int(energyline_cols[1][1:])+1 # time is at row 0 !
-                                neib = energyline_cols[3].split("resid_")[2][:-1]
-                                host = energyline_cols[3].split("resid_")[1][:-1]
-                                energytype = energyline_cols[3].split("-")[0][1:]
-                                LOGGER.debug("Hostid: %s, Neibid: %s", host, neib)
-
-                                res_to_rowindex[(energytype, host, neib)] = rowindex
-                                LOGGER.debug("Adding to dict: Etype %s, host %s, neib %s", energytype, host, neib)
-
-                            elif '@' not in energyline and '#' not in energyline: #pick correct energies from energyfile and print
-                                time = float(energyline_cols[0])
-                                if time % self.dt != 0:
-                                    continue
-
-                                for neib in all_neibs_of_res[part]:
-
-                                    # This if clause is due to a broken simulation... In future it should be removed
-                                    if self.system == 'dppc_dupc_chol25' and ((int(host) == 372 and neib == 242) or (int(host) == 242 and neib == 372)):
-                                        continue
-
-                                    neibtype = self.resid_to_lipid[neib]
-
-                                    host_sterol_processed = False # We need that as sterols are not separated into different parts
-                                    # so we just process sterols only once
-                                    for parthost in self.molparts:
-                                        parthost = parthost[6:] # remove "resid" from parthost string
-
-                                        if residtype == 'CHL1' and not host_sterol_processed:
-                                            parthost = ''
-                                            host_sterol_processed = True
-                                        elif residtype == 'CHL1' and host_sterol_processed:
-                                            continue
-
-                                        neib_sterol_processed = False
-                                        for partneib in self.molparts:
-                                            partneib = partneib[6:] # remove "resid" from parthost string
-
-                                            if neibtype == 'CHL1' and not neib_sterol_processed:
-                                                partneib = ''
-                                                neib_sterol_processed = True
-                                            elif neibtype == 'CHL1' and neib_sterol_processed:
-                                                continue
-
-                                            # if partstring is empty take whole lipid
-                                            if parthost.replace("_", "") == '':
-                                                interhost = 'w'
-                                            else:
-                                                interhost = parthost.replace("_", "")
-
-                                            if partneib.replace("_", "")== '':
-                                                interneib = 'w'
-                                            else:
-                                                interneib = partneib.replace("_", "")
-                                            inter = ''.join([interhost, '_', interneib])
-
-                                            # Get energies from dict energyline_cols
-                                            try:
-                                                vdw  = energyline_cols[ res_to_rowindex[ ('LJ',   parthost+str(resid), partneib+str(neib)) ] ]
-                                                coul = energyline_cols[ res_to_rowindex[ ('Coul', parthost+str(resid), partneib+str(neib)) ] ]
-                                            except KeyError:
-                                                LOGGER.warning("Data not found for %s - %s", parthost+str(resid), partneib+str(neib) )
-                                                if resid not in missing_energydata:
-                                                    missing_energydata.append(resid)
-
-                                            Etot = float(vdw) + float(coul)
-                                            print(\
-                                                  '{: <10}{: <10}{: <10}{: <20}'
-                                                  '{: <20}{: <20}{: <20.5f}'
-                                                  .format(time, resid, neib, inter,
-                                                                            vdw, coul, Etot),
-                                                  file=energyoutput)
+        chunkpath = self.energypath + 'chunks/'
+        os.makedirs(chunkpath, exist_ok=True)
+        manifest = chunkpath + CHUNK_MANIFEST.format(self.part)
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+        for stale in glob.glob('{}energies_residue*{}.npy'.format(chunkpath, self.part)):
+            if re.match(r'energies_residue\d+{}\.npy$'.format(re.escape(self.part)), os.path.basename(stale)):
+                os.remove(stale)
+        if self.system == 'dppc_dupc_chol25':
+            # This is due to a broken simulation... In future it should be removed
+            skip_pairs = [(372, 242), (242, 372)]
+        else:
+            skip_pairs = []
+
+        t_end = self.universe.trajectory[-1].time
+        inpargs = []
+        for resid in self.MOLRANGE:
+            all_neibs_of_res = list(set([neibs for t in self.neiblist[resid].keys() for neibs in self.neiblist[resid][t]]))
+            neib_fragments = [ all_neibs_of_res[ i:(i+self.denominator) ] for i in range(0, len(all_neibs_of_res), self.denominator) ]
+            resid_to_lipid = {res:self.resid_to_lipid[res] for res in [resid]+all_neibs_of_res}
+            chunkfile = '{}energies_residue{}{}.npy'.format(chunkpath, resid, self.part)
+            inpargs.append( (resid, neib_fragments, resid_to_lipid, self.molparts, self.part,
+                self.energypath, self.dt, chunkfile, skip_pairs, t_end) )
+
+        LOGGER.info("Reading xvg tables of %s residues", len(inpargs))
+        if parallel:
+            output = loop_to_pool(_assemble_energies_of_residue, inpargs)
+        else:
+            output = [_assemble_energies_of_residue(*inp) for inp in inpargs]
+
+        chunkfiles = [chunkfile for chunkfile, _ in output if chunkfile is not None]
+        missing_energydata = [issue for _, issues in output for issue in issues]
+
+        LOGGER.info("Merging %s chunks", len(chunkfiles))
+        _merge_energy_chunks(chunkfiles, self.all_energies)
+        with open(manifest, "w") as manifestfile:
+            print('\n'.join([os.path.basename(chunkfile) for chunkfile in chunkfiles]), file=manifestfile)
 
         if missing_energydata:
-            LOGGER.warning("Missing energydata: %s", missing_energydata)
-            if not self.part:
-                self.part = "complete"
+            missing_resids = sorted(set([issue["resid"] for issue in missing_energydata]))
+            LOGGER.warning("Missing energydata for residues: %s", missing_resids)
             if submit_missing_data:
-                for missing_resid in missing_energydata:
-                    submit_missing_energycalculation(missing_resid, self.part, self.system, self.temperature)
-            if os.path.isfile(self.all_energies):
-                os.remove(self.all_energies)
-            raise RuntimeError("There were inconsistencies in the data. See log files for further information.")
-
-        LOGGER.info("File %s written successfully", self.all_energies)
+                part = self.part if self.part else "complete"
+                for missing_resid in missing_resids:
+                    submit_missing_energycalculation(missing_resid, part, self.system, self.temperature)
+            LOGGER.warning("File %s is incomplete. See log files for further information.", self.all_energies)
+        else:
+            LOGGER.info("File %s written successfully", self.all_energies)
+        return missing_energydata
 
     def check_exist_xvgs(self, check_len=False):
         ''' Checks if all .xvg-files containing lipid interaction exist
 
             check_len can be set to simulation length and all .xvg files that differ from that length are included to missing_xvgfile.info
+            Files that were packed by compact_storage are checked inside their archive.
         '''
-        def read_lastline_only(fname):
-            ''' Reads last line of file without loop. Attention: Crashes if file is empty'''
-            MAXCOUNT = 100000
-            cnt = 0
-            with open(fname, "rb") as f:
-                f.seek(-2, os.SEEK_END)     # Jump to the second last byte.
-                while f.read(1) != b"\n" and f.tell() != 1:   # Until EOL is found... if f.tell() == 0 means cursor is at the beginning of file
-                    f.seek(-2, os.SEEK_CUR) # ...jump back the read byte plus one more.
-                    cnt += 1
-                    if cnt > MAXCOUNT:
-                        raise RuntimeError("Reach max byte count in file {}. Is it corrupted?".format(fname))
-
-                if f.tell() == 1:
-                    raise RuntimeError("File {} has no EOL character. Is it corrupted?".format(fname))
-
-                last = f.readline()         # Read last line.
-            return last
-
         missing_files = []
 
         time_ok = True
@@ -656,18 +601,18 @@ class Energy(SysInfo):
             for part in range(number_of_groupfragments):
                 xvgfilename = self.energypath+'/xvgtables/energies_residue'+str(resid)+'_'+str(part)+self.part+'.xvg'
 
-                if not os.path.isfile(xvgfilename):
+                if not energyfile_exists(xvgfilename):
                     # Check wether file exists
                     missing_res = True
                     missing_files.append(xvgfilename)
 
-                elif os.stat(xvgfilename).st_size == 0:
+                elif energyfile_size(xvgfilename) == 0:
                     # Check wether file is empty
                     missing_files.append(xvgfilename)
 
                 elif check_len:
                     # Check wether whole trajectory was used
-                    line = read_lastline_only(xvgfilename)
+                    line = read_lastline(xvgfilename)
                     time = float(line.decode().split()[0])
                     if time != check_len:
                         time_ok = False
@@ -696,3 +641,251 @@ class Energy(SysInfo):
 
             return False
         return True
+
+    def compact_storage(self, policy=None, parallel=True):
+        ''' Removes and packs intermediate files in energyfiles/ (see energy_storage.DEFAULT_POLICY)
+            Only .xvg tables that cover the whole trajectory count as verified, inputs of
+            runs without verified output are kept.
+            All readers of this class read transparently from the archives.
+        '''
+        return compact_energyfiles(self.energypath, policy=policy,
+            t_end=self.universe.trajectory[-1].time, parallel=parallel)
+
+    def calibrate(self, res=None):
+        ''' Times one energy run on the first fragment of res (default: first residue)
+            Output files are written to the temporary folder and removed afterwards.
+            Returns dict with the time in seconds for
+                grompp, mdrun_per_frame, energy
+        '''
+        if res is None:
+            res = self.MOLRANGE[0]
+        all_neibs_of_res = list(set([neibs for t in self.neiblist[res].keys() for neibs in self.neiblist[res][t]]))
+        self.groupblocks = (0, self.denominator)
+        mdpout = '{}calibration_res{}.mdp'.format(self.temppath, res)
+        tprout = '{}calibration_res{}.tpr'.format(self.temppath, res)
+        edrout = '{}calibration_res{}.edr'.format(self.temppath, res)
+        xvgout = '{}calibration_res{}.xvg'.format(self.temppath, res)
+        LOGGER.info("Calibration run on residue %s with %s neighbors", res, len(all_neibs_of_res[:self.denominator]))
+
+        self.create_MDP(mdpout, self.gather_energygroups(res, all_neibs_of_res))
+        t0 = time.perf_counter()
+        self.create_TPR(mdpout, tprout)
+        t1 = time.perf_counter()
+        self.do_Energyrun(res, 'calibration', tprout, edrout)
+        t2 = time.perf_counter()
+        self.write_XVG(edrout, tprout, self.get_relev_energies(res, all_neibs_of_res), xvgout)
+        t3 = time.perf_counter()
+        for fname in (mdpout, tprout, edrout, xvgout):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+        calibration = {
+            "grompp":t1-t0,
+            "mdrun_per_frame":(t2-t1)/len(self.universe.trajectory),
+            "energy":t3-t2,
+            }
+        LOGGER.info("Calibration: %s", calibration)
+        return calibration
+
+    def estimate_cost(self, resids=None, calibration=None, denominator=None):
+        ''' Estimates the cost of run_calculation for each residue without running anything
+            Returns pandas.DataFrame with columns
+                resid, resname, neighbors, reruns, frames, energygroups, edr_bytes, xvg_bytes, walltime
+            Each rerun reads the whole trajectory, so frames is reruns * length of trajectory.
+            walltime (in s) is only estimated if calibration (output of calibrate) is given.
+        '''
+        if resids is None:
+            resids = self.MOLRANGE
+        if denominator is None:
+            denominator = self.denominator
+        n_frames = len(self.universe.trajectory)
+        n_parts = len(self.molparts)
+
+        def nparts_of(resid):
+            return 1 if self.resid_to_lipid[resid] in lipidmolecules.STEROLS+lipidmolecules.PROTEINS else n_parts
+
+        rows = []
+        for res in resids:
+            all_neibs_of_res = list(set([neibs for t in self.neiblist[res].keys() for neibs in self.neiblist[res][t]]))
+            fragments = [ all_neibs_of_res[ i:(i+denominator) ] for i in range(0, len(all_neibs_of_res), denominator) ]
+            edr_bytes = xvg_bytes = 0
+            max_groups = 0
+            for fragment in fragments:
+                neib_parts = sum([nparts_of(neib) for neib in fragment])
+                n_groups = nparts_of(res) + neib_parts + 1 # +1 for solvent
+                n_terms = 4 * n_groups * (n_groups+1) // 2 # Coul-SR, LJ-SR, Coul-14, LJ-14 per group pair
+                n_selected = 2 * nparts_of(res) * neib_parts + 2
+                edr_bytes += n_frames * n_terms * self.EDR_BYTES_PER_TERM
+                xvg_bytes += n_frames * (n_selected+1) * self.XVG_BYTES_PER_VALUE
+                max_groups = max(max_groups, n_groups)
+            if calibration is not None:
+                walltime = len(fragments) * (calibration["grompp"] + calibration["energy"]\
+                    + calibration["mdrun_per_frame"] * n_frames)
+            else:
+                walltime = np.nan
+            rows.append( (res, self.resid_to_lipid[res], len(all_neibs_of_res), len(fragments), len(fragments)*n_frames,
+                max_groups, edr_bytes, xvg_bytes, walltime) )
+        return pd.DataFrame(rows, columns=["resid", "resname", "neighbors", "reruns", "frames",
+            "energygroups", "edr_bytes", "xvg_bytes", "walltime"])
+
+    def suggest_setting(self, walltime, calibration, startdivisor=1):
+        ''' Suggests divisor (number of jobs of submit_energycalcs) and fragment size (denominator)
+            such that the slowest job finishes within walltime (in s).
+            The smallest divisor is chosen, if no divisor is sufficient the fragment size is increased.
+            Returns dict with keys divisor, denominator, makespan (in s) or None if nothing fits
+        '''
+        n_lipids = self.number_of_lipids
+        divisors = [div for div in range(max(1, int(startdivisor)), n_lipids+1) if n_lipids % div == 0]
+        denominator = self.denominator
+        while True:
+            cost = self.estimate_cost(calibration=calibration, denominator=denominator)
+            if cost.energygroups.max() > self.MAXENERGYGROUPS:
+                break
+            for div in divisors:
+                lipids_per_part = n_lipids // div
+                makespan = max([cost.walltime.iloc[i*lipids_per_part:(i+1)*lipids_per_part].sum() for i in range(div)])
+                if makespan <= walltime:
+                    return {"divisor":div, "denominator":denominator, "makespan":makespan}
+            if cost.reruns.max() <= 1:
+                break
+            denominator *= 2
+        LOGGER.warning("No setting found that finishes within %s s", walltime)
+        return None
+
+    def plan_calculation(self, walltime=None, calibration=None, outputfilename="energy_plan.dat", startdivisor=80):
+        ''' Writes the output of estimate_cost to outputfilename and logs the totals.
+            If calibration is given, the wall time of the longest job for startdivisor is estimated
+            and if also walltime (in s) is given, a setting from suggest_setting is added.
+            Returns (cost per residue, totals, suggested setting)
+        '''
+        cost = self.estimate_cost(calibration=calibration)
+        cost.to_csv(outputfilename, sep=' ', index=False, float_format="%.3f")
+        totals = cost[["reruns", "frames", "edr_bytes", "xvg_bytes", "walltime"]].sum()
+        LOGGER.info("Fragment size: %s", self.denominator)
+        LOGGER.info("Energy runs needed: %s", int(totals.reruns))
+        LOGGER.info("Frames decoded: %s", int(totals.frames))
+        LOGGER.info("Expected disk usage: %.2f GB (.edr) %.2f GB (.xvg)", totals.edr_bytes/1e9, totals.xvg_bytes/1e9)
+        suggestion = None
+        if calibration is not None:
+            divisor = get_minmaxdiv(startdivisor, self.number_of_lipids)
+            lipids_per_part = self.number_of_lipids // divisor
+            makespan = max([cost.walltime.iloc[i*lipids_per_part:(i+1)*lipids_per_part].sum() for i in range(divisor)])
+            LOGGER.info("Estimated CPU time: %.2f h, with divisor %s the longest job takes %.2f h",
+                totals.walltime/3600, divisor, makespan/3600)
+            if walltime is not None:
+                suggestion = self.suggest_setting(walltime, calibration)
+                LOGGER.info("Suggested setting: %s", suggestion)
+        return cost, totals, suggestion
+
+
+def read_xvg(xvgfilename):
+    ''' Reads a .xvg table written by gmx energy
+        Returns the legend of all columns (column 0 is time) and the data as 2D array
+    '''
+    legend = ["Time"]
+    with open_energyfile(xvgfilename) as xvgfile:
+        for line in xvgfile:
+            if line.startswith('@ s'):
+                legend.append(line.split()[3])
+            elif not line.startswith(('@', '#')):
+                break
+        xvgfile.seek(0)
+        data = np.loadtxt(xvgfile, comments=('#', '@'), ndmin=2)
+    return legend, data
+
+def _parts_of(lipidtype, molparts):
+    ''' Returns energy group prefixes of lipidtype without "resid", e.g. "h_" for "resid_h_" '''
+    if lipidtype in lipidmolecules.STEROLS+lipidmolecules.PROTEINS:
+        return ['']
+    return [part[6:] for part in molparts]
+
+def _assemble_energies_of_residue(resid, neib_fragments, resid_to_lipid, molparts, part, energypath, dt, chunkfile, skip_pairs=(), t_end=None):
+    ''' Reads all .xvg fragments of resid and stores all pair energies in binary chunkfile
+        Rows are ordered by fragment, time and neighbor. Defined on module level to be picklable for parallelization.
+        Tables that do not end at t_end (if given) are reported as truncated.
+        Returns (chunkfile, issues); chunkfile is None if the data of resid is incomplete
+    '''
+    issues = []
+    hostparts = _parts_of(resid_to_lipid[resid], molparts)
+    reftimes = None
+    datablocks = []
+
+    for fragment, fragment_neibs in enumerate(neib_fragments):
+        xvgfilename = '{}xvgtables/energies_residue{}_{}{}.xvg'.format(energypath, resid, fragment, part)
+        try:
+            legend, data = read_xvg(xvgfilename)
+        except (OSError, ValueError) as err:
+            issues.append({"resid":resid, "fragment":fragment, "issue":"unreadable", "detail":str(err)})
+            continue
+        if t_end is not None and (len(data) == 0 or data[-1, 0] != t_end):
+            issues.append({"resid":resid, "fragment":fragment, "issue":"truncated",
+                "detail":"last time {} instead of {}".format(data[-1, 0] if len(data) else None, t_end)})
+            continue
+
+        # Column of each energy, legend entries look like "LJ-SR:resid_h_1-resid_t_49"
+        col_of = {}
+        for col, entry in enumerate(legend[1:], start=1):
+            if entry.count("resid_") != 2:
+                continue
+            energytype = entry.split("-")[0][1:]
+            host, neib = entry.split("resid_")[1][:-1], entry.split("resid_")[2][:-1]
+            col_of[(energytype, host, neib)] = col
+
+        times = data[:, 0]
+        mask = times % dt == 0
+        if reftimes is None:
+            reftimes = times[mask]
+        elif not np.array_equal(reftimes, times[mask]):
+            issues.append({"resid":resid, "fragment":fragment, "issue":"inconsistent frames",
+                "detail":"{} frames instead of {}".format(mask.sum(), len(reftimes))})
+            continue
+
+        frag_vdw, frag_coul, frag_neibs, frag_inters = [], [], [], []
+        for neib in fragment_neibs:
+            if (resid, neib) in skip_pairs:
+                continue
+            for parthost in hostparts:
+                for partneib in _parts_of(resid_to_lipid[neib], molparts):
+                    keyhost, keyneib = parthost+str(resid), partneib+str(neib)
+                    try:
+                        frag_vdw.append( col_of[('LJ', keyhost, keyneib)] )
+                        frag_coul.append( col_of[('Coul', keyhost, keyneib)] )
+                    except KeyError:
+                        issues.append({"resid":resid, "fragment":fragment, "issue":"missing column",
+                            "detail":"{} - {}".format(keyhost, keyneib)})
+                        continue
+                    frag_neibs.append(neib)
+                    frag_inters.append('_'.join([parthost.replace("_", "") or 'w', partneib.replace("_", "") or 'w']))
+        datablocks.append( (data[mask], frag_vdw, frag_coul, frag_neibs, frag_inters) )
+
+    if issues or reftimes is None:
+        for issue in issues:
+            LOGGER.warning("Residue %s fragment %s: %s (%s)", issue["resid"], issue["fragment"], issue["issue"], issue["detail"])
+        return None, issues
+
+    # One block per fragment, each flattened time major from arrays of shape (n_times, n_pairs)
+    blocks = []
+    for data, cols_vdw, cols_coul, frag_neibs, frag_inters in datablocks:
+        ntimes, npairs = len(reftimes), len(cols_vdw)
+        block = np.empty(ntimes*npairs, dtype=ENERGY_DTYPE)
+        block["time"]  = np.repeat(reftimes, npairs)
+        block["host"]  = resid
+        block["neib"]  = np.tile(frag_neibs, ntimes)
+        block["inter"] = np.tile(frag_inters, ntimes)
+        block["vdw"]   = data[:, cols_vdw].ravel()
+        block["coul"]  = data[:, cols_coul].ravel()
+        block["etot"]  = block["vdw"] + block["coul"]
+        blocks.append(block)
+    chunk = np.concatenate(blocks) if blocks else np.empty(0, dtype=ENERGY_DTYPE)
+    np.save(chunkfile, chunk)
+    LOGGER.debug("Wrote %s rows of residue %s to %s", len(chunk), resid, chunkfile)
+    return chunkfile, issues
+
+def _merge_energy_chunks(chunkfiles, outputfilename, batchsize=100000):
+    ''' Concatenates chunks in the given order into one table, rows are written in batches '''
+    with open(outputfilename, "w") as energyoutput:
+        print(ENERGY_HEADER, file=energyoutput)
+        for chunkfile in chunkfiles:
+            chunk = np.load(chunkfile, mmap_mode='r')
+            for start in range(0, len(chunk), batchsize):
+                energyoutput.write(''.join([ENERGY_LINE % row for row in chunk[start:start+batchsize].tolist()]))
@@ -0,0 +1,250 @@
+'''
+    This module manages the intermediate files of the energy calculation in energyfiles/
+        - .tpr and .mdp files are removed once the .xvg table of the run is verified
+        - .xvg, .edr and mdrun log files are packed into one zip archive per residue
+          energyfiles/archives/residue<resid>.zip with an index in energyfiles/archives/index.dat
+        - gmx_*.log files in the working directory are compressed and truncated
+    Files inside an archive are read with open_energyfile etc. as if they were still on disk.
+'''
+import os
+import re
+import io
+import glob
+import gzip
+import shutil
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+from .. import log
+from ..common import loop_to_pool
+
+LOGGER = log.LOGGER
+
+ARCHIVEDIR = 'archives'
+INDEXFILE = 'index.dat'
+SUBDIRS = ['xvgtables', 'edrfiles', 'tprfiles', 'mdpfiles', 'logfiles']
+
+# Matches all files written by Energy, group 1 is the resid and group 2 the fragment (including part)
+FILEPATTERN = re.compile(r'(?:energies_residue|energyfile_resid|mdrerun_resid|energy_mdp_recalc_resid)(\d+)_?(.*)\.(xvg|edr|tpr|mdp|log)$')
+
+DEFAULT_POLICY = {
+    "delete_inputs":True,             # Delete .tpr and .mdp once the .xvg output is verified
+    "pack":["xvg", "edr", "log"],     # File types that are moved to the residue archives
+    "compress_logs":True,             # Compress gmx_*.log of working directory to gmx_*.log.gz
+    "compresslevel":6,
+    }
+
+def archive_location(path):
+    ''' Returns archive and member name in which path is stored after packing '''
+    path = os.path.normpath(path)
+    subdir, fname = os.path.split(path)
+    energypath, subdirname = os.path.split(subdir)
+    match = FILEPATTERN.match(fname)
+    if match is None:
+        raise ValueError("{} is not a file of the energy calculation".format(fname))
+    archive = os.path.join(energypath, ARCHIVEDIR, 'residue{}.zip'.format(match.group(1)))
+    return archive, '/'.join([subdirname, fname])
+
+def _archived_info(path):
+    ''' Returns ZipInfo of path if it is stored in an archive else None '''
+    try:
+        archive, member = archive_location(path)
+    except ValueError:
+        return None
+    if not os.path.isfile(archive):
+        return None
+    with zipfile.ZipFile(archive) as zfile:
+        try:
+            return zfile.getinfo(member)
+        except KeyError:
+            return None
+
+def energyfile_exists(path):
+    ''' True if path exists on disk or in its residue archive '''
+    return os.path.isfile(path) or _archived_info(path) is not None
+
+def energyfile_size(path):
+    ''' Size in bytes of path on disk or (uncompressed) in its residue archive '''
+    if os.path.isfile(path):
+        return os.stat(path).st_size
+    info = _archived_info(path)
+    if info is None:
+        raise FileNotFoundError("{} neither on disk nor in archive".format(path))
+    return info.file_size
+
+def open_energyfile(path, mode="r"):
+    ''' Opens path from disk, if it does not exist the member of its residue archive is read into memory '''
+    if os.path.isfile(path):
+        return open(path, mode)
+    if _archived_info(path) is None:
+        raise FileNotFoundError("{} neither on disk nor in archive".format(path))
+    archive, member = archive_location(path)
+    with zipfile.ZipFile(archive) as zfile:
+        content = zfile.read(member)
+    if 'b' in mode:
+        return io.BytesIO(content)
+    return io.StringIO(content.decode())
+
+@contextmanager
+def extracted_energyfile(path, temppath):
+    ''' Yields a path on disk of path, archived files are extracted to temppath and removed afterwards '''
+    if os.path.isfile(path):
+        yield path
+        return
+    tempfile = os.path.join(temppath, os.path.basename(path))
+    with open_energyfile(path, "rb") as src, open(tempfile, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    try:
+        yield tempfile
+    finally:
+        os.remove(tempfile)
+
+def read_lastline(path):
+    ''' Reads last line of path (as bytes), from the end of the file if it is on disk '''
+    if not os.path.isfile(path):
+        with open_energyfile(path, "rb") as fobj:
+            last = deque(fobj, maxlen=1)
+        if not last:
+            raise RuntimeError("File {} is empty. Is it corrupted?".format(path))
+        return last[0]
+    MAXCOUNT = 100000
+    cnt = 0
+    with open(path, "rb") as f:
+        f.seek(-2, os.SEEK_END)     # Jump to the second last byte.
+        while f.read(1) != b"\n" and f.tell() != 1:   # Until EOL is found... if f.tell() == 0 means cursor is at the beginning of file
+            f.seek(-2, os.SEEK_CUR) # ...jump back the read byte plus one more.
+            cnt += 1
+            if cnt > MAXCOUNT:
+                raise RuntimeError("Reach max byte count in file {}. Is it corrupted?".format(path))
+
+        if f.tell() == 1:
+            raise RuntimeError("File {} has no EOL character. Is it corrupted?".format(path))
+
+        last = f.readline()         # Read last line.
+    return last
+
+def xvg_is_complete(path, t_end=None):
+    ''' True if xvg table path is not empty and (if given) ends at time t_end '''
+    try:
+        if energyfile_size(path) == 0:
+            return False
+        time = float(read_lastline(path).decode().split()[0])
+    except (FileNotFoundError, RuntimeError, ValueError, IndexError):
+        return False
+    return t_end is None or time == t_end
+
+def files_per_residue(energypath):
+    ''' Returns dict resid -> list of all files of the energy calculation on disk '''
+    files = {}
+    for subdir in SUBDIRS:
+        for fpath in glob.glob(os.path.join(energypath, subdir, '*')):
+            match = FILEPATTERN.match(os.path.basename(fpath))
+            if match is not None:
+                files.setdefault(int(match.group(1)), []).append(fpath)
+    return files
+
+def compact_residue(resid, files, archive, policy, t_end=None):
+    ''' Applies policy to all files of resid
+        Defined on module level to be picklable for parallelization.
+        Returns dict with number of deleted and packed files and freed bytes
+    '''
+    report = {"resid":resid, "deleted":0, "packed":0, "freed":0, "unverified":[]}
+    complete = {}
+    for fpath in files:
+        match = FILEPATTERN.match(os.path.basename(fpath))
+        if match.group(3) == 'xvg':
+            complete[match.group(2)] = xvg_is_complete(fpath, t_end)
+            if not complete[match.group(2)]:
+                report["unverified"].append(fpath)
+
+    to_pack, to_delete = [], []
+    for fpath in files:
+        match = FILEPATTERN.match(os.path.basename(fpath))
+        ftype = match.group(3)
+        if ftype in ('tpr', 'mdp') and policy["delete_inputs"] and complete.get(match.group(2), False):
+            to_delete.append(fpath)
+        elif ftype in policy["pack"] and (ftype != 'xvg' or complete[match.group(2)]):
+            to_pack.append(fpath)
+
+    if to_pack:
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        members = {'/'.join(fpath.split(os.sep)[-2:]):fpath for fpath in to_pack}
+        tmparchive = archive + '.tmp'
+        with zipfile.ZipFile(tmparchive, "w", zipfile.ZIP_DEFLATED, compresslevel=policy["compresslevel"]) as newzip:
+            if os.path.isfile(archive):
+                with zipfile.ZipFile(archive) as oldzip:
+                    for info in oldzip.infolist():
+                        if info.filename not in members:
+                            newzip.writestr(info, oldzip.read(info.filename))
+            for member, fpath in members.items():
+                newzip.write(fpath, member)
+        with zipfile.ZipFile(tmparchive) as newzip:
+            broken = newzip.testzip()
+        if broken is not None:
+            os.remove(tmparchive)
+            raise RuntimeError("Packing of residue {} failed at {}".format(resid, broken))
+        os.replace(tmparchive, archive)
+        to_delete += to_pack
+        report["packed"] = len(to_pack)
+
+    for fpath in to_delete:
+        report["freed"] += os.stat(fpath).st_size
+        os.remove(fpath)
+    report["deleted"] = len(to_delete) - report["packed"]
+    return report
+
+def write_archive_index(energypath):
+    ''' Writes table of all archived files to archives/index.dat '''
+    archives = sorted(glob.glob(os.path.join(energypath, ARCHIVEDIR, 'residue*.zip')))
+    with open(os.path.join(energypath, ARCHIVEDIR, INDEXFILE), "w") as indexf:
+        print('{: <20}{: <60}{: <15}{: <15}'.format("Archive", "Member", "Size", "Compressed"), file=indexf)
+        for archive in archives:
+            with zipfile.ZipFile(archive) as zfile:
+                for info in zfile.infolist():
+                    print('{: <20}{: <60}{: <15}{: <15}'.format(os.path.basename(archive),
+                        info.filename, info.file_size, info.compress_size), file=indexf)
+
+def compress_logs(logpath=".", compresslevel=6):
+    ''' Appends content of gmx_*.log in logpath to gmx_*.log.gz and truncates the log files
+        Returns number of freed bytes
+    '''
+    freed = 0
+    for logfile in glob.glob(os.path.join(logpath, 'gmx_*.log')):
+        size = os.stat(logfile).st_size
+        if not size:
+            continue
+        with open(logfile, "rb") as src, gzip.open(logfile+'.gz', "ab", compresslevel=compresslevel) as dst:
+            shutil.copyfileobj(src, dst)
+        open(logfile, "w").close()
+        freed += size
+    return freed
+
+def compact_energyfiles(energypath, policy=None, t_end=None, resids=None, parallel=True):
+    ''' Cleans up and packs all intermediate files in energypath according to policy (see DEFAULT_POLICY)
+        Only .xvg files that end at t_end (if given) count as verified.
+        Returns list of reports of compact_residue
+    '''
+    current_policy = dict(DEFAULT_POLICY)
+    if policy is not None:
+        current_policy.update(policy)
+    files = files_per_residue(energypath)
+    if resids is not None:
+        files = {resid:files[resid] for resid in resids if resid in files}
+    inpargs = [(resid, resfiles, archive_location(resfiles[0])[0], current_policy, t_end)
+        for resid, resfiles in sorted(files.items())]
+    LOGGER.info("Compacting energy files of %s residues", len(inpargs))
+    if parallel and inpargs:
+        reports = loop_to_pool(compact_residue, inpargs)
+    else:
+        reports = [compact_residue(*inp) for inp in inpargs]
+    if os.path.isdir(os.path.join(energypath, ARCHIVEDIR)):
+        write_archive_index(energypath)
+    freed = sum([report["freed"] for report in reports])
+    if current_policy["compress_logs"]:
+        freed += compress_logs(compresslevel=current_policy["compresslevel"])
+    unverified = [fpath for report in reports for fpath in report["unverified"]]
+    if unverified:
+        LOGGER.warning("%s xvg files could not be verified and are kept: %s", len(unverified), unverified)
+    LOGGER.info("Deleted %s, packed %s files and freed %.2f MB",
+        sum([report["deleted"] for report in reports]), sum([report["packed"] for report in reports]), freed/1e6)
+    return reports
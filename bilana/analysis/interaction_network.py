@@ -0,0 +1,171 @@
+'''
+    This module builds sparse lipid x lipid interaction energy matrices from the output of analysis.energy
+    and calculates network metrics on them.
+    All frames are stacked into one sparse matrix of shape (nframes*nlipids, nlipids):
+        row frame*nlipids + i is the interaction of lipid i with all other lipids in frame
+'''
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from .. import log
+from ..systeminfo import SysInfo
+from .energy import CHUNK_MANIFEST, ENERGY_DTYPE
+
+LOGGER = log.LOGGER
+
+ENERGYFILES = {
+    'complete':'all_energies.dat',
+    'head-tail':'all_energies_headtail.dat',
+    'head-tailhalfs':'all_energies_headtailhalfs.dat',
+    'carbons':'all_energies_carbons.dat',
+    }
+
+class InteractionNetwork(SysInfo):
+    ''' Interaction energies of all lipid pairs over time
+        part:  The part used in energy.Energy
+        term:  One of vdw, coul, etot
+        inter: Only take entries of this molparts string into account (e.g. "h_t"),
+               if None all entries of a pair are summed up
+        use_chunks: Read the binary chunks of the last Energy.write_energyfile run instead of energyfilename
+    '''
+
+    TERMS = ["vdw", "coul", "etot"]
+
+    def __init__(self, part="complete", inputfilename="inputfile", energyfilename=None, term="etot", inter=None,
+        use_chunks=False):
+        super().__init__(inputfilename, load_univ=False)
+        if part not in ENERGYFILES:
+            raise ValueError("Part keyword specified is not known.")
+        if term not in self.TERMS:
+            raise ValueError("Term must be one of {}".format(self.TERMS))
+        self.part = '' if part == 'complete' else part
+        self.term = term
+        self.inter = inter
+        self.energyfilename = ENERGYFILES[part] if energyfilename is None else energyfilename
+        self.use_chunks = use_chunks
+        self.lipids = np.array(self.MOLRANGE)
+        self.nlipids = len(self.lipids)
+        self.leaflets = np.array([self.res_to_leaflet[res] for res in self.lipids], dtype=int)
+        self.frametimes, self.matrix = self.build_matrix(self.read_energies())
+
+    def read_energies(self):
+        ''' Returns all energy entries as structured array (see energy.ENERGY_DTYPE)
+            The table energyfilename is read, if use_chunks is set the binary chunks listed in the
+            manifest of the last Energy.write_energyfile run are used instead.
+        '''
+        if self.use_chunks:
+            chunkpath = self.energypath + 'chunks/'
+            manifest = chunkpath + CHUNK_MANIFEST.format(self.part)
+            if not os.path.isfile(manifest):
+                raise FileNotFoundError("{} not found, run Energy.write_energyfile first".format(manifest))
+            with open(manifest, "r") as manifestfile:
+                chunkfiles = [chunkpath+line.strip() for line in manifestfile if line.strip()]
+            LOGGER.info("Reading %s energy chunks", len(chunkfiles))
+            if not chunkfiles:
+                return np.empty(0, dtype=ENERGY_DTYPE)
+            return np.concatenate([np.load(fname) for fname in chunkfiles])
+        LOGGER.info("Reading %s", self.energyfilename)
+        table = pd.read_csv(self.energyfilename, sep=r'\s+')
+        records = np.empty(len(table), dtype=ENERGY_DTYPE)
+        for field, column in zip(records.dtype.names, table.columns):
+            records[field] = table[column].to_numpy()
+        return records
+
+    def build_matrix(self, records):
+        ''' Returns times of frames and the stacked csr matrix of term '''
+        if self.inter is not None:
+            records = records[records["inter"] == self.inter]
+        frametimes, frame = np.unique(records["time"], return_inverse=True)
+        host = np.searchsorted(self.lipids, records["host"])
+        neib = np.searchsorted(self.lipids, records["neib"])
+        known = (host < self.nlipids) & (neib < self.nlipids)
+        known[known] &= (self.lipids[host[known]] == records["host"][known])\
+            & (self.lipids[neib[known]] == records["neib"][known])
+        if not known.all():
+            LOGGER.warning("Skipping %s entries of residues that are not lipids", np.count_nonzero(~known))
+        rows = frame[known] * self.nlipids + host[known]
+        matrix = sparse.csr_matrix((records[self.term][known], (rows, neib[known])),
+            shape=(len(frametimes)*self.nlipids, self.nlipids))
+        matrix.sum_duplicates()
+        return frametimes, matrix
+
+    @property
+    def nframes(self):
+        return len(self.frametimes)
+
+    def frame(self, index):
+        ''' Returns the nlipids x nlipids csr matrix of frame index '''
+        return self.matrix[index*self.nlipids:(index+1)*self.nlipids]
+
+    def _per_frame(self, values):
+        return np.asarray(values).reshape(self.nframes, self.nlipids, *np.shape(values)[1:])
+
+    def total_energy(self):
+        ''' Total interaction energy of each lipid, shape (nframes, nlipids) '''
+        return self._per_frame(np.asarray(self.matrix.sum(axis=1)).ravel())
+
+    def degree(self):
+        ''' Number of interaction partners of each lipid, shape (nframes, nlipids) '''
+        return self._per_frame(np.diff(self.matrix.indptr))
+
+    def weighted_degree(self):
+        ''' Sum of absolute interaction energies of each lipid, shape (nframes, nlipids) '''
+        return self._per_frame(np.asarray(abs(self.matrix).sum(axis=1)).ravel())
+
+    def strongest_partner(self):
+        ''' Partner with the lowest interaction energy of each lipid
+            Returns resids and energies, both of shape (nframes, nlipids)
+            Lipids without partner get resid -1 and energy nan
+        '''
+        indptr = self.matrix.indptr
+        nentries = np.diff(indptr)
+        rowofentry = np.repeat(np.arange(len(nentries)), nentries)
+        order = np.lexsort((self.matrix.data, rowofentry))
+        has_partner = nentries > 0
+        first = order[indptr[:-1][has_partner]]
+        partner = np.full(len(nentries), -1, dtype=int)
+        energy = np.full(len(nentries), np.nan)
+        partner[has_partner] = self.lipids[self.matrix.indices[first]]
+        energy[has_partner] = self.matrix.data[first]
+        return self._per_frame(partner), self._per_frame(energy)
+
+    def leaflet_sums(self):
+        ''' Interaction energy of each lipid with lipids of leaflet 0 and 1, shape (nframes, nlipids, 2)
+            Leaflet-leaflet sums per frame are obtained via leaflet_block_sums
+        '''
+        indicator = sparse.csr_matrix((np.ones(self.nlipids), (np.arange(self.nlipids), self.leaflets)),
+            shape=(self.nlipids, 2))
+        return self._per_frame((self.matrix @ indicator).toarray())
+
+    def leaflet_block_sums(self):
+        ''' Summed interaction energy between leaflets, shape (nframes, 2, 2)
+            [:, i, j] is the energy of hosts in leaflet i with neighbors in leaflet j
+        '''
+        per_lipid = self.leaflet_sums()
+        return np.stack([per_lipid[:, self.leaflets == leaflet].sum(axis=1) for leaflet in (0, 1)], axis=1)
+
+    def save(self, outputfilename="interaction_network.npz"):
+        ''' Stores the stacked matrix together with times and resids '''
+        np.savez_compressed(outputfilename, data=self.matrix.data, indices=self.matrix.indices,
+            indptr=self.matrix.indptr, shape=self.matrix.shape, times=self.frametimes, resids=self.lipids)
+
+    def write_network_metrics(self, outputfilename="interaction_network.dat"):
+        ''' Writes all per lipid metrics for each frame to outputfilename '''
+        partner, partner_energy = self.strongest_partner()
+        leaflet_sums = self.leaflet_sums()
+        metrics = pd.DataFrame({
+            "time":np.repeat(self.frametimes, self.nlipids),
+            "resid":np.tile(self.lipids, self.nframes),
+            "resname":np.tile([self.resid_to_lipid[res] for res in self.lipids], self.nframes),
+            "leaflet":np.tile(self.leaflets, self.nframes),
+            "Etot":self.total_energy().ravel(),
+            "partner":partner.ravel(),
+            "Epartner":partner_energy.ravel(),
+            "degree":self.degree().ravel(),
+            "wdegree":self.weighted_degree().ravel(),
+            "Eleaflet0":leaflet_sums[..., 0].ravel(),
+            "Eleaflet1":leaflet_sums[..., 1].ravel(),
+            })
+        metrics.to_csv(outputfilename, sep=' ', index=False, float_format="%.5f")
+        return metrics
@@ -3,6 +3,8 @@ import numpy as np
 import MDAnalysis as mda
 from . import neighbors
 from . import protein
+from . import msd
+from . import diffusion
 from ..import log
 from ..import common as cm
 from ..common import exec_gromacs
@@ -227,10 +229,20 @@ def create_scd_map(sysinfo, orderfilename="scd_distribution.dat"):
     '''
 
 
-def calc_diffusion(sysinfo, selection, mol=False):
-    ''' Use gromacs to calculate diffusion of lipid type '''
+def calc_diffusion(sysinfo, selection, mol=False, method="gmx"):
+    ''' Calculate lateral MSD and (if mol) diffusion of each molecule of selection
+        method is either
+            gmx    -- gmx select and gmx msd -lateral z
+            native -- MDAnalysis selection and all-origin MSD of msd.lateral_positions, the outputs have
+                      the same columns as those of gmx msd
+    '''
     outpath = sysinfo.datapath + "diffusion/"
     os.makedirs(outpath, exist_ok=True)
+    if method == "native":
+        _calc_diffusion_native(sysinfo, selection, mol, outpath)
+        return
+    if method != "gmx":
+        raise ValueError("method must be gmx or native")
 
     # get index entry for atom choice
     ndxname = sysinfo.temppath + "tmp{}.ndx".format(selection.replace(" ", ""))
@@ -255,3 +267,15 @@ def calc_diffusion(sysinfo, selection, mol=False):
         cmd += ["-mol", output_diff]
     out, err = exec_gromacs(cmd, inpstr)
     print(out+"\n", err+"\n")
+
+def _calc_diffusion_native(sysinfo, selection, mol, outpath):
+    ''' Writes msd_<selection>.xvg (time, MSD in nm^2) and if mol diff_<selection>.xvg (resid, D in 1e-5 cm^2/s) '''
+    atoms = sysinfo.universe.select_atoms(selection)
+    times, resids, _, positions = msd.lateral_positions(sysinfo, atoms, by_residue=mol)
+    lipid_msd = msd.msd_fft(positions)
+    lags = times - times[0]
+    label = selection.replace(" ", "")
+    np.savetxt(outpath + "msd_{}.xvg".format(label), np.column_stack([lags, lipid_msd.mean(axis=0)]), fmt="%.6f")
+    if mol:
+        lipid_diffusion = diffusion.fit_diffusion(lags, lipid_msd) * diffusion.NM2_PER_PS_IN_1E5_CM2_PER_S
+        np.savetxt(outpath + "diff_{}.xvg".format(label), np.column_stack([resids, lipid_diffusion]), fmt=["%d", "%.6f"])
@@ -1,11 +1,14 @@
 import os
-import re
 import numpy as np
 import pandas as pd
 import MDAnalysis as mda
+from MDAnalysis.lib.distances import capped_distance, self_capped_distance
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from ..definitions import lipidmolecules
-from ..common import exec_gromacs
+from ..common import exec_gromacs, imap_to_pool, frame_ranges, cached_universe, minimum_image, truncate_npy
 from .. import log
+from ..systeminfo import LeafletAssignment
 LOGGER = log.LOGGER
 
 def is_neighbor_in_leaflet(systeminfo_inst, neiblist):
@@ -29,78 +32,42 @@ def molecule_leaflet_orientation(atompos1: np.array, atompos2: np.array, axis=np
     cos = np.dot(new_coords, axis) / np.linalg.norm(new_coords)
     return ( 0 if cos <= 0 else 1 )
 
-def create_leaflet_assignment_file(sysinfo_obj, verbosity="INFO"):
+def create_leaflet_assignment_file(sysinfo_obj, verbosity="INFO", nframes=1, outputfilename='leaflet_assignment.dat',
+    method="orientation", cutoff=15.0):
     ''' Creates a file with that assigns all lipids to upper or lower leaflet
+        The orientation of each residue (see leaflets_of_positions) is taken from the structure file or,
+        if nframes > 1, the leaflet each residue is assigned to most often in the first nframes of the
+        trajectory is used (ties are decided by the first frame).
+        method is orientation or graph (see leaflet_assignment_time_evolution)
+        The orientation is the vector from the center of mass of the last tail atoms of all chains to the
+        head atom. Former versions used the last tail atom of the first chain only, both give the same
+        assignment for flat bilayers.
+        Returns the LeafletAssignment
                         !Attention!
             !Flip flops of Cholesterol are not considered! Though should it?
     '''
     LOGGER.setLevel(verbosity)
-    outputfilename = 'leaflet_assignment.dat'
-    grofile_path = sysinfo_obj.gropath
-    coord_head, coord_base = None, None
-
-    with open(grofile_path, "r") as gfile, open(outputfilename, "w") as outf:
-        print("{: <7} {: <5}".format('resid', 'leaflet'), file=outf) # HEADER
-
-                #========================RESID=======RESNAME======ATOMNAME=======INDEX===============X============Y============Z=======
-        regexp = re.compile(r'^([\s,\d]{5})([\w,\s]{5})([\d,\w,\s]{5})([\s*\d+]{5})\s*(-?\d+\.\d+\s*-?\d+\.\d+\s*-?\d+\.\d+).*')
-        old_resid = 0
-        sum_upper = 0
-        sum_lower = 0
-
-        for line in gfile:
-            match = regexp.match(line)
-
-            if match:
-                resid = int(match.group(1).split()[0])
-
-                if not old_resid:
-                    old_resid = resid
-
-                resname = match.group(2).split()[0].upper()
-                atomname = match.group(3).split()[0]
-                coords = [float(i) for i in match.group(5).split()]
-
-                if resname not in sysinfo_obj.molecules:
-                    continue
-
-                last_tail_atm = lipidmolecules.scd_tail_atoms_of(resname)[0][-1]
-                head_atm = lipidmolecules.central_atom_of(resname)
-
-                if old_resid != resid:
-                    LOGGER.debug("Resid/resname/atmname %s/%s/%s", resid, resname, atomname)
-                    LOGGER.debug("Coords head/base: %s/%s", coord_head, coord_base)
-
-                    leaflet = molecule_leaflet_orientation(coord_head, coord_base)
-
-                    if leaflet:
-                        sum_lower += 1
-                    else:
-                        sum_upper += 1
-
-                    print("{: <7} {: <5}".format(old_resid, leaflet), file=outf)
-
-                    old_resid = resid
-                    coord_head = coord_base = None
-
-                if atomname == head_atm:
-                    coord_head = np.array(coords)
-                    LOGGER.debug("Added head %s", atomname)
-                if atomname == last_tail_atm:
-                    coord_base = np.array(coords)
-                    LOGGER.debug("Added tail %s", atomname)
-
-        if coord_base is not None and coord_head is not None:
-            new_coords = coord_head - coord_base
-            cos = np.dot(new_coords, np.array([0.0,0.0,1.0]))/np.linalg.norm(new_coords)
-            if cos <= 0:
-                sum_upper += 1
-                leaflet = 0
-            else:
-                sum_lower += 1
-                leaflet = 1
-            print("{: <7} {: <5}".format(old_resid, leaflet), file=outf)
-        LOGGER.info("UP: %s LOW: %s", sum_upper, sum_lower)
+    if nframes > 1:
+        universe = sysinfo_obj.universe
+    else:
+        universe = mda.Universe(sysinfo_obj.gropath)
+    resids, resnames, *refinfo = leaflet_reference_index(universe.atoms, sysinfo_obj.molecules)
+    graphinfo = _graphinfo(method, resnames, cutoff)
+    frames = universe.trajectory[:max(nframes, 1)]
+    if graphinfo is None:
+        votes = np.array([leaflets_of_positions(ts.positions, *refinfo, box=ts.dimensions) for ts in frames])
+    else:
+        votes = np.array([graph_leaflets_of_positions(ts.positions, *refinfo, graphinfo[0], box=ts.dimensions,
+            cutoff=cutoff) for ts in frames])
+    leaflet = votes[0]
+    if len(votes) > 1:
+        ones = votes.sum(axis=0, dtype=int)
+        leaflet = np.where(2*ones == len(votes), votes[0], 2*ones > len(votes)).astype(np.int8)
+        LOGGER.info("%s residues change leaflet within the first %s frames", np.count_nonzero(votes.min(axis=0) != votes.max(axis=0)), len(votes))
+    assignment = LeafletAssignment(resids, leaflet)
+    assignment.write(outputfilename)
+    LOGGER.info("UP: %s LOW: %s", np.count_nonzero(leaflet == 0), np.count_nonzero(leaflet == 1))
+    return assignment
 
 
 def leaflet_assignment_of_frame(residues: mda.ResidueGroup, refhead: dict, reftail: dict) -> pd.DataFrame:
@@ -132,73 +99,254 @@ def leaflet_assignment_of_frame(residues: mda.ResidueGroup, refhead: dict, refta
     dt = pd.DataFrame({"resid":resids, "resname":resnames, "leaflet":leaflet_assignment})
     return dt
 
-def leaflet_assignment_time_evolution(sysinfo, outputfilename="leaflet_trajectory.csv"):
-    ''' Create leaflet assignment file for whole trajectory '''
-    u = sysinfo.universe
-    frames = []
-    refdict_head = {}
-    refdict_tail = {}
-    for mol in sysinfo.molecules:
-        refdict_head[mol] = "name {}".format( lipidmolecules.central_atom_of(mol) )
-        refdict_tail[mol] = "name {}".format( ' '.join( [i[-1] for i in lipidmolecules.scd_tail_atoms_of(mol)] ) )
-    for ts in u.trajectory:
-        time = ts.time
-        if time < sysinfo.t_start:
+def leaflet_reference_index(atoms, molecules):
+    ''' Looks up the reference atoms of all residues of molecules:
+            head: index of central atom (lipidmolecules.central_atom_of)
+            tail: indices of the last tail atom of each chain (lipidmolecules.scd_tail_atoms_of), the leaflet
+                is taken from their mass weighted center instead of the last atom of the first chain
+        Returns resids, resnames, head (residue), tail (residue, chain), tail_weights (residue, chain)
+        tail_weights are the masses normalized per residue and 0 for padding
+    '''
+    index_of = dict(zip(zip(atoms.resids[::-1], atoms.names[::-1]), range(len(atoms)-1, -1, -1)))
+    residues = atoms.select_atoms("resname {}".format(' '.join(molecules))).residues
+    resids, resnames, heads, tails = [], [], [], []
+    for resid, resname in zip(residues.resids, residues.resnames):
+        try:
+            heads.append(index_of[(resid, lipidmolecules.central_atom_of(resname))])
+            tails.append([index_of[(resid, chain[-1])] for chain in lipidmolecules.scd_tail_atoms_of(resname)])
+        except KeyError as err:
+            raise KeyError("Reference atom {} not found in residue {} {}".format(err, resid, resname)) from err
+        resids.append(resid)
+        resnames.append(resname)
+    nchains = max([len(tail) for tail in tails], default=0)
+    tail = np.zeros((len(tails), nchains), dtype=int)
+    tail_mask = np.zeros((len(tails), nchains), dtype=bool)
+    for resndx, indices in enumerate(tails):
+        tail[resndx, :len(indices)] = indices
+        tail_mask[resndx, :len(indices)] = True
+    tail_weights = np.where(tail_mask, atoms.masses[tail], 0)
+    tail_weights /= tail_weights.sum(axis=1, keepdims=True)
+    return np.array(resids), np.array(resnames), np.array(heads, dtype=int), tail, tail_weights
+
+def leaflets_of_positions(positions, head, tail, tail_weights, box=None, axis=np.array([0.0, 0.0, 1.0])):
+    ''' Leaflet (see molecule_leaflet_orientation) of all residues from head atom and center of mass
+        of the tail atoms, vectors are corrected for periodic boundaries
+        Returns int8 array (residue)
+    '''
+    new_coords = head_tail_vectors(positions, head, tail, tail_weights, box=box)
+    cos = new_coords @ axis / np.sqrt((new_coords**2).sum(axis=1))
+    return np.where(cos <= 0, 0, 1).astype(np.int8)
+
+def head_tail_vectors(positions, head, tail, tail_weights, box=None):
+    ''' Vectors from center of mass of the tail atoms to the head atom of all residues (residue, xyz) '''
+    head_xyz = positions[head]
+    return -(minimum_image(positions[tail] - head_xyz[:, None, :], box) * tail_weights[..., None]).sum(axis=1)
+
+def graph_leaflets_of_positions(positions, head, tail, tail_weights, is_sterol, box=None, cutoff=15.0):
+    ''' Leaflet of all residues from the connectivity of their head atoms, for curved or tilted membranes
+            - Head atoms of all non sterol residues closer than cutoff (Angstrom, periodic) are connected
+              (MDAnalysis capped distances, grid search for large systems),
+              the two largest connected components are the leaflets
+            - The leaflets are labeled by their orientation relative to the center of geometry of their
+              head atoms (the membrane has to be whole): If the tail to head vectors of one leaflet point
+              towards the center on average (inner leaflet of vesicles or tubes), the outer leaflet becomes
+              leaflet 1. Otherwise (flat or undulating bilayers) the component with the larger fraction of
+              residues with orientation 1 (see leaflets_of_positions) becomes leaflet 1, so flat bilayers
+              get the usual labels.
+            - Sterols and residues of smaller components get the leaflet of the closest head atom
+              of the two leaflets, or their orientation if there is none within 2*cutoff
+        If less than two components are found, all residues get their orientation.
+        Returns int8 array (residue)
+    '''
+    directions = head_tail_vectors(positions, head, tail, tail_weights, box=box)
+    directions /= np.sqrt((directions**2).sum(axis=1, keepdims=True))
+    orientation = np.where(directions[:, 2] <= 0, 0, 1).astype(np.int8)
+    head_xyz = positions[head]
+    lipids = np.nonzero(~is_sterol)[0]
+    pairs = self_capped_distance(head_xyz[lipids], cutoff, box=box, return_distances=False)
+    graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(lipids), len(lipids)))
+    _, components = connected_components(graph, directed=False)
+    leaflets = orientation.copy()
+    sizes = np.bincount(components)
+    largest = np.argsort(sizes)[::-1][:2]
+    in_leaflet = np.zeros(len(head), dtype=bool)
+    if len(largest) == 2:
+        members_of = [lipids[components == comp] for comp in largest]
+        center = head_xyz[np.concatenate(members_of)].mean(axis=0)
+        radial = [np.einsum('ij,ij->i', head_xyz[members] - center, directions[members]).mean() for members in members_of]
+        if min(radial) < 0:
+            first_is_upper = radial[0] > radial[1]
+        else:
+            fractions = [orientation[members].mean() for members in members_of]
+            first_is_upper = fractions[0] > fractions[1]
+        for members, label in zip(members_of, (int(first_is_upper), int(not first_is_upper))):
+            leaflets[members] = label
+            in_leaflet[members] = True
+    else:
+        LOGGER.warning("Found %s connected components of head atoms within %s A, leaflets are assigned by orientation",
+            len(largest), cutoff)
+    members = np.nonzero(in_leaflet)[0]
+    others = np.nonzero(~in_leaflet)[0]
+    if len(others) and len(members):
+        pairs, distances = capped_distance(head_xyz[others], head_xyz[members], 2*cutoff, box=box)
+        if len(pairs):
+            order = np.lexsort((distances, pairs[:, 0]))
+            first = order[np.unique(pairs[order, 0], return_index=True)[1]]
+            leaflets[others[pairs[first, 0]]] = leaflets[members[pairs[first, 1]]]
+    return leaflets
+
+def _leaflets_of_frames(gropath, trjpath, frames, refinfo, timefilter, graphinfo=None):
+    ''' Leaflet of all residues of refinfo (head, tail, tail_weights) in frames (start, stop) of trajectory
+        Frames with t_start <= time <= t_end (timefilter) are used.
+        If graphinfo (is_sterol, cutoff) is given, graph_leaflets_of_positions is used.
+        Defined on module level to be picklable for parallelization.
+        Returns times and int8 array (frame, residue)
+    '''
+    universe = cached_universe(gropath, trjpath)
+    t_start, t_end = timefilter
+    times = np.empty(frames[1] - frames[0])
+    leaflets = np.empty((frames[1] - frames[0], len(refinfo[0])), dtype=np.int8)
+    nframes = 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time < t_start or ts.time > t_end:
             continue
-        elif time > sysinfo.t_end:
-            break
-        atomsel = u.atoms.select_atoms("resname {}".format( ' '.join(sysinfo.molecules) ) )
-        frame = leaflet_assignment_of_frame(atomsel.residues, refhead=refdict_head, reftail=refdict_tail)
-        frame["time"] = time
-        LOGGER.debug("Time at %s\n%s", time, frame)
-        frames.append(frame)
-    dat = pd.concat(frames)
-    dat.to_csv(outputfilename, index=False)
-
-def get_flipflop_events(inpfilename, outputfilename="flipflop_events.csv"):
+        times[nframes] = ts.time
+        if graphinfo is None:
+            leaflets[nframes] = leaflets_of_positions(ts.positions, *refinfo, box=ts.dimensions)
+        else:
+            leaflets[nframes] = graph_leaflets_of_positions(ts.positions, *refinfo, graphinfo[0], box=ts.dimensions, cutoff=graphinfo[1])
+        nframes += 1
+    return times[:nframes], leaflets[:nframes]
+
+def _graphinfo(method, resnames, cutoff):
+    ''' Extra input of the leaflet workers for method orientation or graph '''
+    if method == "orientation":
+        return None
+    if method != "graph":
+        raise ValueError("method must be orientation or graph")
+    return np.isin(resnames, lipidmolecules.STEROLS), cutoff
+
+def leaflet_assignment_time_evolution(sysinfo, outputfilename="leaflet_trajectory.csv",
+    matrixfilename="leaflet_trajectory.npy", method="orientation", cutoff=15.0, parallel=True):
+    ''' Create leaflet assignment file for whole trajectory
+        method is orientation (head-tail vector along z, see leaflets_of_positions) or
+        graph (connected head atoms within cutoff, see graph_leaflets_of_positions)
+        The leaflets are stored in matrixfilename as int8 array (frame, residue), together with
+        <matrixfilename>_times.npy and <matrixfilename>_resids.npy (see load_leaflet_matrix).
+        If outputfilename is given the matrix is exported as csv with columns resid, resname, leaflet, time.
+    '''
+    u = sysinfo.universe
+    resids, resnames, *refinfo = leaflet_reference_index(u.atoms, sysinfo.molecules)
+    len_traj = len(u.trajectory)
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    graphinfo = _graphinfo(method, resnames, cutoff)
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, refinfo, (sysinfo.t_start, sysinfo.t_end), graphinfo)
+        for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Assigning leaflets of %s residues in %s frames", len(resids), len_traj)
+    if parallel:
+        output = imap_to_pool(_leaflets_of_frames, inpargs)
+    else:
+        output = (_leaflets_of_frames(*inp) for inp in inpargs)
+    matrix = np.lib.format.open_memmap(matrixfilename, mode="w+", dtype=np.int8, shape=(len_traj, len(resids)))
+    times = []
+    for frametimes, leaflets in output:
+        matrix[len(times):len(times)+len(frametimes)] = leaflets
+        times += list(frametimes)
+    matrix.flush()
+    del matrix
+    truncate_npy(matrixfilename, len(times))
+    prefix = os.path.splitext(matrixfilename)[0]
+    np.save(prefix+"_times.npy", np.array(times))
+    np.save(prefix+"_resids.npy", resids)
+    np.save(prefix+"_resnames.npy", resnames)
+    if outputfilename:
+        export_leaflet_csv(matrixfilename, outputfilename)
+
+def load_leaflet_matrix(matrixfilename="leaflet_trajectory.npy", mmap_mode="r"):
+    ''' Returns times, resids, resnames and the (frame, residue) leaflet matrix of leaflet_assignment_time_evolution '''
+    prefix = os.path.splitext(matrixfilename)[0]
+    return np.load(prefix+"_times.npy"), np.load(prefix+"_resids.npy"), np.load(prefix+"_resnames.npy"),\
+        np.load(matrixfilename, mmap_mode=mmap_mode)
+
+def export_leaflet_csv(matrixfilename="leaflet_trajectory.npy", outputfilename="leaflet_trajectory.csv", batchsize=1000):
+    ''' Writes leaflet matrix as csv (one line per residue and frame) in batches of frames '''
+    times, resids, resnames, matrix = load_leaflet_matrix(matrixfilename)
+    for start in range(0, max(len(times), 1), batchsize):
+        batch = np.asarray(matrix[start:start+batchsize])
+        nframes = len(batch)
+        dat = pd.DataFrame({"resid":np.tile(resids, nframes), "resname":np.tile(resnames, nframes),
+            "leaflet":batch.ravel(), "time":np.repeat(times[start:start+batchsize], len(resids))})
+        dat.to_csv(outputfilename, index=False, mode="w" if start == 0 else "a", header=start == 0)
+
+def leaflet_runs(matrix, times, chunksize=10000):
+    ''' Run length encoding of the leaflet of all residues of matrix (frame, residue)
+        The matrix is read in chunks of frames, only the frames where a residue changes its leaflet are kept.
+        Returns arrays over all runs sorted by residue and start:
+            residue index, first frame, end frame (exclusive), leaflet and dwell time
+        All arrays are empty if matrix has no frames or no residues.
+    '''
+    nframes, nres = matrix.shape
+    if nframes == 0 or nres == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, empty, np.zeros(0, dtype=matrix.dtype), np.zeros(0)
+    start_res, start_frame, start_leaflet = [np.arange(nres)], [np.zeros(nres, dtype=int)], [np.asarray(matrix[0])]
+    for first in range(1, nframes, chunksize):
+        block = np.asarray(matrix[first-1:first+chunksize])
+        frames, residues = np.nonzero(block[1:] != block[:-1])
+        start_res.append(residues)
+        start_frame.append(frames + first)
+        start_leaflet.append(block[frames+1, residues])
+    residues, frames, leaflets = np.concatenate(start_res), np.concatenate(start_frame), np.concatenate(start_leaflet)
+    order = np.lexsort((frames, residues))
+    residues, frames, leaflets = residues[order], frames[order], leaflets[order]
+    last_of_res = np.append(residues[1:] != residues[:-1], True)
+    ends = np.where(last_of_res, nframes, np.append(frames[1:], nframes))
+    dt = np.median(np.diff(times)) if len(times) > 1 else 0
+    ext_times = np.append(times, times[-1] + dt) if len(times) else np.zeros(1)
+    return residues, frames, ends, leaflets, ext_times[ends] - ext_times[frames]
+
+def flipflop_transitions(residues, starts, ends, leaflets, dwell, times, min_dwell=10000.0):
+    ''' Completed leaflet changes from the output of leaflet_runs with dwell time hysteresis
+        Only runs that last at least min_dwell count as stable, a transition is a change between two
+        consecutive stable runs of a residue. Shorter excursions in between are ignored.
+        Returns residue index, t_start (last frame of old stable run), t_end (first frame of new one)
+        and the new leaflet
+    '''
+    stable = dwell >= min_dwell
+    residues, starts, ends, leaflets = residues[stable], starts[stable], ends[stable], leaflets[stable]
+    change = (residues[1:] == residues[:-1]) & (leaflets[1:] != leaflets[:-1])
+    new = np.nonzero(change)[0] + 1
+    return residues[new], times[ends[new-1]-1], times[starts[new]], leaflets[new]
+
+def get_flipflop_events(inpfilename="leaflet_trajectory.npy", outputfilename="flipflop_events.csv",
+    min_dwell=10000.0, chunksize=10000):
     ''' Creates two pd.DataFrame(s) with entries:
-        1.    <resid> <resname> <leaflet flip flopped to>
-        2.    <resid> <resname> <start time> <end time>
-        inpfilename must be in .csv format
+        1.    <resid> <resname> <leaflet flip flopped to> <time> <dwell time in new leaflet>
+        2.    <resid> <resname> <start time> <end time> <leaflet>
+        1. contains every change of the leaflet, 2. only transitions between stable runs
+        (at least min_dwell ps, see flipflop_transitions).
+        inpfilename is the leaflet matrix of leaflet_assignment_time_evolution or
+        its csv export (.csv)
     '''
-    dat = pd.read_csv(inpfilename)
-    grpd = dat.groupby("resid")
-    frames1 = []
-    frames2 = []
-    for res, fr in grpd:
-        events = fr[fr.leaflet.diff().fillna(0) != 0]
-        if events.empty:
-            continue
-        split_times = events[events.time.diff().fillna(0) > 10000.0]
-        split_times = [0] + [t for t in split_times.time]
-
-        for i, left_val in enumerate(split_times):
-            if i+1 == len(split_times):
-                dat = events[ events.time >= left_val ]
-            else:
-                right_val = split_times[i+1]
-                dat = events[ (events.time >= left_val) & (events.time < right_val) ]
-            print(dat)
-            start = dat.iloc[0]
-            end   = dat.iloc[-1]
-            if start.leaflet == end.leaflet:
-                frames2.append([start, end])
-
-        events = events[ events.time.diff().fillna(1001.0) > 1000.0 ]
-
-        LOGGER.debug("Mask\n%s", fr.leaflet.diff())
-        LOGGER.debug("At res %s\n%s", res, events)
-        frames1.append(events)
-    final1 = pd.concat(frames1)
+    if inpfilename.endswith(".csv"):
+        dat = pd.read_csv(inpfilename)
+        table = dat.pivot(index="time", columns="resid", values="leaflet")
+        times, resids, matrix = table.index.to_numpy(), table.columns.to_numpy(), table.to_numpy().astype(np.int8)
+        resnames = dat.drop_duplicates("resid").set_index("resid").loc[resids, "resname"].to_numpy()
+    else:
+        times, resids, resnames, matrix = load_leaflet_matrix(inpfilename)
+    residues, starts, ends, leaflets, dwell = leaflet_runs(matrix, times, chunksize=chunksize)
+    event = starts > 0
+    final1 = pd.DataFrame({"resid":resids[residues[event]], "resname":resnames[residues[event]],
+        "leaflet":leaflets[event].astype(int), "time":times[starts[event]], "dwell":dwell[event]})
     final1.to_csv(outputfilename, index=False)
 
-    final2 = pd.DataFrame(columns=["resid", "resname", "t_start", "t_end", "leaflet"])
-    for i, l in enumerate(frames2):
-        final2.loc[i] = [l[0].resid, l[0].resname, l[0].time, l[1].time, l[1].leaflet]
-    final2["resid"] = final2.resid.astype(int)
-    final2["leaflet"] = final2.leaflet.astype(int)
-    print(final2)
+    residues, t_start, t_end, leaflets = flipflop_transitions(residues, starts, ends, leaflets, dwell, times, min_dwell=min_dwell)
+    final2 = pd.DataFrame({"resid":resids[residues].astype(int), "resname":resnames[residues],
+        "t_start":t_start, "t_end":t_end, "leaflet":leaflets.astype(int)})
     final2.to_csv(outputfilename.replace("events", "complete"), index=False)
+    LOGGER.info("%s leaflet changes, %s complete flip flops", len(final1), len(final2))
+    return final1, final2
 
 def calc_density(systeminfo, selstr, outname="density.xvg", overwrite=False, **kw_den):
     '''
@@ -246,8 +394,173 @@ def calc_density(systeminfo, selstr, outname="density.xvg", overwrite=False, **k
     return OUT
 
 
+AMU_PER_NM3_IN_KG_PER_M3 = 1.66053906660
+
+def _density_of_frames(gropath, trjpath, frames, indices, labels, masses, nbins, center_indices, timefilter):
+    ''' Summed mass density profiles along z of all selections (labels) in frames (start, stop) of trajectory
+        z is binned in nbins slices of the box, relative to the center of mass of center_indices if given.
+        Defined on module level to be picklable for parallelization.
+        Returns densities (selection, bin) in kg/m^3 summed over frames, summed box length in nm and number of frames
+    '''
+    universe = cached_universe(gropath, trjpath)
+    t_start, t_end = timefilter
+    nsel = labels.max() + 1 if len(labels) else 0
+    densities = np.zeros(nsel * nbins)
+    sum_boxz, nframes = 0.0, 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time < t_start or ts.time > t_end:
+            continue
+        box = ts.dimensions[:3] / 10
+        frac = ts.positions[indices, 2] / 10 / box[2]
+        if center_indices is not None:
+            # Circular mean, so the center is found also if the bilayer is split by the boundary
+            angle = 2 * np.pi * ts.positions[center_indices, 2] / 10 / box[2]
+            center = np.arctan2(np.sin(angle).mean(), np.cos(angle).mean()) / (2 * np.pi)
+            frac = frac - center + 0.5
+        binndx = np.minimum((np.mod(frac, 1.0) * nbins).astype(int), nbins-1)
+        slab_volume = box[0] * box[1] * box[2] / nbins
+        densities += np.bincount(labels*nbins + binndx, weights=masses, minlength=nsel*nbins) / slab_volume
+        sum_boxz += box[2]
+        nframes += 1
+    return densities.reshape(nsel, nbins) * AMU_PER_NM3_IN_KG_PER_M3, sum_boxz, nframes
+
+def density_profiles(sysinfo, selections, nbins=50, center=None, parallel=True):
+    ''' Mass density profiles along z (in kg/m^3) of many MDAnalysis selections in one trajectory pass
+        selections: dict name -> selection string
+        nbins:      number of slices of the box (as gmx density -sl)
+        center:     selection whose center of mass along z is the origin (as gmx density -center)
+        Returns DataFrame with column z (nm) and one column per selection
+    '''
+    u = sysinfo.universe
+    names = list(selections)
+    groups = [u.select_atoms(selections[name]) for name in names]
+    for name, grp in zip(names, groups):
+        if not len(grp):
+            LOGGER.warning("Selection %s (%s) is empty", name, selections[name])
+    indices = np.concatenate([grp.indices for grp in groups]).astype(int)
+    labels = np.concatenate([np.full(len(grp), ndx) for ndx, grp in enumerate(groups)]).astype(int)
+    masses = np.concatenate([grp.masses for grp in groups])
+    center_indices = None if center is None else u.select_atoms(center).indices
+    len_traj = len(u.trajectory)
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, indices, labels, masses, nbins, center_indices,
+        (sysinfo.t_start, sysinfo.t_end)) for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Density of %s selections in %s frames", len(names), len_traj)
+    if parallel:
+        output = imap_to_pool(_density_of_frames, inpargs)
+    else:
+        output = (_density_of_frames(*inp) for inp in inpargs)
+    densities, sum_boxz, nframes = np.zeros((len(names), nbins)), 0.0, 0
+    for dens, boxz, nfr in output:
+        densities += dens
+        sum_boxz += boxz
+        nframes += nfr
+    if not nframes:
+        raise ValueError("No frame between {} and {}".format(sysinfo.t_start, sysinfo.t_end))
+    binpos = (np.arange(nbins) + 0.5) / nbins
+    if center is not None:
+        binpos -= 0.5
+    dat = pd.DataFrame({"z":binpos * sum_boxz / nframes})
+    for name, dens in zip(names, densities / nframes):
+        dat[name] = dens
+    return dat
+
+def write_density_xvg(outname, z, density):
+    ''' Writes two column table z density like gmx density -xvg none '''
+    np.savetxt(outname, np.column_stack([z, density]), fmt="%12.6f")
+
+def fill_periodic(values, filled, maxiter=None):
+    ''' Fills cells of 2D grid values where filled is False with the mean of their filled neighbors
+        (periodic in both directions), repeated until every cell is filled. Returns new array.
+    '''
+    values = np.where(filled, values, 0.0)
+    filled = filled.copy()
+    maxiter = sum(values.shape) if maxiter is None else maxiter
+    for _ in range(maxiter):
+        if filled.all() or not filled.any():
+            break
+        neighbor_sum = np.zeros_like(values)
+        neighbor_count = np.zeros(values.shape)
+        for shift, axis in ((1, 0), (-1, 0), (1, 1), (-1, 1)):
+            neighbor_sum += np.roll(values, shift, axis=axis)
+            neighbor_count += np.roll(filled, shift, axis=axis)
+        new = ~filled & (neighbor_count > 0)
+        values[new] = neighbor_sum[new] / neighbor_count[new]
+        filled |= new
+    return values
+
+def thickness_of_positions(positions, box, leaflets, grid):
+    ''' Thickness map of one frame from reference atom positions and their leaflets (0 | 1)
+        grid is (nx, ny), z of both leaflets is averaged per cell, empty cells are filled with fill_periodic.
+        z is taken relative to the center of all reference atoms, so bilayers split by the boundary work.
+        Returns thickness map (nx, ny) in nm and local thickness of each reference atom (its cell)
+    '''
+    nx, ny = grid
+    box = box[:3] / 10
+    frac = np.mod(positions / 10 / box, 1.0)
+    cell = np.minimum((frac[:, 0] * nx).astype(int), nx-1) * ny + np.minimum((frac[:, 1] * ny).astype(int), ny-1)
+    angle = 2 * np.pi * frac[:, 2]
+    center = np.arctan2(np.sin(angle).mean(), np.cos(angle).mean()) / (2 * np.pi)
+    z = (np.mod(frac[:, 2] - center + 0.5, 1.0) - 0.5) * box[2]
+    surfaces = []
+    for leaflet in (0, 1):
+        in_leaflet = leaflets == leaflet
+        count = np.bincount(cell[in_leaflet], minlength=nx*ny)
+        zsum = np.bincount(cell[in_leaflet], weights=z[in_leaflet], minlength=nx*ny)
+        zmean = zsum / np.maximum(count, 1)
+        surfaces.append(fill_periodic(zmean.reshape(grid), (count > 0).reshape(grid)))
+    thickness = np.abs(surfaces[1] - surfaces[0])
+    return thickness, thickness.ravel()[cell]
+
+def _thickness_of_frames(gropath, trjpath, frames, indices, leaflets, grid, timefilter):
+    ''' Thickness maps (see thickness_of_positions) of frames (start, stop) of trajectory
+        Defined on module level to be picklable for parallelization.
+        Returns times, boxes (frame, 3), maps (frame, nx, ny) and local thickness (frame, reference atom)
+    '''
+    universe = cached_universe(gropath, trjpath)
+    t_start, t_end = timefilter
+    nframes = frames[1] - frames[0]
+    times, boxes = np.empty(nframes), np.empty((nframes, 3))
+    maps = np.empty((nframes, *grid), dtype=np.float32)
+    local = np.empty((nframes, len(indices)), dtype=np.float32)
+    count = 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time < t_start or ts.time > t_end:
+            continue
+        times[count], boxes[count] = ts.time, ts.dimensions[:3] / 10
+        maps[count], local[count] = thickness_of_positions(ts.positions[indices], ts.dimensions, leaflets, grid)
+        count += 1
+    return times[:count], boxes[:count], maps[:count], local[:count]
+
+def thickness_maps(sysinfo, ref_atomname="P", grid=(20, 20), outputfilename="thickness_maps.npz", parallel=True):
+    ''' Local bilayer thickness on an xy grid from z of reference atoms of both leaflets (sysinfo.res_to_leaflet)
+        Stores compressed arrays in outputfilename:
+            times, boxes (nm), maps (frame, nx, ny) in nm, resids of the reference atoms and
+            lipid_thickness (frame, reference atom), the thickness at the position of each lipid
+        Returns mean thickness of each frame
+    '''
+    u = sysinfo.universe
+    refatoms = u.select_atoms("resname {} and name {}".format(' '.join(sysinfo.molecules), ref_atomname))
+    refatoms = refatoms[np.isin(refatoms.resids, list(sysinfo.res_to_leaflet))]
+    resids = refatoms.resids
+    leaflets = sysinfo.res_to_leaflet.leaflets_of(resids)
+    len_traj = len(u.trajectory)
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, refatoms.indices, leaflets, tuple(grid),
+        (sysinfo.t_start, sysinfo.t_end)) for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Thickness maps of %s reference atoms in %s frames", len(resids), len_traj)
+    if parallel:
+        output = list(imap_to_pool(_thickness_of_frames, inpargs))
+    else:
+        output = [_thickness_of_frames(*inp) for inp in inpargs]
+    times, boxes, maps, local = [np.concatenate(arrays) for arrays in zip(*output)]
+    np.savez_compressed(outputfilename, times=times, boxes=boxes, maps=maps, resids=resids, lipid_thickness=local)
+    return pd.DataFrame({"time":times, "thickness":maps.mean(axis=(1, 2))})
+
 def calc_thickness(universe, ref_atomname, fname="bilayer_thickness"):
-    ''' Calculate thickness of a bilayer structure using reference atoms ref_atomname '''
+    ''' Calculate thickness of a bilayer structure using reference atoms ref_atomname
+        Leaflets are split by atom order, for leaflet aware local thickness see thickness_maps
+    '''
     fstr = "{: <15}{: <15}"
     fstr2 = "{: <15}{: <15.3f}"
     with open(fname, "w") as outf:
@@ -1,9 +1,17 @@
 '''
     This module should contain a class that automates gromacs tool gmx msd
+    LateralMSD calculates the lateral MSD of all lipids without gromacs:
+        - xy positions of one reference atom per lipid are read frame-parallel into a float32 memory map
+        - the positions are unwrapped across periodic boundaries and the center of mass drift
+          of each leaflet is removed
+        - the MSD of each lipid is averaged over all time origins with FFT in O(T log T)
+        - optionally fourth moments (non-Gaussian parameter) and van Hove self-correlation functions
+          are accumulated per lipid type and leaflet on log-spaced lag times in the same pass
 '''
 import os
 import MDAnalysis as mda
 import numpy as np
+from scipy import fft
 
 from MDAnalysis.analysis.lineardensity import LinearDensity
 from MDAnalysis.analysis.waterdynamics import MeanSquareDisplacement as MSD
@@ -11,10 +19,221 @@ from MDAnalysis.analysis.waterdynamics import MeanSquareDisplacement as MSD
 from . import neighbors
 from .neighbors import Neighbors
 from .. import log
-from ..common import exec_gromacs, GMXNAME
+from ..common import exec_gromacs, GMXNAME, imap_to_pool, frame_ranges, cached_universe, truncate_npy
 from ..systeminfo import SysInfo
 from ..definitions import lipidmolecules
 
+LOGGER = log.LOGGER
+
+def residue_segments(atoms, by_residue=True):
+    ''' Index to reduce atoms to one lateral position per segment with np.add.reduceat
+        Segments are the residues of atoms (center of mass) or, if not by_residue, the single atoms.
+        Returns atom indices, start of each segment, atom masses and resid of each segment
+    '''
+    atoms = atoms[np.argsort(atoms.indices, kind="stable")]
+    if by_residue:
+        starts = np.flatnonzero(np.concatenate([[True], np.diff(atoms.resindices) != 0]))
+    else:
+        starts = np.arange(len(atoms))
+    return atoms.indices, starts, atoms.masses, atoms.resids[starts]
+
+def _lateral_positions_of_frames(gropath, trjpath, frames, indices, starts, masses, timefilter):
+    ''' xy centers of mass of segments (see residue_segments) in frames (start, stop) of trajectory
+        Atoms are shifted to the periodic image closest to the first atom of their segment before the reduction.
+        Defined on module level to be picklable for parallelization.
+        Returns times, positions (frame, segment, 2) in nm and boxes (frame, 2) in nm
+    '''
+    universe = cached_universe(gropath, trjpath)
+    t_start, t_end = timefilter
+    nframes = frames[1] - frames[0]
+    times, boxes = np.empty(nframes), np.empty((nframes, 2))
+    positions = np.empty((nframes, len(starts), 2), dtype=np.float32)
+    segment_of_atom = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(indices))))
+    segment_masses = np.add.reduceat(masses, starts)
+    segment_masses[segment_masses == 0] = 1
+    count = 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time < t_start or ts.time > t_end:
+            continue
+        box = ts.dimensions[:2]
+        xy = ts.positions[indices, :2].astype(float)
+        first = xy[starts]
+        shift = xy - first[segment_of_atom]
+        shift -= box * np.round(shift / box)
+        com = first + np.add.reduceat(masses[:, None] * shift, starts) / segment_masses[:, None]
+        times[count], boxes[count] = ts.time, box / 10
+        positions[count] = com / 10
+        count += 1
+    return times[:count], positions[:count], boxes[:count]
+
+def unwrap_lateral(positions, boxes, chunksize=1000):
+    ''' Unwraps positions (frame, particle, 2) in place, jumps between frames larger than
+        half of the box (boxes (frame, 2)) are treated as crossings of the periodic boundary.
+        Positions are processed in chunks of frames so that memory maps are never loaded completely.
+    '''
+    nframes = len(positions)
+    if not nframes:
+        return positions
+    prev_wrapped = np.asarray(positions[0], dtype=float)
+    prev_unwrapped = prev_wrapped.copy()
+    for start in range(1, nframes, chunksize):
+        wrapped = np.asarray(positions[start:start+chunksize], dtype=float)
+        steps = np.diff(np.concatenate([prev_wrapped[None], wrapped]), axis=0)
+        box = np.asarray(boxes[start:start+chunksize], dtype=float)[:, None, :]
+        steps -= box * np.round(steps / box)
+        unwrapped = prev_unwrapped + np.cumsum(steps, axis=0)
+        positions[start:start+chunksize] = unwrapped
+        prev_wrapped, prev_unwrapped = wrapped[-1], unwrapped[-1]
+    return positions
+
+def remove_leaflet_drift(positions, leaflets, weights=None, chunksize=1000):
+    ''' Subtracts the displacement of the center of mass of each leaflet from
+        unwrapped positions (frame, particle, 2) in place
+        weights are the masses of the particles, if None all particles are weighted equally
+    '''
+    leaflets = np.asarray(leaflets)
+    weights = np.ones(len(leaflets)) if weights is None else np.asarray(weights, dtype=float)
+    reference = {}
+    for start in range(0, len(positions), chunksize):
+        chunk = np.asarray(positions[start:start+chunksize], dtype=float)
+        for leaflet in np.unique(leaflets):
+            inleaflet = leaflets == leaflet
+            com = np.average(chunk[:, inleaflet], axis=1, weights=weights[inleaflet])
+            if leaflet not in reference:
+                reference[leaflet] = com[0]
+            chunk[:, inleaflet] -= (com - reference[leaflet])[:, None, :]
+        positions[start:start+chunksize] = chunk
+    return positions
+
+def log_lags(nframes, nlags=32):
+    ''' At most nlags unique log-spaced lags (in frames) between 1 and nframes-1 '''
+    if nframes < 2:
+        return np.zeros(0, dtype=int)
+    return np.unique(np.geomspace(1, nframes-1, nlags).astype(int))
+
+class DisplacementAccumulator:
+    ''' Moments and histograms of the length of lateral displacements per group of particles and lag
+        Only the log-spaced lags of log_lags are evaluated so memory is (group, lag, bin) independent of
+        the trajectory length. All time origins are used for each lag.
+        The histogram has nbins bins up to rmax (nm), longer displacements are counted in an extra last bin.
+    '''
+    def __init__(self, groups, nframes, nlags=32, rmax=5.0, nbins=100):
+        self.groups = np.asarray(groups, dtype=int)
+        self.ngroups = self.groups.max() + 1 if len(self.groups) else 0
+        self.lags = log_lags(nframes, nlags)
+        self.edges = np.linspace(0, rmax, nbins+1)
+        self.count = np.zeros((self.ngroups, len(self.lags)))
+        self.sum2 = np.zeros((self.ngroups, len(self.lags)))
+        self.sum4 = np.zeros((self.ngroups, len(self.lags)))
+        self.hist = np.zeros((self.ngroups, len(self.lags), nbins+1), dtype=np.int64)
+
+    @property
+    def nbins(self):
+        return len(self.edges) - 1
+
+    def add(self, batch, start=0):
+        ''' Adds displacements of batch (particle, frame, dim) of particles start to start+len(batch) '''
+        groups = self.groups[start:start+len(batch)]
+        binwidth = self.edges[1] - self.edges[0]
+        for i, lag in enumerate(self.lags):
+            squared = ((batch[:, lag:] - batch[:, :-lag])**2).sum(axis=2)
+            self.count[:, i] += np.bincount(groups, minlength=self.ngroups) * squared.shape[1]
+            self.sum2[:, i] += np.bincount(groups, weights=squared.sum(axis=1), minlength=self.ngroups)
+            self.sum4[:, i] += np.bincount(groups, weights=(squared**2).sum(axis=1), minlength=self.ngroups)
+            binndx = np.minimum((np.sqrt(squared) / binwidth).astype(int), self.nbins)
+            self.hist[:, i] += np.bincount((groups[:, None] * (self.nbins+1) + binndx).ravel(),
+                minlength=self.ngroups*(self.nbins+1)).reshape(self.ngroups, self.nbins+1)
+
+    def msd(self):
+        ''' MSD (group, lag) '''
+        return self.sum2 / np.maximum(self.count, 1)
+
+    def non_gaussian(self):
+        ''' Non-Gaussian parameter (group, lag) of the 2D displacements alpha2 = <r^4> / (2 <r^2>^2) - 1 '''
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum4 / np.maximum(self.count, 1) / (2 * self.msd()**2) - 1
+
+    def van_hove(self):
+        ''' Self part of the van Hove correlation function G_s(r, t) (group, lag, bin) at the bin centers,
+            normalized such that the integral over the plane is 1 (displacements beyond rmax are missing)
+        '''
+        ringarea = np.pi * (self.edges[1:]**2 - self.edges[:-1]**2)
+        return self.hist[..., :self.nbins] / np.maximum(self.count, 1)[..., None] / ringarea
+
+def msd_fft(positions, batchsize=256, out=None, accumulator=None):
+    ''' MSD of each particle averaged over all time origins for all lag times
+        positions is an (unwrapped) array (frame, particle, dim), it is read in batches of batchsize particles
+        MSD(m) = S1(m) - 2 S2(m) where S1 is obtained from cumulative sums of squared positions
+        and S2 is the position autocorrelation calculated with FFT.
+        If a DisplacementAccumulator is given each batch is added to it.
+        Returns array (particle, lag), out can be a (memory mapped) array of that shape.
+    '''
+    nframes, nparticles = positions.shape[:2]
+    if out is None:
+        out = np.empty((nparticles, nframes), dtype=np.float32)
+    nfft = fft.next_fast_len(2 * nframes)
+    lags = np.arange(nframes)
+    counts = (nframes - lags).astype(float)
+    for start in range(0, nparticles, batchsize):
+        batch = np.asarray(positions[:, start:start+batchsize], dtype=float).transpose(1, 0, 2)
+        squared = (batch**2).sum(axis=2)
+        cumulative = np.concatenate([np.zeros((len(batch), 1)), np.cumsum(squared, axis=1)], axis=1)
+        # sum_{k=0}^{T-m-1} (r^2(k) + r^2(k+m))
+        sum1 = cumulative[:, nframes-lags] + cumulative[:, nframes:] - cumulative[:, lags]
+        spectrum = fft.rfft(batch, n=nfft, axis=1)
+        sum2 = fft.irfft((spectrum * spectrum.conj()).real.sum(axis=2), n=nfft, axis=1)[:, :nframes]
+        msd = (sum1 - 2 * sum2) / counts
+        msd[:, 0] = 0
+        out[start:start+batchsize] = msd
+        if accumulator is not None:
+            accumulator.add(batch, start)
+    return out
+
+def lateral_positions(sysinfo, atoms, by_residue=False, leaflets=None, memmapfile=None, parallel=True):
+    ''' Unwrapped lateral positions of the atoms or (by_residue) of the residue centers of mass of atoms
+        for all frames between sysinfo.t_start and sysinfo.t_end
+        If leaflets of the segments are given the center of mass drift of each leaflet is removed.
+        If memmapfile is given the positions are stored there as float32 .npy file.
+        Returns times, resids, masses of the segments and positions (frame, segment, 2) in nm
+    '''
+    indices, starts, masses, resids = residue_segments(atoms, by_residue)
+    u = sysinfo.universe
+    len_traj = len(u.trajectory)
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, indices, starts, masses, (sysinfo.t_start, sysinfo.t_end))
+        for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Reading lateral positions of %s %s in %s frames", len(starts),
+        "residues" if by_residue else "atoms", len_traj)
+    if parallel:
+        output = imap_to_pool(_lateral_positions_of_frames, inpargs)
+    else:
+        output = (_lateral_positions_of_frames(*inp) for inp in inpargs)
+    if memmapfile is None:
+        positions = np.empty((len_traj, len(starts), 2), dtype=np.float32)
+    else:
+        positions = np.lib.format.open_memmap(memmapfile, mode="w+", dtype=np.float32, shape=(len_traj, len(starts), 2))
+    boxes = np.empty((len_traj, 2))
+    times = []
+    for frametimes, framepositions, frameboxes in output:
+        positions[len(times):len(times)+len(frametimes)] = framepositions
+        boxes[len(times):len(times)+len(frametimes)] = frameboxes
+        times += list(frametimes)
+    if memmapfile is not None:
+        positions.flush()
+        del positions
+        truncate_npy(memmapfile, len(times))
+        positions = np.load(memmapfile, mmap_mode="r+")
+    else:
+        positions = positions[:len(times)]
+    times = np.array(times)
+    if len(times) > 2 and not np.allclose(np.diff(times), times[1] - times[0]):
+        LOGGER.warning("Frames are not equally spaced in time, lag times of the MSD are not exact")
+    unwrap_lateral(positions, boxes[:len(times)])
+    segment_masses = np.add.reduceat(masses, starts)
+    if leaflets is not None:
+        remove_leaflet_drift(positions, leaflets, segment_masses)
+    return times, resids, segment_masses, positions
+
 class MSDanalysis(SysInfo):
 
     def __init__(self,inputfilename="inputfile"):
@@ -266,3 +485,134 @@ class MSDanalysisDirect(SysInfo):
                 print(mean_squared_displacement)
 
                 fout.write('{}\t{}\n'.format(u.trajectory.time - t0,mean_squared_displacement))
+
+
+class LateralMSD(SysInfo):
+    ''' Lateral MSD of all lipids, reference is either
+            atom -- one reference atom per lipid (lipidmolecules.central_atom_of)
+            com  -- center of mass of each lipid
+        The leaflets of lipids are taken from the leaflet assignment of SysInfo.
+        If memmapfile is given the positions are stored there as float32 .npy file,
+        the MSD of each lipid is stored in <memmapfile>_msd.npy.
+    '''
+
+    def __init__(self, inputfilename="inputfile", memmapfile=None, reference="atom"):
+        super().__init__(inputfilename)
+        if reference not in ("atom", "com"):
+            raise ValueError("reference must be atom or com")
+        self.memmapfile = memmapfile
+        self.reference = reference
+        self.times = None
+        self.resids = None
+        self.positions = None
+
+    def _allocate(self, shape, filename=None):
+        if filename is None:
+            return np.empty(shape, dtype=np.float32)
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=shape)
+
+    def reference_atoms(self):
+        ''' Atoms of the reference of all lipids that have a leaflet assigned '''
+        if self.reference == "com":
+            selstr = "resname {}".format(' '.join(self.molecules))
+        else:
+            selstr = ' or '.join(["(resname {} and name {})".format(lipid, lipidmolecules.central_atom_of(lipid))
+                for lipid in self.molecules])
+        refatoms = self.universe.select_atoms(selstr)
+        return refatoms[np.isin(refatoms.resids, list(self.res_to_leaflet))]
+
+    def build_positions(self, remove_drift=True, parallel=True):
+        ''' Reads xy positions of the reference of all lipids of all frames, unwraps them
+            and (if remove_drift) removes the center of mass motion of each leaflet
+        '''
+        refatoms = self.reference_atoms()
+        by_residue = self.reference == "com"
+        leaflets = None
+        if remove_drift:
+            leaflets = self.res_to_leaflet.leaflets_of(residue_segments(refatoms, by_residue)[3])
+        self.times, self.resids, _, self.positions = lateral_positions(self, refatoms,
+            by_residue=by_residue, leaflets=leaflets, memmapfile=self.memmapfile, parallel=parallel)
+        return self.positions
+
+    def lipid_msd(self, batchsize=256, accumulator=None):
+        ''' MSD (lipid, lag) in nm^2 of each lipid averaged over all time origins
+            If a DisplacementAccumulator is given the displacements are added to it in the same pass
+        '''
+        if self.positions is None:
+            raise ValueError("Positions are missing, run build_positions first")
+        msdfile = None if self.memmapfile is None else os.path.splitext(self.memmapfile)[0]+"_msd.npy"
+        out = self._allocate((self.positions.shape[1], self.positions.shape[0]), msdfile)
+        return msd_fft(self.positions, batchsize=batchsize, out=out, accumulator=accumulator)
+
+    def type_groups(self):
+        ''' Keys (type, leaflet) and index of the key of each lipid '''
+        types = np.array([self.resid_to_lipid[res] for res in self.resids])
+        leaflets = self.res_to_leaflet.leaflets_of(self.resids)
+        keys = sorted(set(zip(types.tolist(), leaflets.tolist())))
+        key_index = {key:i for i, key in enumerate(keys)}
+        return keys, np.array([key_index[key] for key in zip(types.tolist(), leaflets.tolist())], dtype=int)
+
+    def type_msd(self, msd=None):
+        ''' Average MSD of the lipids per lipid type and leaflet
+            Returns dict (type, leaflet) -> (number of lipids, msd)
+        '''
+        if msd is None:
+            msd = self.lipid_msd()
+        keys, groups = self.type_groups()
+        return {key:(np.count_nonzero(groups == i), np.mean(msd[groups == i], axis=0)) for i, key in enumerate(keys)}
+
+    def displacement_accumulator(self, nlags=32, rmax=5.0, nbins=100):
+        ''' DisplacementAccumulator for the lipid types and leaflets of type_groups '''
+        if self.positions is None:
+            raise ValueError("Positions are missing, run build_positions first")
+        return DisplacementAccumulator(self.type_groups()[1], len(self.times), nlags=nlags, rmax=rmax, nbins=nbins)
+
+    def write_displacements(self, accumulator, outputprefix="displacement"):
+        ''' Writes
+                <outputprefix>_alpha2.dat:  MSD and non-Gaussian parameter per lipid type and leaflet
+                <outputprefix>_vanhove.dat: G_s(r, t) per lipid type and leaflet
+        '''
+        keys = self.type_groups()[0]
+        lags = self.times[accumulator.lags] - self.times[0]
+        msd, alpha2, gs = accumulator.msd(), accumulator.non_gaussian(), accumulator.van_hove()
+        centers = (accumulator.edges[1:] + accumulator.edges[:-1]) / 2
+        with open(outputprefix+"_alpha2.dat", "w") as alphafile:
+            print("{: <12}{: <10}{: <10}{: <15}{: <15}".format("Lag", "Type", "leaflet", "MSD", "alpha2"), file=alphafile)
+            for i, (lipid, leaflet) in enumerate(keys):
+                for j, lag in enumerate(lags):
+                    print("{: <12.2f}{: <10}{: <10}{: <15.8}{: <15.8}".format(lag, lipid, leaflet, msd[i, j], alpha2[i, j]),
+                        file=alphafile)
+        with open(outputprefix+"_vanhove.dat", "w") as vhfile:
+            print("{: <12}{: <10}{: <10}{: <10}{: <15}".format("Lag", "Type", "leaflet", "r", "Gs"), file=vhfile)
+            for i, (lipid, leaflet) in enumerate(keys):
+                for j, lag in enumerate(lags):
+                    for r, value in zip(centers, gs[i, j]):
+                        print("{: <12.2f}{: <10}{: <10}{: <10.4f}{: <15.8}".format(lag, lipid, leaflet, r, value), file=vhfile)
+
+    def write_msd(self, outputfilename="msd_lateral.dat", batchsize=256, msd=None, displacementprefix=None, **kw_disp):
+        ''' Writes MSD over lag time per lipid type and leaflet to outputfilename
+            msd of each lipid (see lipid_msd) is calculated if not given
+            If displacementprefix is given the non-Gaussian parameter and van Hove functions are accumulated
+            in the same pass (kw_disp are passed to displacement_accumulator) and written with write_displacements
+        '''
+        if self.positions is None:
+            self.build_positions()
+        if displacementprefix is not None:
+            accumulator = self.displacement_accumulator(**kw_disp)
+            if msd is None:
+                msd = self.lipid_msd(batchsize=batchsize, accumulator=accumulator)
+            else:
+                for start in range(0, self.positions.shape[1], batchsize):
+                    accumulator.add(np.asarray(self.positions[:, start:start+batchsize], dtype=float).transpose(1, 0, 2), start)
+            self.write_displacements(accumulator, displacementprefix)
+        if msd is None:
+            msd = self.lipid_msd(batchsize=batchsize)
+        type_msd = self.type_msd(msd)
+        lags = self.times - self.times[0]
+        with open(outputfilename, "w") as msdfile:
+            print("{: <12}{: <10}{: <10}{: <10}{: <15}".format("Lag", "Type", "leaflet", "nlipids", "MSD"), file=msdfile)
+            for (lipid, leaflet), (nlipids, values) in sorted(type_msd.items()):
+                for lag, value in zip(lags, values):
+                    print("{: <12.2f}{: <10}{: <10}{: <10}{: <15.8}".format(lag, lipid, leaflet, nlipids, value),
+                        file=msdfile)
+        return type_msd
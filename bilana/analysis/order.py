@@ -5,15 +5,16 @@
 
 '''
 import os
+import re
 import numpy as np
 import pandas as pd
-import multiprocessing as mp
 import MDAnalysis as mda
+from scipy import sparse
 
 from . import neighbors
 from .neighbors import Neighbors
 from .. import log
-from ..common import loop_to_pool
+from ..common import loop_to_pool, imap_to_pool, frame_ranges, cached_universe, minimum_image, truncate_npy
 from ..definitions import lipidmolecules
 from ..definitions.structure_formats import REGEXP_GRO
 
@@ -28,392 +29,625 @@ class Order(Neighbors):
 
     def __init__(self, inputfilename="inputfile"):
         super().__init__(inputfilename)
-        self.atomlist = lipidmolecules.scd_tail_atoms_of
         self.components = self.molecules
         self.neiblist = neighbors.get_neighbor_dict()
         # Change dict entries from neiblist[host][time] to neiblist[time][host]
 
-    def create_orderfile(self, mode="CC", outputfile='scd_distribution.dat', with_tilt_correction="tilt.csv", parallel=True):
+    def create_orderfile(self, mode="CC", outputfile='scd_distribution.dat', with_tilt_correction="tilt.csv", write_tilt=True, include_neighbors="global",
+        summaryfile=None, write_distribution=True, profile_bins=None, dumpfile=None, parallel=True):
         '''
             Calculate order parameter S = 0.5 (3cos^2(a)-1) of lipids.
             a is the angle between the bilayer normal and (set with mode):
                 CC -- Vector between Cn-Cn+2 carbon atoms of chain. Averaged over all the angles
-
-            if with tilt_correction avg tilt angle per time is read from name given in variable
+                profile -- As CC, but S of every Cn-Cn+2 vector is written
+                CH -- C-H bonds of tail carbons (lipidmolecules.TAILHYDR). S of each carbon is averaged over its
+                      hydrogens, outputfile gets the average over all carbons of each lipid and the
+                      profile of each carbon is written to <outputfile>_CHprofile.dat
+
+            if with_tilt_correction is set, the average tilt vector of each leaflet (see calc_tilt) is calculated
+            for each frame in the same pass and used as axis. If also write_tilt is set, the tilt is written
+            to the file name given in with_tilt_correction.
+            include_neighbors sets the axis used for the tilt correction:
+                global -- Average tail vector of the leaflet
+                local  -- Average tail vector of the lipid and its neighbors (same leaflet) in the frame
+            In mode CC and CH the values can be summarized per lipid type, leaflet and neighbor composition
+            while calculating (see ScdAggregator), the summary is written to summaryfile and its histograms
+            to <summaryfile>_hist.dat. With write_distribution=False outputfile (one line per lipid and frame)
+            is not written.
+            In mode profile S per lipid type, leaflet, chain and carbon (see ProfileAggregator) is written to
+            summaryfile (outputfile if not given), with profile_bins histograms of each carbon are written
+            to <summaryfile>_hist.dat. write_distribution has no effect, use dumpfile to keep the values of
+            every frame.
+            If dumpfile is given, all values of all frames are stored there as float32 .npy array
+            (frame, residue[, chain, carbon]), the times in <dumpfile>_times.npy.
+            Bond vectors are corrected for periodic boundaries, so the raw trajectory can be used.
         '''
         if not self.trjpath_whole:
-            LOGGER.error("Is input trajectory in mda.universe made whole? If not, this may result in spurious results")
-            raise FileNotFoundError("No whole trajectory found")
+            LOGGER.info("No whole trajectory found, bond vectors are corrected with the minimum image convention")
 
-        def catch_callback(result):
-            ''' Catches callback value of pool.apply_async workers and puts into outputlist'''
-            outputlist.append(result)
         neiblist_t = pd.DataFrame(self.neiblist).transpose().to_dict()
-        outputlist = [] # Don't change this name as function catch_callback uses it!
-
-        if parallel:
-            pool = mp.Pool(len(os.sched_getaffinity(0)), maxtasksperchild=1)
 
-        # If tilt correction is activated read file with tilt information or create it
+        # If tilt correction is activated the workers calculate the tilt of each frame
+        tiltinfo = None
         if with_tilt_correction:
-            try:
-                dat = pd.read_csv(with_tilt_correction)
-            except FileNotFoundError:
-                LOGGER.info("Could not find tilt file. Creating new one.")
-                calc_tilt(self)
-                dat = pd.read_csv(with_tilt_correction)
+            tiltinfo = tilt_index(self.universe.atoms, self.MOLRANGE, self.resid_to_lipid, self.res_to_leaflet)
+        if include_neighbors not in ("global", "local"):
+            raise ValueError("include_neighbors must be global or local")
+        if include_neighbors == "local" and not with_tilt_correction:
+            raise ValueError("Local tilt correction requires with_tilt_correction")
 
         # Define how the order parameter has to be calculated
-        if mode == "CC":
-            calc_s = self.scc_of_res
-        elif mode == "profile":
-            calc_s = self.get_order_profile
-        else:
+        if mode not in ("CC", "profile", "CH"):
             raise ValueError("Mode not yet implement use mode=CC (default)")
 
-        ## Gather all input data for _calc_scd_output function
-        LOGGER.info("Start adding tasks")
+        # Atom indices of all bonds are looked up once for the whole trajectory
+        if mode == "CH":
+            bondinfo = ch_bond_index(self.universe.atoms, self.MOLRANGE, self.resid_to_lipid)
+        else:
+            bondinfo = scd_bond_index(self.universe.atoms, self.MOLRANGE, self.resid_to_lipid)
+        resids, resnames, _, bond_mask = bondinfo[:4]
+        leaflets = np.array([self.res_to_leaflet[res] for res in resids])
+        if include_neighbors == "local":
+            neighbor_times, adjacency = neighbor_matrix(neiblist_t, resids, leaflets)
+            tail_owner = tail_owner_matrix(tiltinfo[2], resids)
+
+        # Each task reads a range of frames itself
+        trajectory = self.trjpath_whole if self.trjpath_whole else self.trjpath
         len_traj = len(self.universe.trajectory)
-        for t in range(len_traj):
-
-            time = self.universe.trajectory[t].time
-            if time % self.dt != 0 or self.t_start > time or self.t_end < time:
-                continue
-
-            # Get tilt of leaflet for time
-            if with_tilt_correction:
-                new_axis = np.asarray(dat.loc[(dat.time == time)][["x", "y", "z"]]).copy()
-                LOGGER.debug("Corrected angle %s", new_axis)
-            else:
-                new_axis = None
-
-            if mode == 'CC':
-                # Collect input arguments in tuple
-                inptup = (calc_s, new_axis, self.MOLRANGE, self.universe.atoms, self.universe.atoms.positions,
-                    time, self.components, neiblist_t[time], self.res_to_leaflet, self.resid_to_lipid,)
-                if parallel:
-                    pool.apply_async(self._calc_scd_output, args=inptup, callback=catch_callback)
-                else:
-                    outputlist.append(self._calc_scd_output(*inptup))
-
-            elif mode == 'profile':
-                # Collect input arguments in tuple
-                inptup = (calc_s, new_axis, self.MOLRANGE, self.universe.atoms, self.universe.atoms.positions,
-                    time, self.res_to_leaflet, self.resid_to_lipid,)
-                if parallel:
-                    pool.apply_async(self._calc_scd_profile_output, args=inptup, callback=catch_callback)
-                else:
-                    outputlist.append(self._calc_scd_profile_output(*inptup))
-
+        ncores = len(os.sched_getaffinity(0)) if parallel else 1
+        inpargs = []
+        for frames in frame_ranges(len_traj, 4*ncores):
+            localinfo = None
+            if include_neighbors == "local":
+                # Only the neighbor matrices of the frames of the task are passed
+                first = np.searchsorted(neighbor_times, self.universe.trajectory[frames[0]].time)
+                last = np.searchsorted(neighbor_times, self.universe.trajectory[frames[1]-1].time, side="right")
+                localinfo = (tail_owner, neighbor_times[first:last],
+                    adjacency[first*len(resids):last*len(resids)])
+            inpargs.append( (mode, self.gropath, trajectory, frames, bondinfo, leaflets,
+                (self.dt, self.t_start, self.t_end), tiltinfo, localinfo) )
+        LOGGER.info("Calculating order of %s frames in %s tasks", len_traj, len(inpargs))
         if parallel:
-            # finalize pool
-            pool.close()
-            pool.join()
-
-
-        ## Sort output and write to file
-        LOGGER.info("Writing to file ...")
-        outputlist = [i for l in outputlist for i in l]
-        outputlist = sorted(outputlist, key=lambda tup: tup[:2])
-        if mode == "CC":
-            with open(outputfile, "w") as scdfile:
-                print("{: <12}{: <10}{: <10}{: <7}{: <15}".format("Time", "Residue", "leaflet", "Type", "Scd")\
-                    + (len(self.components)*'{: ^7}').format(*self.components),
-                    file=scdfile)
-                for line in outputlist:
-                    line = "{: <12.2f}{: <10}{: <10}{: <7}{: <15.8}".format(*line[:5]) + (len(self.components)*"{: ^7}").format(*line[5:])
-                    print(line, file=scdfile)
+            output = imap_to_pool(_scd_of_frames, inpargs)
+        else:
+            output = (_scd_of_frames(*inp) for inp in inpargs)
+        if with_tilt_correction and write_tilt:
+            output = self._write_tilt(output, with_tilt_correction)
+        else:
+            output = ((times, values) for times, values, _ in output)
+        if dumpfile:
+            output = self._dump(output, dumpfile, len_traj, bond_mask.shape[:1] if mode == "CC" else bond_mask.shape[:3])
+
+        ## Write results to file as they arrive, tasks are ordered by time
+        if mode == "CH":
+            profile = ProfileAggregator(resnames, leaflets, bondinfo[4], bond_mask.any(axis=-1), name="SCH")
+            output = self._aggregate_profile(output, profile, os.path.splitext(outputfile)[0]+"_CHprofile.dat")
+        if mode in ("CC", "CH"):
+            if summaryfile or write_distribution:
+                output = self._add_compositions(output, resids, neiblist_t)
+            if summaryfile:
+                aggregator = ScdAggregator(self.components)
+                output = self._aggregate(output, aggregator, resnames, leaflets)
+            if write_distribution:
+                self._write_distribution(output, outputfile, resids, resnames, leaflets)
+            else:
+                for _ in output:
+                    pass
+            if summaryfile:
+                aggregator.write(summaryfile, os.path.splitext(summaryfile)[0]+"_hist.dat")
         elif mode == "profile":
-            with open(outputfile, "w") as scdfile:
-                print("{: <12}{: <10}{: <10}{: <7}{: <15}{: <15}{: <10}{: <10}".format("Time", "Residue", "leaflet", "Type", "avgS", "S", "carbon", "chain" ), file=scdfile)
-                for line in outputlist:
-                    line = "{: <12.2f}{: <10}{: <10}{: <7}{: <15.8}{: <15.8}{: <10}{: <10}".format(*line)
-                    print(line, file=scdfile)
-
-
-
-    @staticmethod
-    def _calc_scd_output(s_fun, new_axis, molrange, all_atms, positions, time, components, neiblist, res_to_leaflet, resid_to_lipid):
-        outp = []
-        for res in molrange:
-            leaflet = res_to_leaflet[res]
-            neibs   = neiblist[res]
-            resname = resid_to_lipid[res]
-            if new_axis is not None:
-                new_axis_at_t = new_axis[leaflet]
-
-            LOGGER.debug("At time %s and residue %s", time, res)
-
-            # If resname is not known skip, this residue
-            if resname[:-2] not in lipidmolecules.TAIL_ATOMS_OF.keys()\
-                and resname not in lipidmolecules.STEROLS\
-                and resname not in lipidmolecules.PROTEINS:
-                LOGGER.debug("Skipping")
-                continue
-
-            tailatms = lipidmolecules.scd_tail_atoms_of(resname)
-            neib_comp_list = []
-            for lip in components:
-                ncomp = [resid_to_lipid[N] for N in neibs].count(lip)
-                neib_comp_list.append(ncomp)
-
-            scd_value = s_fun(res, tailatms, all_atms, positions, tilt_correction=new_axis_at_t)
-            LOGGER.debug("Calculated order: %s", scd_value)
-            outp.append( (time, res, leaflet, resname, scd_value, *neib_comp_list) )
-
-        LOGGER.info("finished with time %s", time)
-
-        return outp
+            # Per-frame values of each bond are only stored in dumpfile, the text output is the summary
+            summaryfile = summaryfile if summaryfile else outputfile
+            carbon_numbers = np.broadcast_to(np.arange(1, bond_mask.shape[2]+1), bond_mask.shape)
+            profile = ProfileAggregator(resnames, leaflets, carbon_numbers, bond_mask, name="S", nbins=profile_bins)
+            histfile = os.path.splitext(summaryfile)[0]+"_hist.dat" if profile_bins else None
+            for _ in self._aggregate_profile(output, profile, summaryfile, histfile=histfile, passvalues=True):
+                pass
+
+    def _add_compositions(self, output, resids, neiblist_t):
+        ''' Passes through (times, values) of output together with the neighbor composition
+            (see neighbor_composition) of each frame, so it is calculated only once per frame
+        '''
+        for times, scd_values in output:
+            compositions = [neighbor_composition(neiblist_t[time], resids, self.resid_to_lipid, self.components)
+                for time in times]
+            yield times, scd_values, compositions
+
+    def _write_distribution(self, output, outputfile, resids, resnames, leaflets):
+        ''' Writes one line per lipid and frame with its Scd and neighbor composition (output of _add_compositions) '''
+        with open(outputfile, "w") as scdfile:
+            print("{: <12}{: <10}{: <10}{: <7}{: <15}".format("Time", "Residue", "leaflet", "Type", "Scd")\
+                + (len(self.components)*'{: ^7}').format(*self.components),
+                file=scdfile)
+            for times, scd_values, frame_compositions in output:
+                for time, scd_of_res, compositions in zip(times, scd_values, frame_compositions):
+                    for res, leaflet, resname, scd_value, neib_comp_list in zip(resids, leaflets, resnames, scd_of_res, compositions):
+                        line = "{: <12.2f}{: <10}{: <10}{: <7}{: <15.8}".format(time, res, leaflet, resname, scd_value)\
+                            + (len(self.components)*"{: ^7}").format(*neib_comp_list)
+                        print(line, file=scdfile)
+
+    def _aggregate(self, output, aggregator, resnames, leaflets):
+        ''' Passes through (times, values, compositions) of _add_compositions while adding all values to aggregator '''
+        for times, scd_values, frame_compositions in output:
+            for scd_of_res, compositions in zip(scd_values, frame_compositions):
+                aggregator.add(resnames, leaflets, compositions, scd_of_res)
+            yield times, scd_values, frame_compositions
 
     @staticmethod
-    def _calc_scd_profile_output(s_fun, new_axis, molrange, all_atms, positions, time, res_to_leaflet, resid_to_lipid):
-        outp = []
-        for res in molrange:
-            leaflet = res_to_leaflet[res]
-            resname = resid_to_lipid[res]
-            if new_axis is not None:
-                new_axis_at_t = new_axis[leaflet]
-
-            LOGGER.debug("At time %s and residue %s", time, res)
-
-            # If resname is not known skip, this residue
-            if resname[:-2] not in lipidmolecules.TAIL_ATOMS_OF.keys()\
-                and resname not in lipidmolecules.STEROLS\
-                and resname not in lipidmolecules.PROTEINS:
-                LOGGER.debug("Skipping")
-                continue
-
-            tailatms = lipidmolecules.scd_tail_atoms_of(resname)
-
-            scds_per_tail, avg_scd = s_fun(res, tailatms, all_atms, positions, tilt_correction=new_axis_at_t)
-            LOGGER.debug("scds at tail with avg %s: %s", avg_scd, scds_per_tail)
-            for chain, scdvals in enumerate(scds_per_tail, start=1):
-                for ndx, scdval in enumerate(scdvals, start=1):
-                    outputtuple = (time, res, leaflet, resname, avg_scd, scdval, ndx, "sn"+str(chain) )
-                    outp.append(outputtuple)
-
-        LOGGER.info("finished with time %s", time)
-        return outp
+    def _write_tilt(output, filename):
+        ''' Passes through (times, values) of output of _scd_of_frames while collecting the tilt of each frame.
+            The tilt is written to filename after the last frame (same format as calc_tilt).
+        '''
+        alltimes, allaxes = [], []
+        for times, values, axes in output:
+            alltimes.append(times)
+            allaxes.append(axes.reshape(-1, 2, 3))
+            yield times, values
+        write_tiltfile(filename, np.concatenate(alltimes), np.concatenate(allaxes))
 
     @staticmethod
-    def get_order_profile(res, tailatms, all_atmnames, positions, tilt_correction=None):
-        ''' Calculate order parameter profiles for each chain '''
-
-        if tilt_correction is None:
-            tilt_correction = [0, 0, 1] # Use z-axis
-
-
-        scds_of_tails = []
-        for tailndx, tail in enumerate(tailatms):
-            scds_of_tails.append([])
-
-            for atomindex in range(len(tail)-1):
-
-                atm1, atm2 = tail[atomindex], tail[atomindex+1]
-                #coords12 = resinfo.atoms.select_atoms("name {} {}".format(atm1, atm2)).positions
-
-                mask1 =  ( all_atmnames.names == tail[ atomindex ], all_atmnames.resids == res )
-                mask2 =  ( all_atmnames.names == tail[ atomindex + 1 ], all_atmnames.resids == res )
-                atm1, atm2 = positions[ mask1[0] & mask1[1] ][0], positions[ mask2[0] & mask2[1] ][0]
-
-                diffvector = atm2 - atm1
-                diffvector /= np.linalg.norm(diffvector)
-                LOGGER.debug("Diffvector %s", diffvector)
-
-                cos_angle = np.dot(diffvector, tilt_correction)
-                LOGGER.debug("Resulting cos %s", cos_angle)
-                scds_of_tails[tailndx].append( 0.5 * ( ( 3 * (cos_angle**2)) - 1 )  )
-
-        LOGGER.debug("Scds of res %s: %s", res, scds_of_tails)
-
-        return scds_of_tails, np.array(scds_of_tails).mean()
+    def _aggregate_profile(output, profile, profilefile, histfile=None, passvalues=False):
+        ''' Passes through (times, values) of output of _scd_of_frames in mode CH or profile while adding the
+            values of each carbon to profile (a ProfileAggregator), which is written after the last frame.
+            In mode CH (passvalues=False) the average over carbons of each lipid is passed on.
+        '''
+        for times, scds in output:
+            if len(scds):
+                profile.add(scds)
+            if passvalues:
+                yield times, scds
+            else:
+                yield times, scd_cc(scds) if len(scds) else scds
+        profile.write(profilefile, histfile)
 
     @staticmethod
-    def scc_of_res(res, tailatms, all_atmnames, positions, tilt_correction=None):
-        ''' Calculate the order parameter  '''
-
-        if tilt_correction is None:
-            tilt_correction = [0, 0, 1] # Use z-axis
-
-
-        scds_of_tails = []
-        for tail in tailatms:
-
-            scds_of_atoms = []
-            for atomindex in range(len(tail)-1):
-
-                atm1, atm2 = tail[atomindex], tail[atomindex+1]
-
-                mask1 =  ( all_atmnames.names == tail[ atomindex ], all_atmnames.resids == res )
-                mask2 =  ( all_atmnames.names == tail[ atomindex + 1 ], all_atmnames.resids == res )
-                atm1, atm2 = positions[ mask1[0] & mask1[1] ][0], positions[ mask2[0] & mask2[1] ][0]
-
-                diffvector = atm2 - atm1
-                diffvector /= np.linalg.norm(diffvector)
-                LOGGER.debug("Diffvector %s", diffvector)
-
-                cos_angle = np.dot(diffvector, tilt_correction)
-                LOGGER.debug("Resulting cos %s", cos_angle)
-                scds_of_atoms.append( 0.5 * ( ( 3 * (cos_angle**2)) - 1 )  )
-
-            scds_of_tails.append( np.array(scds_of_atoms).mean() )
-        LOGGER.debug("Scds of res %s: %s", res, scds_of_tails)
-
-        return np.array(scds_of_tails).mean()
+    def _dump(output, dumpfile, len_traj, shape):
+        ''' Passes through (times, values) of output while storing values in the .npy memory map dumpfile '''
+        dump = np.lib.format.open_memmap(dumpfile, mode="w+", dtype=np.float32, shape=(len_traj,)+tuple(shape))
+        alltimes = []
+        for times, values in output:
+            if len(times):
+                dump[len(alltimes):len(alltimes)+len(times)] = values
+            alltimes += list(times)
+            yield times, values
+        dump.flush()
+        del dump
+        truncate_npy(dumpfile, len(alltimes))
+        np.save(os.path.splitext(dumpfile)[0]+"_times.npy", np.array(alltimes))
+
+def scd_bond_index(atoms, molrange, resid_to_lipid):
+    ''' Looks up atom indices of all bonds given by lipidmolecules.scd_tail_atoms_of
+        Returns
+            resids:     residues with known tail atoms
+            resnames:   their lipid types
+            bond_atoms: int array (residue, chain, bond, 2) with indices of both atoms of bond
+            bond_mask:  bool array (residue, chain, bond), False where entry is padding
+    '''
+    index_of = _atom_index_lookup(atoms)
+    resids, resnames, tails = [], [], []
+    for res in molrange:
+        resname = resid_to_lipid[res]
+        if resname[:-2] not in lipidmolecules.TAIL_ATOMS_OF.keys()\
+            and resname not in lipidmolecules.STEROLS\
+            and resname not in lipidmolecules.PROTEINS:
+            continue
+        resids.append(res)
+        resnames.append(resname)
+        tails.append([[index_of[(res, name)] for name in tail] for tail in lipidmolecules.scd_tail_atoms_of(resname)])
+    nchains = max([len(tail) for tail in tails], default=0)
+    nbonds = max([len(chain)-1 for tail in tails for chain in tail], default=0)
+    bond_atoms = np.zeros((len(tails), nchains, nbonds, 2), dtype=int)
+    bond_mask = np.zeros((len(tails), nchains, nbonds), dtype=bool)
+    for resndx, tail in enumerate(tails):
+        for chain, atomindices in enumerate(tail):
+            nbond = len(atomindices)-1
+            bond_atoms[resndx, chain, :nbond, 0] = atomindices[:-1]
+            bond_atoms[resndx, chain, :nbond, 1] = atomindices[1:]
+            bond_mask[resndx, chain, :nbond] = True
+    return np.array(resids), np.array(resnames), bond_atoms, bond_mask
+
+def _atom_index_lookup(atoms):
+    ''' Returns dict (resid, name) -> index, the first atom of a name in a residue is used '''
+    return dict(zip(zip(atoms.resids[::-1], atoms.names[::-1]), range(len(atoms)-1, -1, -1)))
+
+def carbon_of_hydrogen(hydrogen, carbons):
+    ''' Returns name of carbon in carbons that hydrogen is bound to, e.g. H5R -> C25 for carbons C22 ... C216
+        Hydrogen names are H<n><letter> (e.g. H5R, H16T), if that fails the last character is stripped (e.g. H91)
+        Returns None if carbon is not in carbons
+    '''
+    match = re.match(r'^H(\d+)[A-Z]$', hydrogen)
+    number = match.group(1) if match else hydrogen[1:-1]
+    carbon = carbons[0][:2] + number
+    return carbon if carbon in carbons else None
+
+def ch_layout_of(lipid):
+    ''' Returns list (chain) of list (carbon) of tuples (carbon number, carbon name, hydrogen names) '''
+    tail = lipid[:-2]
+    layout = []
+    for carbons, hydrogens in zip(lipidmolecules.TAILCARBS[tail], lipidmolecules.TAILHYDR[tail]):
+        hydrogens_of = {carbon:[] for carbon in carbons}
+        for hydrogen in hydrogens:
+            carbon = carbon_of_hydrogen(hydrogen, carbons)
+            if carbon is None:
+                LOGGER.debug("No carbon found for hydrogen %s of %s", hydrogen, lipid)
+                continue
+            hydrogens_of[carbon].append(hydrogen)
+        layout.append([(int(carbon[2:]), carbon, hydrogens_of[carbon]) for carbon in carbons if hydrogens_of[carbon]])
+    return layout
+
+def ch_bond_index(atoms, molrange, resid_to_lipid):
+    ''' Looks up atom indices of all C-H bonds of tail carbons
+        Returns like scd_bond_index but with arrays of shape (residue, chain, carbon, hydrogen(, 2))
+        and additionally carbon_numbers (residue, chain, carbon), the number of each carbon in its chain
+    '''
+    index_of = _atom_index_lookup(atoms)
+    layouts = {}
+    resids, resnames = [], []
+    for res in molrange:
+        resname = resid_to_lipid[res]
+        if resname[:-2] not in lipidmolecules.TAILHYDR.keys() or resname in lipidmolecules.STEROLS+lipidmolecules.PROTEINS:
+            continue
+        if resname not in layouts:
+            layouts[resname] = ch_layout_of(resname)
+        resids.append(res)
+        resnames.append(resname)
+    nchains = max([len(layout) for layout in layouts.values()], default=0)
+    ncarbons = max([len(chain) for layout in layouts.values() for chain in layout], default=0)
+    nhydrogens = max([len(carbon[2]) for layout in layouts.values() for chain in layout for carbon in chain], default=0)
+    bond_atoms = np.zeros((len(resids), nchains, ncarbons, nhydrogens, 2), dtype=int)
+    bond_mask = np.zeros((len(resids), nchains, ncarbons, nhydrogens), dtype=bool)
+    carbon_numbers = np.zeros((len(resids), nchains, ncarbons), dtype=int)
+    for resndx, (res, resname) in enumerate(zip(resids, resnames)):
+        for chain, carbons in enumerate(layouts[resname]):
+            for carbonndx, (number, carbon, hydrogens) in enumerate(carbons):
+                nhyd = len(hydrogens)
+                bond_atoms[resndx, chain, carbonndx, :nhyd, 0] = index_of[(res, carbon)]
+                bond_atoms[resndx, chain, carbonndx, :nhyd, 1] = [index_of[(res, hyd)] for hyd in hydrogens]
+                bond_mask[resndx, chain, carbonndx, :nhyd] = True
+                carbon_numbers[resndx, chain, carbonndx] = number
+    return np.array(resids), np.array(resnames), bond_atoms, bond_mask, carbon_numbers
+
+def sch_of_carbons(scds):
+    ''' Averages output of scd_of_bonds for C-H bonds over the hydrogens of each carbon
+        Returns array (residue, chain, carbon), nan for padding
+    '''
+    valid = ~np.isnan(scds)
+    nhydrogens = valid.sum(axis=-1)
+    with np.errstate(invalid="ignore"):
+        return np.where(valid, scds, 0).sum(axis=-1) / np.where(nhydrogens > 0, nhydrogens, np.nan)
+
+def leaflet_axes(new_axis, leaflets):
+    ''' Reference axis per residue: new_axis[leaflet] or z axis if new_axis is None '''
+    if new_axis is None:
+        return np.tile([0., 0., 1.], (len(leaflets), 1))
+    return np.asarray(new_axis, dtype=float)[leaflets]
+
+def scd_of_bonds(positions, bond_atoms, bond_mask, axes, box=None):
+    ''' S = 0.5 (3cos^2(a)-1) of all bonds at once, a is the angle of bond to axes (one per residue)
+        If box is given, bonds that are split by periodic boundaries are corrected
+        Returns array (residue, chain, bond), padding entries are nan
+    '''
+    bondvectors = minimum_image(positions[bond_atoms[..., 1]] - positions[bond_atoms[..., 0]], box)
+    # Same summation as np.linalg.norm of a single vector
+    norms = np.sqrt(np.matmul(bondvectors[..., None, :], bondvectors[..., :, None]))[..., 0]
+    bondvectors = np.divide(bondvectors, norms, out=np.zeros_like(bondvectors), where=bond_mask[..., None])
+    cos_angle = np.einsum('r...k,rk->r...', bondvectors, axes)
+    scds = 0.5 * ( ( 3 * (cos_angle**2)) - 1 )
+    scds[~bond_mask] = np.nan
+    return scds
+
+def scd_cc(scds):
+    ''' Mean over chains of the mean over bonds of each chain for output of scd_of_bonds (last two axes) '''
+    valid = ~np.isnan(scds)
+    nbonds = valid.sum(axis=-1)
+    chain_means = np.where(valid, scds, 0).sum(axis=-1) / np.maximum(nbonds, 1)
+    return (chain_means * (nbonds > 0)).sum(axis=-1) / (nbonds > 0).sum(axis=-1)
+
+class ScdAggregator:
+    ''' Running moments and histograms of order parameters per (lipid type, leaflet, neighbor composition)
+        Values are added frame by frame with add, nothing per lipid is kept in memory.
+        The histogram has nbins fixed bins in scdrange, values outside are counted in the first/last bin.
+    '''
+    def __init__(self, components, nbins=150, scdrange=(-0.5, 1.0)):
+        self.components = list(components)
+        self.edges = np.linspace(*scdrange, nbins+1)
+        self.keys = []
+        self.key_index = {}
+        self.count = np.zeros(0)
+        self.sums = np.zeros(0)
+        self.sqsums = np.zeros(0)
+        self.hist = np.zeros((0, nbins), dtype=np.int64)
+
+    @property
+    def nbins(self):
+        return len(self.edges) - 1
+
+    def _key_indices(self, resnames, leaflets, compositions):
+        ''' Index of key of each lipid, new keys are appended '''
+        types = np.array([self.components.index(resname) for resname in resnames])
+        rows = np.column_stack([types, leaflets, compositions]).astype(int)
+        unique_rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+        indices = []
+        for row in map(tuple, unique_rows):
+            if row not in self.key_index:
+                self.key_index[row] = len(self.keys)
+                self.keys.append(row)
+            indices.append(self.key_index[row])
+        nkeys = len(self.keys)
+        if nkeys > len(self.count):
+            grow = nkeys - len(self.count)
+            self.count = np.append(self.count, np.zeros(grow))
+            self.sums = np.append(self.sums, np.zeros(grow))
+            self.sqsums = np.append(self.sqsums, np.zeros(grow))
+            self.hist = np.vstack([self.hist, np.zeros((grow, self.nbins), dtype=np.int64)])
+        return np.array(indices)[inverse.ravel()]
+
+    def add(self, resnames, leaflets, compositions, values):
+        ''' Adds values (lipid) of one frame, compositions is (lipid, component) array of neighbor counts '''
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        keyndx = self._key_indices(resnames, leaflets, compositions)[valid]
+        values = values[valid]
+        nkeys = len(self.keys)
+        self.count += np.bincount(keyndx, minlength=nkeys)
+        self.sums += np.bincount(keyndx, weights=values, minlength=nkeys)
+        self.sqsums += np.bincount(keyndx, weights=values**2, minlength=nkeys)
+        binndx = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, self.nbins-1)
+        self.hist += np.bincount(keyndx*self.nbins + binndx, minlength=nkeys*self.nbins).reshape(nkeys, self.nbins)
+
+    def summary(self):
+        ''' DataFrame with count, mean, variance and standard error of each key '''
+        keys = np.array(self.keys, dtype=int).reshape(-1, 2+len(self.components))
+        mean = self.sums / np.maximum(self.count, 1)
+        var = np.maximum(self.sqsums / np.maximum(self.count, 1) - mean**2, 0)
+        dat = pd.DataFrame({"Type":[self.components[i] for i in keys[:, 0]], "leaflet":keys[:, 1]})
+        for i, lip in enumerate(self.components):
+            dat[lip] = keys[:, 2+i]
+        dat["count"] = self.count.astype(int)
+        dat["mean"] = mean
+        dat["var"] = var
+        dat["sem"] = np.sqrt(var / np.maximum(self.count, 1))
+        return dat.sort_values(["Type", "leaflet"] + self.components).reset_index(drop=True)
+
+    def write(self, summaryfile, histfile=None):
+        ''' Writes summary and (if histfile is given) all non empty histogram bins '''
+        self.summary().to_csv(summaryfile, sep=' ', index=False, float_format="%.8f")
+        if histfile is None:
+            return
+        keyndx, binndx = np.nonzero(self.hist)
+        keys = np.array(self.keys, dtype=int).reshape(-1, 2+len(self.components))[keyndx]
+        centers = 0.5 * (self.edges[:-1] + self.edges[1:])
+        dat = pd.DataFrame({"Type":[self.components[i] for i in keys[:, 0]], "leaflet":keys[:, 1]})
+        for i, lip in enumerate(self.components):
+            dat[lip] = keys[:, 2+i]
+        dat["Scd"] = centers[binndx]
+        dat["count"] = self.hist[keyndx, binndx]
+        dat.sort_values(["Type", "leaflet"] + self.components + ["Scd"]).to_csv(histfile, sep=' ', index=False, float_format="%.5f")
+
+class ProfileAggregator:
+    ''' Running sums, sums of squares and (optional with nbins) histograms of order parameters per
+        (lipid type, leaflet, chain, carbon)
+        resnames, leaflets: of each residue of the values that are added
+        carbon_numbers:     (residue, chain, carbon) number of each carbon in its chain
+        mask:               (residue, chain, carbon) False where the entry is padding
+    '''
+    def __init__(self, resnames, leaflets, carbon_numbers, mask, name="S", nbins=None, scdrange=(-0.5, 1.0)):
+        self.keys = sorted(set(zip(resnames, leaflets)))
+        self.key_of_res = np.array([self.keys.index(key) for key in zip(resnames, leaflets)], dtype=int)
+        self.carbon_numbers = carbon_numbers
+        self.mask = mask
+        self.name = name
+        self.shape = (len(self.keys),) + mask.shape[1:]
+        ncells = mask.shape[1] * mask.shape[2]
+        self.cell_of_value = self.key_of_res[:, None, None] * ncells + np.arange(ncells).reshape(mask.shape[1:])
+        self.count, self.sums, self.sqsums = np.zeros(self.shape), np.zeros(self.shape), np.zeros(self.shape)
+        self.edges = None if nbins is None else np.linspace(*scdrange, nbins+1)
+        self.hist = None if nbins is None else np.zeros(self.shape+(nbins,), dtype=np.int64)
+
+    def add(self, values):
+        ''' Adds values of shape (frame, residue, chain, carbon) '''
+        values = np.asarray(values, dtype=float)
+        valid = self.mask[None] & ~np.isnan(values)
+        cells = np.broadcast_to(self.cell_of_value, values.shape)[valid]
+        values = values[valid]
+        size = np.prod(self.shape)
+        self.count += np.bincount(cells, minlength=size).reshape(self.shape)
+        self.sums += np.bincount(cells, weights=values, minlength=size).reshape(self.shape)
+        self.sqsums += np.bincount(cells, weights=values**2, minlength=size).reshape(self.shape)
+        if self.hist is not None:
+            nbins = len(self.edges) - 1
+            binndx = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, nbins-1)
+            self.hist += np.bincount(cells*nbins + binndx, minlength=size*nbins).reshape(self.hist.shape)
+
+    def write(self, profilefile, histfile=None):
+        ''' Writes mean, std and count of each carbon and (if histfile is given) all non empty histogram bins '''
+        with open(profilefile, "w") as proffile:
+            print("{: <7}{: <10}{: <10}{: <10}{: <15}{: <15}{: <10}".format("Type", "leaflet", "chain", "carbon", self.name, "std", "count"), file=proffile)
+            for keyndx, chain, carbon in zip(*np.nonzero(self.count)):
+                resname, leaflet = self.keys[keyndx]
+                number = self.carbon_numbers[self.key_of_res.tolist().index(keyndx), chain, carbon]
+                mean = self.sums[keyndx, chain, carbon] / self.count[keyndx, chain, carbon]
+                std = np.sqrt(max(self.sqsums[keyndx, chain, carbon] / self.count[keyndx, chain, carbon] - mean**2, 0))
+                print("{: <7}{: <10}{: <10}{: <10}{: <15.8}{: <15.8}{: <10}".format(resname, leaflet, "sn"+str(chain+1), number,
+                    mean, std, int(self.count[keyndx, chain, carbon])), file=proffile)
+        if histfile is None or self.hist is None:
+            return
+        centers = 0.5 * (self.edges[:-1] + self.edges[1:])
+        with open(histfile, "w") as hfile:
+            print("{: <7}{: <10}{: <10}{: <10}{: <10}{: <10}".format("Type", "leaflet", "chain", "carbon", self.name, "count"), file=hfile)
+            for keyndx, chain, carbon, binndx in zip(*np.nonzero(self.hist)):
+                resname, leaflet = self.keys[keyndx]
+                number = self.carbon_numbers[self.key_of_res.tolist().index(keyndx), chain, carbon]
+                print("{: <7}{: <10}{: <10}{: <10}{: <10.4f}{: <10}".format(resname, leaflet, "sn"+str(chain+1), number,
+                    centers[binndx], self.hist[keyndx, chain, carbon, binndx]), file=hfile)
+
+def neighbor_composition(neiblist, resids, resid_to_lipid, components):
+    ''' Number of neighbors of each lipid type in components for all resids, shape (residue, component) '''
+    compositions = np.zeros((len(resids), len(components)), dtype=int)
+    for ndx, res in enumerate(resids):
+        neibs = [resid_to_lipid[N] for N in neiblist[res]]
+        compositions[ndx] = [neibs.count(lip) for lip in components]
+    return compositions
+
+def _scd_of_frames(mode, gropath, trjpath, frames, bondinfo, leaflets, timefilter, tiltinfo=None, localinfo=None):
+    ''' Reads frames (start, stop) of trajectory and calculates order parameters of all residues of bondinfo
+        Only frames with time % dt == 0 and t_start <= time <= t_end (timefilter) are used.
+        If tiltinfo (see tilt_index) is given, the average tilt of each leaflet is calculated for the frame
+        and used as axis. Otherwise the z axis is used.
+        If also localinfo (tail_owner_matrix, neighbor times and stacked neighbor_matrix) is given, each
+        residue gets its local tilt (see local_tilt) as axis.
+        Defined on module level to be picklable for parallelization.
+        Returns times, values and the axes (frame, leaflet, xyz) of the tilt (empty if not calculated)
+        values are
+            for mode CC:      array (frame, residue) of Scd
+            for mode profile: array (frame, residue, chain, bond) of S (see scd_of_bonds)
+            for mode CH:      array (frame, residue, chain, carbon) of S (see sch_of_carbons)
+    '''
+    universe = cached_universe(gropath, trjpath)
+    bond_atoms, bond_mask = bondinfo[2:4]
+    dt, t_start, t_end = timefilter
+    times, values, tilts = [], [], []
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        time = ts.time
+        if time % dt != 0 or t_start > time or t_end < time:
+            continue
+        new_axis = None
+        if tiltinfo is not None:
+            new_axis = leaflet_tilt(ts.positions, *tiltinfo[:2], box=ts.dimensions)
+            tilts.append(new_axis)
+        axes = leaflet_axes(new_axis, leaflets)
+        if localinfo is not None:
+            tail_owner, neighbor_times, adjacency = localinfo
+            nres = len(leaflets)
+            timendx = np.searchsorted(neighbor_times, time)
+            if timendx >= len(neighbor_times) or neighbor_times[timendx] != time:
+                raise KeyError("Time {} not found in neighbor_info, create it with the same dt, t_start and t_end".format(time))
+            axes = local_tilt(ts.positions, tiltinfo[0], tail_owner,
+                adjacency[timendx*nres:(timendx+1)*nres], box=ts.dimensions, fallback=axes)
+        scds = scd_of_bonds(ts.positions, bond_atoms, bond_mask, axes, box=ts.dimensions)
+        if mode == "CC":
+            values.append(scd_cc(scds))
+        elif mode == "CH":
+            values.append(sch_of_carbons(scds))
+        else:
+            values.append(scds)
+        times.append(time)
+    LOGGER.info("finished with frames %s to %s", *frames)
+    return np.array(times), np.array(values), np.array(tilts)
+
+def tilt_index(atoms, molrange, resid_to_lipid, res_to_leaflet):
+    ''' Looks up atom indices of first and last carbon of each tail of all lipids (sterols are skipped)
+        Returns tail_atoms (tail, 2), leaflet and resid of each tail
+    '''
+    index_of = _atom_index_lookup(atoms)
+    tail_atoms, tail_leaflets, tail_resids = [], [], []
+    for res in molrange:
+        resn = resid_to_lipid[res]
+        if resn in lipidmolecules.STEROLS:
+            continue
+        for carbons in lipidmolecules.tailcarbons_of(resn)[:2]:
+            tail_atoms.append( (index_of[(res, carbons[0])], index_of[(res, carbons[-1])]) )
+            tail_leaflets.append(res_to_leaflet[res])
+            tail_resids.append(res)
+    return np.array(tail_atoms, dtype=int).reshape(-1, 2), np.array(tail_leaflets, dtype=int), np.array(tail_resids, dtype=int)
+
+def tail_directors(positions, tail_atoms, box=None):
+    ''' Normalized end to end vector of each tail of tail_atoms (see tilt_index), shape (tail, 3) '''
+    tailvectors = minimum_image(positions[tail_atoms[:, 1]] - positions[tail_atoms[:, 0]], box)
+    return tailvectors / np.sqrt(np.matmul(tailvectors[:, None, :], tailvectors[:, :, None]))[:, 0]
+
+def leaflet_tilt(positions, tail_atoms, tail_leaflets, box=None):
+    ''' Average normalized end to end vector of all tails of each leaflet (normalized), shape (2, 3) '''
+    tailvectors = tail_directors(positions, tail_atoms, box)
+    avg_vecs = np.array([tailvectors[tail_leaflets == leaflet].mean(axis=0) for leaflet in (0, 1)])
+    return avg_vecs / np.sqrt(np.matmul(avg_vecs[:, None, :], avg_vecs[:, :, None]))[:, 0]
+
+def tail_owner_matrix(tail_resids, resids):
+    ''' Sparse matrix (residue, tail) that sums up the tails of each residue of resids '''
+    resndx_of = {res:ndx for ndx, res in enumerate(resids)}
+    owned = [(resndx_of[res], tail) for tail, res in enumerate(tail_resids) if res in resndx_of]
+    rows, cols = zip(*owned) if owned else ((), ())
+    return sparse.csr_matrix((np.ones(len(owned)), (rows, cols)), shape=(len(resids), len(tail_resids)))
+
+def neighbor_matrix(neiblist_t, resids, leaflets):
+    ''' Adjacency matrices (including the residue itself) of resids for all times of neiblist_t[time][res]
+        Only neighbors in the same leaflet are taken into account.
+        Returns sorted times and the stacked csr matrix (time*residue, residue)
+    '''
+    times = np.array(sorted(neiblist_t))
+    resndx_of = {res:ndx for ndx, res in enumerate(resids)}
+    rows, cols = [], []
+    for timendx, time in enumerate(times):
+        neibs_of = neiblist_t[time]
+        for ndx, res in enumerate(resids):
+            neibndx = [resndx_of[neib] for neib in neibs_of.get(res, []) if neib in resndx_of]
+            neibndx = [ndx] + [neib for neib in neibndx if leaflets[neib] == leaflets[ndx] and neib != ndx]
+            rows += len(neibndx) * [timendx*len(resids) + ndx]
+            cols += neibndx
+    adjacency = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(times)*len(resids), len(resids)))
+    return times, adjacency
+
+def local_tilt(positions, tail_atoms, tail_owner, adjacency, box=None, fallback=None):
+    ''' Average normalized tail vector of each residue and its neighbors (normalized), shape (residue, 3)
+        tail_owner is the output of tail_owner_matrix and adjacency the neighbor_matrix of one frame.
+        Residues without any tail in their neighborhood get the axis of fallback (default z axis).
+    '''
+    local_vecs = adjacency @ (tail_owner @ tail_directors(positions, tail_atoms, box).astype(float))
+    norms = np.sqrt((local_vecs**2).sum(axis=1))
+    if fallback is None:
+        fallback = np.tile([0., 0., 1.], (len(local_vecs), 1))
+    return np.where(norms[:, None] > 0, local_vecs / np.where(norms > 0, norms, 1)[:, None], fallback)
+
+def write_tiltfile(filename, times, axes):
+    ''' Writes tilt axes (frame, leaflet, xyz) with their angle to the z axis in the format of calc_tilt '''
+    angles = np.degrees(np.arccos(axes[..., 2].astype(float)))
+    angles = np.where(angles > 90, np.abs(angles - 180), angles)
+    dat = pd.DataFrame({"time":np.repeat(times, 2), "leaflet":np.tile([0, 1], len(times)), "angle":angles.ravel(),
+        "x":axes[..., 0].ravel(), "y":axes[..., 1].ravel(), "z":axes[..., 2].ravel()})
+    dat.to_csv(filename, index=False)
 
 def calc_tilt(sysinfo, include_neighbors="global", filename="tilt.csv", parallel=True):
     ''' End to end vector of each tail, average vector is substracted depending on include_neighbors variable
-        include_neighbors can be "global", "local"(not implemented)
+        include_neighbors can be "global", "local" is only available in Order.create_orderfile, where
+        the axis of each lipid is used directly without writing it.
+        Tail vectors are corrected for periodic boundaries, so the raw trajectory can be used.
+        The first and last carbon of each tail are looked up once (see tilt_index), each task
+        calculates the tilt of a range of frames.
     '''
-    DEBUG = False
-    if DEBUG:
-        LOGGER.setLevel("DEBUG")
+    if include_neighbors != "global":
+        raise ValueError("calc_tilt only supports include_neighbors='global', use Order.create_orderfile for local tilt")
     u = sysinfo.universe
     len_traj = len(u.trajectory)
-    inpargs = []
-    #angles  = []
-    #vectors = []
-    #times   = []
-    #leaflet = []
-
-
-    LOGGER.info("gather input arguments")
-    for t in range(len_traj):
-
-        time = u.trajectory[t].time
-        if time % sysinfo.dt != 0 or time > sysinfo.t_end or time < sysinfo.t_start:
-            continue
-        #LOGGER.info("At time %s", time)
-
-        inpargs.append( (time, sysinfo.MOLRANGE, sysinfo.resid_to_lipid, sysinfo.res_to_leaflet, u.atoms, u.atoms.positions) )
-
-        #Leaflist = [[], []]
-        #for res in sysinfo.MOLRANGE:
-
-        #    mda_res = u.atoms.select_atoms("resid {}".format(res))
-        #    resn = sysinfo.resid_to_lipid[res]
-        #    leaf = sysinfo.res_to_leaflet[res]
-
-        #    if resn in lipidmolecules.STEROLS:
-        #        continue
-
-        #    # first carbon of tail
-        #    t1_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[0][0])).positions
-        #    t2_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[1][0])).positions
-
-        #    # get vector c_last - c_first
-        #    tail1_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[0][-1])).positions - t1_xyz
-        #    tail2_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[1][-1])).positions - t2_xyz
-
-        #    # normalize vectors
-        #    tail1_xyz = tail1_xyz / np.linalg.norm(tail1_xyz)
-        #    tail2_xyz = tail2_xyz / np.linalg.norm(tail2_xyz)
-
-        #    # leaf is either 0 or 1: append avg vector to correct leaflet list
-        #    leaflist[leaf] += [tail1_xyz, tail2_xyz]
-
-        ## get average tilt vector per leaflet
-        #avg_vec_leaf1 = np.array(leaflist[0]).mean(axis=0)
-        #avg_vec_leaf2 = np.array(leaflist[1]).mean(axis=0)
-        #avg_vec_leaf1 = (avg_vec_leaf1/np.linalg.norm(avg_vec_leaf1))[0]
-        #avg_vec_leaf2 = (avg_vec_leaf2/np.linalg.norm(avg_vec_leaf2))[0]
-
-        ## calculate the angle of average vector to z axis
-        #ang_l1 = angle_to_axis(avg_vec_leaf1)
-        #ang_l2 = angle_to_axis(avg_vec_leaf2)
-        #if ang_l1 > 90:
-        #    ang_l1 = np.abs(ang_l1 - 180)
-        #if ang_l2 > 90:
-        #    ang_l2 = np.abs(ang_l2 - 180)
-
-        ## fill lists this will become line in the final dataframe
-        #angles  += [ang_l1, ang_l2]
-        #vectors +=  [avg_vec_leaf1, avg_vec_leaf2]
-        #times   += [time, time]
-        #leaflet += [0, 1]
-
-    LOGGER.info("running tasks")
-    if parallel and not DEBUG:
-        output = loop_to_pool(_calc_tilt_output, inpargs)
+    tiltinfo = tilt_index(u.atoms, sysinfo.MOLRANGE, sysinfo.resid_to_lipid, sysinfo.res_to_leaflet)[:2]
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, tiltinfo, (sysinfo.dt, sysinfo.t_start, sysinfo.t_end))
+        for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Calculating tilt of %s frames in %s tasks", len_traj, len(inpargs))
+    if parallel:
+        output = loop_to_pool(_tilt_of_frames, inpargs)
     else:
-        output = []
-        for inp in inpargs:
-            print("at time:", inp[0])
-            output.append( _calc_tilt_output(*inp) )
-    LOGGER.info("sort and write dataframe")
-    dat = pd.concat(output)
-    dat = dat.sort_values(by=["time"])
-
-    #vectors = np.array(vectors)
-    #dat = pd.DataFrame({"time":times, "leaflet":leaflet, "angle":angles, "x":vectors[:,0], "y":vectors[:,1], "z":vectors[:,2]})
-    dat.to_csv(filename, index=False)
-
-def _calc_tilt_output(time, molrange, resid_to_lipid, res_to_leaflet, all_atms, all_positions,):
-        leaflist = [[], []]
-
-        for res in molrange:
-
-            #mda_res = u.atoms.select_atoms("resid {}".format(res))
-            #mda_res = all_atms[all_atms.resids == res]
-            resn = resid_to_lipid[res]
-            leaf = res_to_leaflet[res]
-
-            if resn in lipidmolecules.STEROLS:
-                continue
-
-            # first carbon of tails
-            #t1_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[0][0])).positions
-            #t2_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[1][0])).positions
-            masks1 = ( all_atms.names == lipidmolecules.tailcarbons_of(resn)[0][0], all_atms.resids == res )
-            masks2 = ( all_atms.names == lipidmolecules.tailcarbons_of(resn)[1][0], all_atms.resids == res )
-            t1_xyz = all_positions[ masks1[0] & masks1[1] ][0]
-            t2_xyz = all_positions[ masks2[0] & masks2[1] ][0]
-
-            # get vector c_last - c_first
-            #tail1_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[0][-1])).positions - t1_xyz
-            #tail2_xyz = mda_res.atoms.select_atoms("name {}".format(lipidmolecules.tailcarbons_of(resn)[1][-1])).positions - t2_xyz
-            masks1 = ( all_atms.names == lipidmolecules.tailcarbons_of(resn)[0][-1], all_atms.resids == res )
-            masks2 = ( all_atms.names == lipidmolecules.tailcarbons_of(resn)[1][-1], all_atms.resids == res )
-            tail1_xyz = all_positions[ masks1[0] & masks1[1] ][0] - t1_xyz
-            tail2_xyz = all_positions[ masks2[0] & masks2[1] ][0] - t2_xyz
-
-            # normalize vectors
-            tail1_xyz = tail1_xyz / np.linalg.norm(tail1_xyz)
-            tail2_xyz = tail2_xyz / np.linalg.norm(tail2_xyz)
-
-            LOGGER.debug("tail1_xyz %s", tail1_xyz)
-
-            # leaf is either 0 or 1: append avg vector to correct leaflet list
-            leaflist[leaf] += [tail1_xyz, tail2_xyz]
-        LOGGER.debug("leaflist: %s", leaflist)
-
-        # get average tilt vector per leaflet
-        avg_vec_leaf1 = np.array(leaflist[0]).mean(axis=0)
-        avg_vec_leaf2 = np.array(leaflist[1]).mean(axis=0)
-        avg_vec_leaf1 = (avg_vec_leaf1/np.linalg.norm(avg_vec_leaf1))
-        avg_vec_leaf2 = (avg_vec_leaf2/np.linalg.norm(avg_vec_leaf2))
-
-        LOGGER.debug("avg_vec_leaf1 %s", avg_vec_leaf1)
-
-        # calculate the angle of average vector to z axis
-        ang_l1 = angle_to_axis(avg_vec_leaf1)
-        LOGGER.debug("ang1 %s", ang_l1)
-        ang_l2 = angle_to_axis(avg_vec_leaf2)
-        if ang_l1 > 90:
-            ang_l1 = np.abs(ang_l1 - 180)
-        if ang_l2 > 90:
-            ang_l2 = np.abs(ang_l2 - 180)
-
-        # fill lists this will become line in the final dataframe
-        angles  = [ang_l1, ang_l2]
-        vectors =  [avg_vec_leaf1, avg_vec_leaf2]
-        times   = [time, time]
-        leaflet = [0, 1]
-        vectors = np.array(vectors)
-        dat = pd.DataFrame({"time":times, "leaflet":leaflet, "angle":angles, "x":vectors[:,0], "y":vectors[:,1], "z":vectors[:,2]})
-        return dat
-
-
+        output = [_tilt_of_frames(*inp) for inp in inpargs]
+    times = np.concatenate([times for times, _ in output])
+    axes = np.concatenate([axes for _, axes in output])
+    write_tiltfile(filename, times, axes)
+
+def _tilt_of_frames(gropath, trjpath, frames, tiltinfo, timefilter):
+    ''' Average tilt vector of both leaflets (see leaflet_tilt) for frames (start, stop) of trajectory
+        Defined on module level to be picklable for parallelization.
+        Returns times and axes (frame, leaflet, xyz)
+    '''
+    universe = cached_universe(gropath, trjpath)
+    dt, t_start, t_end = timefilter
+    times = np.empty(frames[1] - frames[0])
+    axes = np.empty((frames[1] - frames[0], 2, 3), dtype=np.float32)
+    nframes = 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time % dt != 0 or t_start > ts.time or t_end < ts.time:
+            continue
+        times[nframes] = ts.time
+        axes[nframes] = leaflet_tilt(ts.positions, *tiltinfo, box=ts.dimensions)
+        nframes += 1
+    return times[:nframes], axes[:nframes]
 
 def angle_to_axis(vec: np.array, axis=np.array([0,0,1])) -> float:
     ''' Calculates angle of vector to axis (default: z axis)
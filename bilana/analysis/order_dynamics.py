@@ -0,0 +1,203 @@
+'''
+    This module analyses the dynamics of lipid order parameters
+        - A (lipid x frame) matrix of Scd is built directly from the trajectory (see order._scd_of_frames)
+          or from an existing scd_distribution.dat
+        - Normalized autocorrelation functions of each lipid are calculated with FFT in batches of lipids
+        - Integrated correlation times give the statistical inefficiency that is used for the
+          standard error of the mean order parameters
+    Large matrices are stored as float32 memory maps (.npy) so that they do not have to fit into memory.
+'''
+import os
+import numpy as np
+import pandas as pd
+from scipy import fft
+
+from .. import log
+from ..common import imap_to_pool, frame_ranges, truncate_npy
+from ..systeminfo import SysInfo
+from .order import scd_bond_index, tilt_index, _scd_of_frames
+
+LOGGER = log.LOGGER
+
+def autocorrelation(series, batchsize=256, out=None):
+    ''' Normalized autocorrelation of each row of series (lipid, frame) averaged over all time origins
+        Rows are processed in batches of batchsize, out can be a (memory mapped) array of the same shape.
+        Missing values (nan) are left out: each lag is divided by the number of pairs of valid values,
+        which is the autocorrelation of the mask of valid values. Lags without pairs and rows with zero
+        variance get nan.
+    '''
+    nrows, nframes = series.shape
+    if out is None:
+        out = np.empty((nrows, nframes), dtype=np.float32)
+    nfft = fft.next_fast_len(2 * nframes)
+    for start in range(0, nrows, batchsize):
+        batch = np.asarray(series[start:start+batchsize], dtype=float)
+        valid = ~np.isnan(batch)
+        batch = batch - np.nanmean(batch, axis=1, keepdims=True)
+        batch[~valid] = 0
+        spectrum = fft.rfft(batch, n=nfft, axis=1)
+        maskspectrum = fft.rfft(valid.astype(float), n=nfft, axis=1)
+        counts = np.rint(fft.irfft(maskspectrum * maskspectrum.conj(), n=nfft, axis=1)[:, :nframes])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            acf = np.where(counts > 0,
+                fft.irfft(spectrum * spectrum.conj(), n=nfft, axis=1)[:, :nframes] / counts, np.nan)
+            out[start:start+batchsize] = acf / acf[:, :1]
+    return out
+
+def integrated_correlation_time(acf, dt=1.0):
+    ''' Integrated correlation time tau = dt * (1/2 + sum rho(k)) of each row of acf
+        The sum is truncated at the first negative value of rho (k >= 1).
+        Returns tau and the statistical inefficiency g = 1 + 2 tau/dt
+    '''
+    acf = np.atleast_2d(acf)
+    negative = acf[:, 1:] < 0
+    cutoff = np.where(negative.any(axis=1), negative.argmax(axis=1), acf.shape[1]-1)
+    lags = np.arange(1, acf.shape[1])
+    summed = np.where(lags[None, :] <= cutoff[:, None], np.nan_to_num(acf[:, 1:]), 0).sum(axis=1)
+    tau = dt * (0.5 + summed)
+    tau[np.isnan(acf[:, 0])] = np.nan
+    return tau, 1 + 2 * tau / dt
+
+class OrderDynamics(SysInfo):
+    ''' Scd time series of all lipids and their autocorrelation
+        If memmapfile is given the Scd matrix is stored there as float32 .npy file,
+        the autocorrelation functions are stored in <memmapfile>_acf.npy.
+    '''
+
+    def __init__(self, inputfilename="inputfile", memmapfile=None):
+        super().__init__(inputfilename)
+        self.memmapfile = memmapfile
+        self.times = None
+        self.resids = None
+        self.matrix = None
+
+    def _allocate(self, shape, filename=None):
+        if filename is None:
+            return np.empty(shape, dtype=np.float32)
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=shape)
+
+    def build_matrix(self, with_tilt_correction=True, parallel=True):
+        ''' Calculates Scd (mode CC of order.Order) of all lipids for all frames into the (lipid, frame) matrix '''
+        bondinfo = scd_bond_index(self.universe.atoms, self.MOLRANGE, self.resid_to_lipid)
+        resids = bondinfo[0]
+        leaflets = np.array([self.res_to_leaflet[res] for res in resids])
+        tiltinfo = None
+        if with_tilt_correction:
+            tiltinfo = tilt_index(self.universe.atoms, self.MOLRANGE, self.resid_to_lipid, self.res_to_leaflet)
+        trajectory = self.trjpath_whole if self.trjpath_whole else self.trjpath
+        len_traj = len(self.universe.trajectory)
+        ncores = len(os.sched_getaffinity(0)) if parallel else 1
+        inpargs = [("CC", self.gropath, trajectory, frames, bondinfo, leaflets,
+            (self.dt, self.t_start, self.t_end), tiltinfo) for frames in frame_ranges(len_traj, 4*ncores)]
+        if parallel:
+            output = imap_to_pool(_scd_of_frames, inpargs)
+        else:
+            output = (_scd_of_frames(*inp) for inp in inpargs)
+        # Frames that do not pass the time filter are dropped, so the matrix is trimmed at the end
+        matrix = self._allocate((len(resids), len_traj), self.memmapfile)
+        times = []
+        for frametimes, scds, _ in output:
+            matrix[:, len(times):len(times)+len(frametimes)] = np.asarray(scds).T
+            times += list(frametimes)
+        if self.memmapfile is None:
+            matrix = matrix[:, :len(times)]
+        else:
+            matrix.flush()
+            del matrix
+            truncate_npy(self.memmapfile, len(resids), len(times))
+            matrix = np.load(self.memmapfile, mmap_mode="r+")
+        self.times, self.resids, self.matrix = np.array(times), resids, matrix
+        return self.matrix
+
+    def read_matrix(self, scdfilename="scd_distribution.dat", chunksize=1000000):
+        ''' Fills the (lipid, frame) matrix from the output of Order.create_orderfile (mode CC) '''
+        reader = pd.read_csv(scdfilename, sep=r'\s+', usecols=["Time", "Residue", "Scd"], chunksize=chunksize)
+        chunks = [chunk for chunk in reader]
+        times = np.unique(np.concatenate([chunk["Time"].to_numpy() for chunk in chunks]))
+        resids = np.unique(np.concatenate([chunk["Residue"].to_numpy() for chunk in chunks]))
+        matrix = self._allocate((len(resids), len(times)), self.memmapfile)
+        matrix[:] = np.nan
+        for chunk in chunks:
+            matrix[np.searchsorted(resids, chunk["Residue"].to_numpy()),
+                np.searchsorted(times, chunk["Time"].to_numpy())] = chunk["Scd"].to_numpy()
+        self.times, self.resids, self.matrix = times, resids, matrix
+        return self.matrix
+
+    def lipid_autocorrelation(self, batchsize=256):
+        ''' Normalized autocorrelation (lipid, lag) of Scd of each lipid '''
+        if self.matrix is None:
+            raise ValueError("Scd matrix is missing, run build_matrix or read_matrix first")
+        acffile = None if self.memmapfile is None else os.path.splitext(self.memmapfile)[0]+"_acf.npy"
+        out = self._allocate(self.matrix.shape, acffile)
+        return autocorrelation(self.matrix, batchsize=batchsize, out=out)
+
+    def _groups(self):
+        ''' Key (type, leaflet) of each lipid of matrix '''
+        return [(self.resid_to_lipid[res], self.res_to_leaflet[res]) for res in self.resids]
+
+    def correlation_times(self, acf=None):
+        ''' DataFrame with mean, variance, integrated correlation time tau and
+            statistical inefficiency g of Scd of each lipid
+        '''
+        if acf is None:
+            acf = self.lipid_autocorrelation()
+        dt = self.times[1] - self.times[0] if len(self.times) > 1 else 1.0
+        tau, inefficiency = integrated_correlation_time(acf, dt=dt)
+        groups = self._groups()
+        return pd.DataFrame({
+            "resid":self.resids,
+            "type":[grp[0] for grp in groups],
+            "leaflet":[grp[1] for grp in groups],
+            "mean":np.nanmean(self.matrix, axis=1),
+            "var":np.nanvar(self.matrix, axis=1),
+            "tau":tau,
+            "g":inefficiency,
+            })
+
+    def type_autocorrelation(self, acf=None):
+        ''' Average of the lipid autocorrelation functions per lipid type and leaflet
+            Returns dict (type, leaflet) -> acf
+        '''
+        if acf is None:
+            acf = self.lipid_autocorrelation()
+        groups = np.array(["{}_{}".format(*grp) for grp in self._groups()])
+        return {(grp.rsplit("_", 1)[0], int(grp.rsplit("_", 1)[1])):np.nanmean(acf[groups == grp], axis=0)
+            for grp in np.unique(groups)}
+
+    def order_statistics(self, lipid_times=None):
+        ''' Mean Scd per lipid type and leaflet with its standard error, lipids are treated as independent
+            and each one contributes nframes/g effective samples
+        '''
+        if lipid_times is None:
+            lipid_times = self.correlation_times()
+        nframes = np.count_nonzero(~np.isnan(self.matrix), axis=1)
+        lipid_times = lipid_times.assign(neff=nframes / lipid_times["g"], nframes=nframes,
+            sqdev=lipid_times["var"] + lipid_times["mean"]**2)
+        rows = []
+        for (lipid, leaflet), grp in lipid_times.groupby(["type", "leaflet"]):
+            mean = np.average(grp["mean"], weights=grp["nframes"])
+            var = np.average(grp["sqdev"], weights=grp["nframes"]) - mean**2
+            neff = grp["neff"].sum()
+            rows.append({"type":lipid, "leaflet":leaflet, "nlipids":len(grp), "mean":mean, "std":np.sqrt(max(var, 0)),
+                "sem":np.sqrt(max(var, 0) / neff), "tau":grp["tau"].mean(), "neff":neff})
+        return pd.DataFrame(rows)
+
+    def write_dynamics(self, outputprefix="scd_dynamics", batchsize=256):
+        ''' Writes
+                <outputprefix>_acf.dat:   autocorrelation per lipid type and leaflet over lag time
+                <outputprefix>_tau.dat:   correlation times of each lipid
+                <outputprefix>_stats.dat: mean Scd with standard error per lipid type and leaflet
+        '''
+        acf = self.lipid_autocorrelation(batchsize=batchsize)
+        lipid_times = self.correlation_times(acf)
+        lags = self.times - self.times[0]
+        type_acf = self.type_autocorrelation(acf)
+        with open(outputprefix+"_acf.dat", "w") as acffile:
+            print("{: <12}{: <10}{: <10}{: <15}".format("Lag", "Type", "leaflet", "ACF"), file=acffile)
+            for (lipid, leaflet), values in sorted(type_acf.items()):
+                for lag, value in zip(lags, values):
+                    print("{: <12.2f}{: <10}{: <10}{: <15.8}".format(lag, lipid, leaflet, value), file=acffile)
+        lipid_times.to_csv(outputprefix+"_tau.dat", sep=' ', index=False, float_format="%.8f")
+        stats = self.order_statistics(lipid_times)
+        stats.to_csv(outputprefix+"_stats.dat", sep=' ', index=False, float_format="%.8f")
+        return stats
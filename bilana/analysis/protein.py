@@ -42,22 +42,52 @@ def run_helanal(systeminfo,
         prefix=prefix,
         )
 
-def define_bilayer_head_region(sysinfo, overwrite=False):
+def density_tables(sysinfo, selections, outnames, overwrite=False, method="gmx"):
+    '''
+        Returns DataFrames with columns z, dens for each selection (dict name -> selection string)
+        method is either
+            gmx    -- one gmx select and gmx density run per selection (leaflets.calc_density)
+            native -- all selections in a single trajectory pass (leaflets.density_profiles)
+        The profiles are stored in <datapath>/densities/<outname>, existing files are read
+        instead unless overwrite is set (native: only if the files of all selections exist).
+    '''
+    if method == "native":
+        os.makedirs(sysinfo.datapath + "densities", exist_ok=True)
+        outputs = {name:sysinfo.datapath + "densities/" + outnames[name] for name in selections}
+        if not overwrite and all(os.path.exists(output) for output in outputs.values()):
+            LOGGER.warning("Density files already exist")
+            return {name:pd.read_table(output, header=None, sep=r'\s+', names=["z", "dens"])
+                for name, output in outputs.items()}
+        profiles = leaflets.density_profiles(sysinfo, selections)
+        tables = {}
+        for name, output in outputs.items():
+            leaflets.write_density_xvg(output, profiles.z, profiles[name])
+            tables[name] = pd.DataFrame({"z":profiles.z, "dens":profiles[name]})
+        return tables
+    if method != "gmx":
+        raise ValueError("method must be gmx or native")
+    tables = {}
+    for name, selstr in selections.items():
+        label = name if str(name).isidentifier() else "sel{}".format(name)
+        sel = "{0}={1};{0};".format(label, selstr)
+        output = leaflets.calc_density(sysinfo, sel, outname=outnames[name], xvg="none", overwrite=overwrite)
+        tables[name] = pd.read_table(output, header=None, sep=r'\s+', names=["z", "dens"])
+    return tables
+
+def define_bilayer_head_region(sysinfo, overwrite=False, method="gmx"):
     '''
         Divides bilayer z range in head and tail regions
         e.g.:
             <region> <zlow> <zhigh>
             head1 -20 0
             tail1 0 20
+        method see density_tables
     '''
     from scipy.interpolate import UnivariateSpline
     head_regions = []
-    
-    sel = "P=resname {} and name P;P;".format(' '.join(sysinfo.PL_molecules))
-
-    output = leaflets.calc_density(sysinfo, sel, outname="densities_P.xvg", xvg="none", overwrite=True)
 
-    dat = pd.read_table(output, header=None, delim_whitespace=True, names=["z", "dens"])
+    sel = "resname {} and name P".format(' '.join(sysinfo.PL_molecules))
+    dat = density_tables(sysinfo, {"P":sel}, {"P":"densities_P.xvg"}, overwrite=True, method=method)["P"]
     LOGGER.debug("\n%s", dat)
     dat["zerogrps"] = (dat.dens.diff(1) != 0).astype(int).cumsum()
     dat = dat.groupby("zerogrps").mean() 
@@ -80,9 +110,10 @@ def define_bilayer_head_region(sysinfo, overwrite=False):
     LOGGER.debug("head_regions: %s", head_regions)
     return head_regions
 
-def define_bilayer_center(sysinfo, overwrite=False):
+def define_bilayer_center(sysinfo, overwrite=False, method="gmx"):
     '''
         Defines the middlepoint of the bilayer
+        method see density_tables
     '''
     atmnames = []
     for PL in sysinfo.PL_molecules:
@@ -90,12 +121,11 @@ def define_bilayer_center(sysinfo, overwrite=False):
         tail = [i[-1] for i in tail]
         atmnames += tail
     atmnames = list( set( atmnames ) )
-    sel = "tailends=resname {} and name {};tailends;".format( ' '.join(sysinfo.PL_molecules), ' '.join(atmnames) )
-    output = leaflets.calc_density(sysinfo, sel, outname="densities_P.xvg", xvg="none", overwrite=overwrite)
-    dat = pd.read_table(output, header=None, delim_whitespace=True, names=["z", "dens"])
+    sel = "resname {} and name {}".format( ' '.join(sysinfo.PL_molecules), ' '.join(atmnames) )
+    dat = density_tables(sysinfo, {"tailends":sel}, {"tailends":"densities_P.xvg"}, overwrite=overwrite, method=method)["tailends"]
     return dat.mean().z
 
-def get_bilayer_regions(sysinfo, overwrite=False):
+def get_bilayer_regions(sysinfo, overwrite=False, method="gmx"):
     ''' 
        Create file with
        region llower lupper
@@ -103,16 +133,17 @@ def get_bilayer_regions(sysinfo, overwrite=False):
         .       .      .
         .       .      .
     '''
-    headregions    = define_bilayer_head_region(sysinfo, overwrite=overwrite)
-    bilayer_center = define_bilayer_center(sysinfo, overwrite=overwrite)
+    headregions    = define_bilayer_head_region(sysinfo, overwrite=overwrite, method=method)
+    bilayer_center = define_bilayer_center(sysinfo, overwrite=overwrite, method=method)
     return sorted([ *headregions[0], bilayer_center, *headregions[1], ])
     
 
-def create_leaflet_assignment_prot(sysinfo, outputfilename="leaflet_assignment_prot.csv", overwrite=False):
+def create_leaflet_assignment_prot(sysinfo, outputfilename="leaflet_assignment_prot.csv", overwrite=False, method="gmx"):
     '''
         Append leaflet assignment for each protein residue to 
         leaflet_assignment.dat created in leaflet.create_leaflet_assignment_file
         < resid > < leaflet > < region >
+        method see density_tables, with native all residues are done in one trajectory pass
     '''
 
     resids       = []
@@ -121,12 +152,12 @@ def create_leaflet_assignment_prot(sysinfo, outputfilename="leaflet_assignment_p
 
     regions_name = {0:"solvent1", 1:"head1", 2:"tail1", 3:"tail2", 4:"head2", 5:"solvent2"}
     # list of region borders:  [ h1/t1, t1/t2, t2/h2, ]
-    regions_range = get_bilayer_regions(sysinfo)
+    regions_range = get_bilayer_regions(sysinfo, method=method)
+    selections = {res:"resname {} and name CA and resid {}".format(sysinfo.resid_to_lipid[res], res) for res in sysinfo.MOLRANGE_PROT}
+    outnames = {res:"densities_res{}.xvg".format(res) for res in sysinfo.MOLRANGE_PROT}
+    tables = density_tables(sysinfo, selections, outnames, overwrite=overwrite, method=method)
     for res in sysinfo.MOLRANGE_PROT:
-        resname = sysinfo.resid_to_lipid[res]
-        sel = "res=resname {} and name CA and resid {};res;".format( resname, res )
-        output = leaflets.calc_density(sysinfo, sel, outname="densities_res{}.xvg".format(res), xvg="none", overwrite=overwrite)
-        dat = pd.read_table(output, header=None, delim_whitespace=True, names=["z", "dens"])
+        dat = tables[res]
         dat = dat[dat.dens > 0]
         dat["wt"] = dat.dens / dat.dens.sum()
         zmean = (dat.z  * dat.wt).sum()
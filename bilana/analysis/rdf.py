@@ -1,23 +1,37 @@
 '''
     This module contains a class that defines own implementation to calculate the radial distribution function
     as well as a wrapper for the gmx rdf tool function radialdistribution
+    rdf_pairs calculates lateral (2D) RDFs of many (ref, sel) pairs in both leaflets in a single
+    frame-parallel trajectory pass, write_rdf_pairs writes them in the format of gmx rdf -xy
 '''
 import os
 import re
 import numpy as np
+import pandas as pd
 import bisect
+from MDAnalysis.lib.distances import capped_distance
 from .. import log
-from ..common import exec_gromacs
+from ..common import exec_gromacs, imap_to_pool, frame_ranges, cached_universe
 from ..systeminfo import SysInfo
 
 LOGGER = log.LOGGER
 GMXNAME = 'gmx'
 
-def radialdistribution(systeminfo, ref, sel, seltype='atom', selrpos='atom', binsize=0.002, refprot=False, **kw_rdf):
+def radialdistribution(systeminfo, ref, sel, seltype='atom', selrpos='atom', binsize=0.002, refprot=False,
+    method="gmx", **kw_rdf):
     ''' Calculates 2D RDF of sel relative to ref only for one specific leaflet
         leaflet_assignment.dat (created in leaflets.py) is needed
-        Using gmx rdf
+        method is either
+            gmx    -- gmx rdf on leaflet 0
+            native -- rdf_pairs for both leaflets (ref and sel in MDAnalysis selection syntax, atoms only),
+                      see write_rdf_pairs for the outputs
     '''
+    if method == "native":
+        if seltype != 'atom' or selrpos != 'atom' or kw_rdf:
+            raise ValueError("method native supports only seltype and selrpos atom without further gmx options")
+        return write_rdf_pairs(systeminfo, [(ref, sel)], binsize=binsize, refprot=refprot)
+    if method != "gmx":
+        raise ValueError("method must be gmx or native")
 
     LOGGER.info("Calculating radial distribution function")
     LOGGER.info("Ref: %s\nSel: %s\n", ref, sel)
@@ -78,6 +92,120 @@ def radialdistribution(systeminfo, ref, sel, seltype='atom', selrpos='atom', bin
                 .format(err, out), file=logfile)
 
 
+def _atom_leaflets(atoms, res_to_leaflet, unassigned):
+    ''' Leaflet of the residue of each atom, atoms of residues without leaflet get unassigned '''
+    resids = atoms.resids
+    leaflets = np.full(len(atoms), unassigned, dtype=int)
+    assigned = np.isin(resids, list(res_to_leaflet))
+    leaflets[assigned] = res_to_leaflet.leaflets_of(resids[assigned])
+    return leaflets
+
+def _rdf_of_frames(gropath, trjpath, frames, pairinfo, nbins, binsize, timefilter):
+    ''' Lateral pair histograms of all pairs of pairinfo in frames (start, stop) of trajectory
+        pairinfo is a list of (ref indices, ref leaflets, sel indices, sel leaflets), reference atoms
+        with leaflet -1 are taken as reference in both leaflets, selected atoms with leaflet -2 are ignored.
+        Each frame is normalized with the density of sel in the box area of that frame, reference atoms that
+        are also selected are not counted as their own partner (ref == sel is normalized with nsel-1).
+        Defined on module level to be picklable for parallelization.
+        Returns number of frames, summed normalized histograms (pair, leaflet 0|1|both, bin)
+        and summed neighbor counts per reference (pair, leaflet 0|1|both, bin)
+    '''
+    universe = cached_universe(gropath, trjpath)
+    t_start, t_end = timefilter
+    gofr = np.zeros((len(pairinfo), 3, nbins))
+    neighbors = np.zeros((len(pairinfo), 3, nbins))
+    nframes = 0
+    for ts in universe.trajectory[frames[0]:frames[1]]:
+        if ts.time < t_start or ts.time > t_end:
+            continue
+        area = ts.dimensions[0] * ts.dimensions[1] / 100
+        for pair, (refndx, refleaf, selndx, selleaf) in enumerate(pairinfo):
+            refxyz, selxyz = ts.positions[refndx], ts.positions[selndx]
+            refxyz[:, 2], selxyz[:, 2] = 0, 0
+            nref_both, hist_both, count_both = 0, np.zeros(nbins), np.zeros(nbins)
+            for leaflet in (0, 1):
+                refmask = (refleaf == leaflet) | (refleaf == -1)
+                selmask = selleaf == leaflet
+                nref, nsel = np.count_nonzero(refmask), np.count_nonzero(selmask)
+                npairs = nref * nsel - np.count_nonzero(np.isin(refndx[refmask], selndx[selmask]))
+                if not npairs:
+                    continue
+                pairs, distances = capped_distance(refxyz[refmask], selxyz[selmask], nbins*binsize*10, box=ts.dimensions)
+                distinct = refndx[refmask][pairs[:, 0]] != selndx[selmask][pairs[:, 1]]
+                binndx = (distances[distinct] / (10*binsize)).astype(int)
+                hist = np.bincount(binndx[binndx < nbins], minlength=nbins)
+                gofr[pair, leaflet] += hist * area / npairs
+                neighbors[pair, leaflet] += hist / nref
+                hist_both += hist * area * nref / npairs
+                count_both += hist
+                nref_both += nref
+            if nref_both:
+                gofr[pair, 2] += hist_both / nref_both
+                neighbors[pair, 2] += count_both / nref_both
+        nframes += 1
+    return nframes, gofr, neighbors
+
+def rdf_pairs(sysinfo, pairs, binsize=0.002, rmax=None, refprot=False, parallel=True):
+    ''' Lateral RDF of sel around ref for all (ref, sel) of pairs (MDAnalysis selection strings),
+        only atoms of the same leaflet (sysinfo.res_to_leaflet) are paired.
+        If refprot, reference atoms of residues without leaflet (e.g. a protein) are used in both leaflets.
+        binsize and rmax in nm, rmax defaults to half of the smaller box edge of the first frame
+        Returns dict (ref, sel) -> DataFrame with r, g and cumulative coordination number cn
+        of leaflet 0, leaflet 1 and both leaflets (columns g_0, g_1, g, cn_0, cn_1, cn)
+    '''
+    u = sysinfo.universe
+    if rmax is None:
+        rmax = min(u.dimensions[:2]) / 20
+    nbins = int(round(rmax / binsize))
+    pairinfo = []
+    for ref, sel in pairs:
+        refatoms, selatoms = u.select_atoms(ref), u.select_atoms(sel)
+        refleaf = _atom_leaflets(refatoms, sysinfo.res_to_leaflet, -1 if refprot else -2)
+        pairinfo.append((refatoms.indices, refleaf, selatoms.indices, _atom_leaflets(selatoms, sysinfo.res_to_leaflet, -2)))
+    len_traj = len(u.trajectory)
+    ncores = len(os.sched_getaffinity(0)) if parallel else 1
+    inpargs = [(sysinfo.gropath, u.trajectory.filename, frames, pairinfo, nbins, binsize, (sysinfo.t_start, sysinfo.t_end))
+        for frames in frame_ranges(len_traj, 4*ncores)]
+    LOGGER.info("Lateral RDF of %s pairs in %s frames", len(pairs), len_traj)
+    if parallel:
+        output = imap_to_pool(_rdf_of_frames, inpargs)
+    else:
+        output = (_rdf_of_frames(*inp) for inp in inpargs)
+    nframes, gofr, neighbors = 0, np.zeros((len(pairs), 3, nbins)), np.zeros((len(pairs), 3, nbins))
+    for framecount, framegofr, frameneighbors in output:
+        nframes += framecount
+        gofr += framegofr
+        neighbors += frameneighbors
+    edges = np.arange(nbins+1) * binsize
+    ringarea = np.pi * (edges[1:]**2 - edges[:-1]**2)
+    gofr /= max(nframes, 1) * ringarea
+    coordination = np.cumsum(neighbors, axis=2) / max(nframes, 1)
+    tables = {}
+    for pair, (ref, sel) in enumerate(pairs):
+        table = pd.DataFrame({"r":(edges[1:] + edges[:-1]) / 2, "r_outer":edges[1:]})
+        for i, label in enumerate(["_0", "_1", ""]):
+            table["g"+label] = gofr[pair, i]
+            table["cn"+label] = coordination[pair, i]
+        tables[(ref, sel)] = table
+    return tables
+
+def write_rdf_pairs(sysinfo, pairs, binsize=0.002, rmax=None, refprot=False, parallel=True):
+    ''' Writes the results of rdf_pairs to <datapath>/rdf/ with the two column layout of gmx rdf -xvg none
+            rdf_<ref>-<sel>.xvg, nr_<ref>-<sel>.xvg           both leaflets
+            rdf_<ref>-<sel>_leaflet<0|1>.xvg, nr_...          single leaflets
+        Returns the tables of rdf_pairs
+    '''
+    os.makedirs(sysinfo.datapath+'/rdf', exist_ok=True)
+    tables = rdf_pairs(sysinfo, pairs, binsize=binsize, rmax=rmax, refprot=refprot, parallel=parallel)
+    for (ref, sel), table in tables.items():
+        for label, suffix in (("", ""), ("_0", "_leaflet0"), ("_1", "_leaflet1")):
+            outputfile = '{}/rdf/rdf_{}-{}{}.xvg'.format(sysinfo.datapath, ref, sel, suffix).replace(" ", "")
+            outputfile_cn = '{}/rdf/nr_{}-{}{}.xvg'.format(sysinfo.datapath, ref, sel, suffix).replace(" ", "")
+            np.savetxt(outputfile, table[["r", "g"+label]].to_numpy(), fmt="%10.4f")
+            np.savetxt(outputfile_cn, table[["r_outer", "cn"+label]].to_numpy(), fmt="%10.4f")
+    return tables
+
+
 ############################# DEPRECATED ###########################################
 
 #class calc_rdf_selfimplementation(SysInfo):
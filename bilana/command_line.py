@@ -11,16 +11,25 @@ from .systeminfo import SysInfo
 
 def submit_energycalcs(systemname, temperature, jobname, lipidpart, *args,
     inputfilename="inputfile",
-    neighborfile="neighbor_info",
+    neighborfilename="neighbor_info",
     startdivisor=80,
     overwrite=False,
     cores=2,
     dry=False,
+    fragsize=None,
     **kwargs,):
-    ''' Divide energyruns into smaller parts for faster computation and submit those runs '''
+    ''' Divide energyruns into smaller parts for faster computation and submit those runs
+        fragsize sets the number of neighbors per energy run (default: Energy.DENOMINATOR)
+        If dry is set, the jobscripts are written but not submitted and the expected costs of the
+        calculation are printed (see plan_energycalcs).
+    '''
     complete_name = './{}_{}'.format(systemname, temperature)
     os.chdir(complete_name)
     mysystem = SysInfo(inputfilename)
+    if dry:
+        from .analysis.energy import Energy
+        _print_energy_plan(Energy(lipidpart, inputfilename=inputfilename, neighborfilename=neighborfilename,
+            denominator=fragsize), startdivisor)
     systemsize = mysystem.number_of_lipids
     divisor = get_minmaxdiv(startdivisor, systemsize)
     if divisor % 1 != 0:
@@ -38,10 +47,10 @@ def submit_energycalcs(systemname, temperature, jobname, lipidpart, *args,
             print(
                 '\nimport os, sys'
                 '\nfrom bilana.analysis.energy import Energy'
-                '\nenergy_instance = Energy("{0}", overwrite={1}, inputfilename="{2}", neighborfilename="{3}")'
+                '\nenergy_instance = Energy("{0}", overwrite={1}, inputfilename="{2}", neighborfilename="{3}", denominator={5})'
                 '\nenergy_instance.info()'
                 '\nenergy_instance.run_calculation(resids={4})'
-                '\nos.remove(sys.argv[0])'.format(lipidpart, overwrite, inputfilename, neighborfile, list_of_res),
+                '\nos.remove(sys.argv[0])'.format(lipidpart, overwrite, inputfilename, neighborfilename, list_of_res, fragsize),
                 file=jobf)
         if not dry:
             write_submitfile('submit.sh', jobfile_name, ncores=cores)
@@ -50,18 +59,65 @@ def submit_energycalcs(systemname, temperature, jobname, lipidpart, *args,
             out, err = proc.communicate()
             print(out.decode(), err.decode())
 
+def plan_energycalcs(systemname, temperature, jobname, lipidpart, *args,
+    inputfilename="inputfile",
+    neighborfilename="neighbor_info",
+    startdivisor=80,
+    walltime=48,
+    calibrate=False,
+    fragsize=None,
+    **kwargs,):
+    ''' Estimate number of reruns, disk usage and wall time of submit_energycalcs
+        The estimate is written to energy_plan.dat. If calibrate is set, one energy run is timed
+        and a divisor/fragment size is suggested that finishes within walltime (in h).
+    '''
+    from .analysis.energy import Energy
+    complete_name = './{}_{}'.format(systemname, temperature)
+    os.chdir(complete_name)
+    energy_instance = Energy(lipidpart, inputfilename=inputfilename, neighborfilename=neighborfilename,
+        denominator=fragsize)
+    calibration = energy_instance.calibrate() if calibrate else None
+    print("System and temperature:", systemname, temperature)
+    _print_energy_plan(energy_instance, startdivisor, walltime=walltime, calibration=calibration)
+
+def _print_energy_plan(energy_instance, startdivisor, walltime=None, calibration=None):
+    ''' Prints the totals of Energy.plan_calculation (also written to energy_plan.dat) '''
+    _, totals, suggestion = energy_instance.plan_calculation(
+        walltime=None if walltime is None else float(walltime)*3600,
+        calibration=calibration, startdivisor=startdivisor)
+    print("Fragment size:", energy_instance.denominator)
+    print("Energy runs:", int(totals.reruns))
+    print("Frames decoded:", int(totals.frames))
+    print("Disk usage edr/xvg in GB: {:.2f} {:.2f}".format(totals.edr_bytes/1e9, totals.xvg_bytes/1e9))
+    if calibration is not None:
+        print("CPU time in h: {:.2f}".format(totals.walltime/3600))
+        if suggestion is not None:
+            print("Suggested setting: --divisor {divisor} --fragsize {denominator}"
+                " (longest job {0:.2f} h)".format(suggestion["makespan"]/3600, **suggestion))
+        else:
+            print("No setting found that finishes within {} h".format(walltime))
+
 def submit_energycalc_leaflet(systemname, temperature, jobname, *args,
     inputfilename="inputfile",
-    neighborfile="neighbor_info",
+    neighborfilename="neighbor_info",
     startdivisor=80,
     overwrite=False,
     cores=2,
     dry=False,
+    fragsize=None,
     **kwargs,):
-    ''' Divide energyruns into smaller parts for faster computation and submit those runs '''
+    ''' Divide energyruns into smaller parts for faster computation and submit those runs
+        fragsize sets the number of neighbors per energy run (default: Energy.DENOMINATOR)
+        If dry is set, the jobscripts are written but not submitted and the expected costs of the
+        calculation are printed (see plan_energycalcs).
+    '''
     complete_name = './{}_{}'.format(systemname, temperature)
     os.chdir(complete_name)
     mysystem = SysInfo(inputfilename)
+    if dry:
+        from .analysis.energy import Energy
+        _print_energy_plan(Energy("complete", inputfilename=inputfilename, neighborfilename=neighborfilename,
+            denominator=fragsize), startdivisor)
     systemsize = mysystem.number_of_lipids
     divisor = get_minmaxdiv(startdivisor, systemsize)
     if divisor % 1 != 0:
@@ -82,7 +138,7 @@ def submit_energycalc_leaflet(systemname, temperature, jobname, *args,
                 '\nenergy_instance = Energy("complete", overwrite={0}, inputfilename="{1}", neighborfilename="{2}")'
                 '\nenergy_instance.info()'
                 '\nenergy_instance.run_lip_leaflet_interaction(resids={3})'
-                '\nos.remove(sys.argv[0])'.format(overwrite, inputfilename, neighborfile, list_of_res),
+                '\nos.remove(sys.argv[0])'.format(overwrite, inputfilename, neighborfilename, list_of_res),
                 file=jobf)
         if not dry:
             write_submitfile('submit.sh', jobfile_name, ncores=cores)
@@ -168,14 +224,12 @@ def calc_scd(systemname, temperature, jobname, *args,
     with open(scriptfilename, 'w') as scriptf:
         print(
             'import os, sys, gc'
-            '\nfrom bilana.systeminfo import SysInfo'
-            '\nfrom bilana.analysis.order import Order, calc_tilt'
-            '\ncalc_tilt(SysInfo())'
-            '\nOrder(inputfilename="{0}").create_orderfile(parallel=False)'
+            '\nfrom bilana.analysis.order import Order'
+            '\nOrder(inputfilename="{0}").create_orderfile(parallel=True)'
             '\nos.remove(sys.argv[0])'.format(inputfilename),
             file=scriptf)
         if not dry:
-            write_submitfile('submit.sh', jobfilename, mem='100G', ncores=16, prio=False)
+            write_submitfile('submit.sh', jobfilename, mem='16G', ncores=16, prio=False)
             cmd = ['sbatch', '-J', jobfilename, 'submit.sh','python3', scriptfilename]
             proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             out, err = proc.communicate()
@@ -208,9 +262,9 @@ def check_and_write(systemname, temperature, jobname, lipidpart, *args,
             '\nenergy_instance = Energy("{0}", overwrite={1}, inputfilename="{2}", neighborfilename="{3}")'
             '\nenergy_instance.info()'
             '\nif energy_instance.check_exist_xvgs(check_len=energy_instance.universe.trajectory[-1].time):'
-            '\n    energy_instance.write_energyfile()'
-            '\n    eofs = EofScd("{0}", inputfilename="{2}", energyfilename="{4}", scdfilename="{5}")'
-            '\n    eofs.create_eofscdfile()'.format(lipidpart, overwrite,
+            '\n    if not energy_instance.write_energyfile():'
+            '\n        eofs = EofScd("{0}", inputfilename="{2}", energyfilename="{4}", scdfilename="{5}")'
+            '\n        eofs.create_eofscdfile()'.format(lipidpart, overwrite,
                 inputfilename, neighborfilename, energyfilename, scdfilename),
             file=scriptf)
         if not dry:
@@ -220,6 +274,31 @@ def check_and_write(systemname, temperature, jobname, lipidpart, *args,
             out, err = proc.communicate()
             print(out.decode(), err.decode())
 
+def compact_energyfiles(systemname, temperature, jobname, lipidpart, *args,
+    inputfilename="inputfile",
+    neighborfilename="neighbor_info",
+    dry=False,
+    **kwargs,):
+    ''' Remove verified .tpr/.mdp files and pack .xvg/.edr/.log files of energy calculation into archives '''
+    complete_systemname = './{}_{}'.format(systemname, temperature)
+    os.chdir(complete_systemname)
+    scriptfilename = 'exec'+complete_systemname[2:]+jobname+'.py'
+    jobfilename = complete_systemname[2:]+"_"+jobname
+    with open(scriptfilename, 'w') as scriptf:
+        print(
+            'import os, sys'
+            '\nfrom bilana.analysis.energy import Energy'
+            '\nenergy_instance = Energy("{0}", inputfilename="{1}", neighborfilename="{2}")'
+            '\nenergy_instance.compact_storage()'
+            '\nos.remove(sys.argv[0])'.format(lipidpart, inputfilename, neighborfilename),
+            file=scriptf)
+        if not dry:
+            write_submitfile('submit.sh', jobfilename, ncores=8)
+            cmd = ['sbatch', '-J', jobfilename, 'submit.sh','python3', scriptfilename]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            print(out.decode(), err.decode())
+
 def write_eofscd(systemname, temperature, jobname, lipidpart, *args,
     inputfilename="inputfile",
     neighborfilename="neighbor_info",
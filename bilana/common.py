@@ -4,6 +4,7 @@
 import os, sys
 import numpy as np
 import subprocess
+from collections import deque
 from multiprocessing import Pool
 
 def find_executable(executable, path=None):
@@ -57,6 +58,84 @@ def loop_to_pool(func, inp, maxtasknum=1000):
     pool.join()
     return data_outputs
 
+def minimum_image(vectors, box):
+    ''' Applies minimum image convention to difference vectors (..., 3)
+        box is given as MDAnalysis dimensions [lx, ly, lz, alpha, beta, gamma]
+        Vectors shorter than half the box (e.g. bonds) are returned unchanged
+    '''
+    if box is None:
+        return vectors
+    box = np.asarray(box, dtype=vectors.dtype)
+    if np.all(box[3:] == 90.):
+        return vectors - box[:3] * np.round(vectors / box[:3])
+    from MDAnalysis.lib.distances import minimize_vectors
+    return minimize_vectors(vectors.reshape(-1, 3), box).reshape(vectors.shape)
+
+def frame_ranges(nframes, nranges):
+    ''' Splits range(nframes) into at most nranges contiguous (start, stop) tuples of similar size '''
+    bounds = np.linspace(0, nframes, min(nranges, nframes)+1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def imap_to_pool(func, inp, maxtasknum=1000, window=None):
+    ''' Like loop_to_pool but yields results in order of inp as soon as they are ready
+        At most window tasks (default: 2 x number of cores) are submitted at once, a new task is only
+        submitted when the oldest result was yielded. So at most window results are held in memory.
+    '''
+    ncores = len(os.sched_getaffinity(0))
+    window = 2 * ncores if window is None else window
+    with Pool(ncores, maxtasksperchild=maxtasknum) as pool:
+        pending = deque()
+        for args in inp:
+            if len(pending) >= window:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, args))
+        while pending:
+            yield pending.popleft().get()
+
+_UNIVERSES = {}
+def cached_universe(*files):
+    ''' Returns MDAnalysis Universe of files, each process opens it only once
+        Workers use it to read the trajectory themselves instead of receiving pickled AtomGroups
+    '''
+    if files not in _UNIVERSES:
+        import MDAnalysis as mda
+        _UNIVERSES[files] = mda.Universe(*files)
+    return _UNIVERSES[files]
+
+def truncate_npy(filename, nrows, ncols=None, batchsize=1024):
+    ''' Shrinks first dimension of .npy file filename to nrows in place, the header keeps its length
+        If ncols is given, also the second dimension of a 2D (C ordered) file is shrunk to ncols. The rows
+        are then moved to their new position in batches of batchsize rows.
+    '''
+    with open(filename, "rb") as npy:
+        version = np.lib.format.read_magic(npy)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy)
+        offset = npy.tell()
+    newshape = (nrows,)+tuple(shape[1:])
+    if ncols is not None:
+        if len(shape) != 2 or fortran_order:
+            raise ValueError("Columns can only be truncated for 2D arrays in C order")
+        newshape = (nrows, ncols)
+        if ncols != shape[1] and nrows > 0:
+            # Rows only move towards the start of the file, so rows that are not yet moved are never overwritten
+            data = np.memmap(filename, dtype=dtype, mode="r+", offset=offset, shape=(shape[0]*shape[1],))
+            for start in range(0, nrows, batchsize):
+                stop = min(start+batchsize, nrows)
+                rows = np.array(data[start*shape[1]:stop*shape[1]]).reshape(-1, shape[1])
+                data[start*ncols:stop*ncols] = rows[:, :ncols].ravel()
+            data.flush()
+            del data
+    with open(filename, "r+b") as npy:
+        header = "{{'descr': {!r}, 'fortran_order': {}, 'shape': {}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), fortran_order, newshape)
+        headerstart = 8 + (2 if version == (1, 0) else 4)
+        npy.seek(headerstart)
+        npy.write(header.ljust(offset - headerstart - 1).encode("latin1") + b"\n")
+        npy.truncate(offset + int(np.prod(newshape, dtype=int)) * dtype.itemsize)
+
 def exec_gromacs(cmd, inp_str=None):
     '''
         Execute Gromacs commands.
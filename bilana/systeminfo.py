@@ -12,6 +12,7 @@
 
 import os
 import re
+from collections.abc import Mapping
 import numpy as np
 import pandas as pd
 import MDAnalysis as mda
@@ -23,6 +24,51 @@ LOGGER = log.LOGGER
 INPUTFILENAME = 'inputfile'
 
 
+class LeafletAssignment(Mapping):
+    ''' Read only mapping resid -> leaflet (0 | 1), stored as sorted resid and int8 leaflet arrays
+        leaflets_of gives the leaflets of many resids at once.
+    '''
+    def __init__(self, resids=(), leaflets=()):
+        resids = np.asarray(resids, dtype=int)
+        order = np.argsort(resids, kind="stable")
+        self.resids = resids[order]
+        self.leaflets = np.asarray(leaflets, dtype=np.int8)[order]
+        self._position = dict(zip(self.resids.tolist(), range(len(self.resids))))
+
+    def __getitem__(self, resid):
+        return int(self.leaflets[self._position[resid]])
+
+    def __iter__(self):
+        return iter(self.resids.tolist())
+
+    def __len__(self):
+        return len(self.resids)
+
+    def __repr__(self):
+        return "LeafletAssignment({} residues, {} in leaflet 0)".format(len(self), np.count_nonzero(self.leaflets == 0))
+
+    def leaflets_of(self, resids):
+        ''' Leaflets of array of resids, raises KeyError if a resid is not assigned '''
+        resids = np.asarray(resids, dtype=int)
+        ndx = np.minimum(np.searchsorted(self.resids, resids), max(len(self.resids)-1, 0))
+        if not len(self.resids) or (self.resids[ndx] != resids).any():
+            missing = resids if not len(self.resids) else resids[self.resids[ndx] != resids]
+            raise KeyError("Residues without leaflet: {}".format(missing[:10].tolist()))
+        return self.leaflets[ndx]
+
+    @classmethod
+    def from_file(cls, filename="leaflet_assignment.dat"):
+        ''' Reads file with header and columns resid leaflet (see leaflets.create_leaflet_assignment_file) '''
+        table = np.loadtxt(filename, skiprows=1, dtype=int, ndmin=2)
+        return cls(table[:, 0], table[:, 1])
+
+    def write(self, filename="leaflet_assignment.dat"):
+        with open(filename, "w") as outf:
+            print("{: <7} {: <5}".format('resid', 'leaflet'), file=outf) # HEADER
+            for resid, leaflet in zip(self.resids, self.leaflets):
+                print("{: <7} {: <5}".format(resid, leaflet), file=outf)
+
+
 class SysInfo():
     ''' Gather all relevant information about the system to analyse
     Info about:
@@ -31,7 +77,7 @@ class SysInfo():
         -Important dictionaries:
             resid_to_lipid[resid] --> str(resname)
             index_to_resid[ndx] --> int(resid)
-            res_to_leaflet[resid] --> int(0 | 1)
+            res_to_leaflet[resid] --> int(0 | 1) (LeafletAssignment)
         -number of lipids in system
         -number of atoms of lipids in system
 
@@ -258,21 +304,14 @@ class SysInfo():
         '''
             Reads file leaflet_assignment created with function
             mainanalysis.create_leaflet_assignment_file
-            and returns dictionary res:leaflet_ind
+            and returns LeafletAssignment res:leaflet_ind
         '''
-        outdict = {}
         try:
-            with open("leaflet_assignment.dat", "r") as lfile:
-                lfile.readline()
-                for line in lfile:
-                    cols = line.split()
-                    res = int(cols[0])
-                    leaflet = int(cols[1])
-                    outdict[res] = leaflet
+            return LeafletAssignment.from_file("leaflet_assignment.dat")
         except FileNotFoundError:
             LOGGER.warning('File "leaflet_assignment.dat" does not exist.\n'
                   'Consider creating it using mainanalysis.create_leaflet_assignment_file()')
-        return outdict
+        return LeafletAssignment()
 
     def assign_res_to_leaflet_prot(self, inputfilename="leaflet_assignment_prot.csv"):
         try:
@@ -353,5 +392,5 @@ class SysInfo():
         # overwrite old dicts
         self.MOLRANGE = self.resids = new_resids
         self.resid_to_lipid = new_resid_to_lipid
-        self.res_to_leaflet = new_res_to_leaflet
+        self.res_to_leaflet = LeafletAssignment(list(new_res_to_leaflet.keys()), list(new_res_to_leaflet.values()))
         self.index_to_resid = new_index_to_resid
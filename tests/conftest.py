@@ -0,0 +1,61 @@
+'''
+    Shared fixtures of the tests
+    The fake gmx of benchmarks/fakegmx.py is put in front of PATH before bilana is imported (bilana looks
+    up gmx on import), so the gromacs based workflows run without gromacs on the synthetic bilayer of
+    benchmarks/synthetic_system.py.
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+sys.path.insert(0, BENCHMARKS)
+import fakegmx
+
+FAKEGMX_BIN = tempfile.mkdtemp(prefix="bilana_fakegmx_")
+os.environ["PATH"] = os.path.dirname(fakegmx.install(FAKEGMX_BIN)) + os.pathsep + os.environ["PATH"]
+
+def pytest_unconfigure(config):
+    shutil.rmtree(FAKEGMX_BIN, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def energy_system():
+    ''' Folder with the synthetic bilayer (8 lipids, 4 frames), its leaflet assignment, neighbor_info,
+        index file and the .edr and .xvg files of the reruns of all residues (part complete)
+        The inputfile parser does not accept "-" in paths, so it is not created in the pytest tmp_path.
+    '''
+    import synthetic_system
+    from bilana.systeminfo import SysInfo
+    from bilana.analysis import leaflets
+    from bilana.analysis.neighbors import Neighbors
+    from bilana.analysis.energy import Energy
+    root = tempfile.mkdtemp(prefix="bilana_energy_")
+    inputfile = synthetic_system.write_system(root, ngrid=2, nframes=4)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        sysinfo = SysInfo(inputfile)
+        with open(sysinfo.tprpath, "w") as tpr:
+            print(fakegmx.TPR_MAGIC, file=tpr)
+            print(json.dumps({"structure":sysinfo.gropath, "topology":None, "index":None, "energygrps":[]}), file=tpr)
+        leaflets.create_leaflet_assignment_file(sysinfo)
+        neibs = Neighbors(inputfile)
+        synthetic_system.write_neighbor_info(neibs)
+        neibs.create_indexfile()
+        energy = Energy("complete", inputfilename=inputfile, denominator=3, verbosity="WARNING")
+        energy.run_calculation(energy.MOLRANGE)
+    finally:
+        os.chdir(cwd)
+    yield root
+    shutil.rmtree(root)
+
+@pytest.fixture
+def energy_workdir(energy_system, tmp_path, monkeypatch):
+    ''' Copy of energy_system as working directory, tests may change or remove its files '''
+    workdir = tmp_path / "system"
+    shutil.copytree(energy_system, workdir)
+    monkeypatch.chdir(workdir)
+    return workdir
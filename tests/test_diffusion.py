@@ -0,0 +1,69 @@
+''' Diffusion coefficients and their bootstrap confidence intervals for random walks with known D '''
+import numpy as np
+import pytest
+
+from bilana.systeminfo import LeafletAssignment
+from bilana.analysis.msd import msd_fft
+from bilana.analysis.diffusion import (Diffusion, fit_window, fit_diffusion, bootstrap_diffusion,
+    NM2_PER_PS_IN_1E5_CM2_PER_S)
+
+
+def random_walk_msd(nlipids, nframes, diffusion, dt=1.0, seed=0):
+    ''' MSD (lipid, lag) of 2D random walks with diffusion coefficient diffusion '''
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, np.sqrt(2 * diffusion * dt), (nframes, nlipids, 2))
+    return msd_fft(np.cumsum(steps, axis=0)).astype(float)
+
+def test_fit_of_linear_msd():
+    lags = np.arange(100) * 20.0
+    msd = np.array([4 * 0.3 * lags + 0.1, 4 * 0.05 * lags])
+    np.testing.assert_allclose(fit_diffusion(lags, msd), [0.3, 0.05])
+    with pytest.raises(ValueError):
+        fit_window(lags[:3], fitrange=(0.6, 0.9))
+
+def test_bootstrap_interval_contains_true_coefficient():
+    lags = np.arange(200.0)
+    window = fit_window(lags)
+    msd = random_walk_msd(200, len(lags), 0.02)
+    low, high = bootstrap_diffusion(msd, lags, window, nboot=500, seed=1, parallel=False)
+    assert low < fit_diffusion(lags, msd.mean(axis=0), window)[0] < high
+    assert low < 0.02 < high
+    assert (high - low) < 0.5 * 0.02
+    # Bounds of a seed do not depend on the parallelization, a smaller confidence gives a narrower interval
+    assert bootstrap_diffusion(msd, lags, window, nboot=500, seed=1, parallel=True) == (low, high)
+    narrow = bootstrap_diffusion(msd, lags, window, nboot=500, confidence=0.5, seed=1, parallel=False)
+    assert low < narrow[0] < narrow[1] < high
+
+def test_bootstrap_of_identical_lipids_has_no_spread():
+    lags = np.arange(50.0)
+    msd = np.tile(4 * 0.01 * lags, (10, 1))
+    low, high = bootstrap_diffusion(msd, lags, fit_window(lags), nboot=250, seed=0, parallel=False)
+    assert low == pytest.approx(0.01) and high == pytest.approx(0.01)
+
+def test_coefficients_per_type_and_leaflet():
+    diffusion = Diffusion.__new__(Diffusion)
+    nframes = 150
+    diffusion.times = 1000.0 + 10.0 * np.arange(nframes)
+    diffusion.resids = np.arange(1, 121)
+    diffusion.resid_to_lipid = {res:("CHL1" if res % 3 == 0 else "DPPC") for res in diffusion.resids}
+    diffusion.res_to_leaflet = LeafletAssignment(diffusion.resids, diffusion.resids > 60)
+    true_d = {("DPPC", 0):1e-4, ("DPPC", 1):2e-4, ("CHL1", 0):5e-5, ("CHL1", 1):1e-4}
+    msd = np.empty((len(diffusion.resids), nframes))
+    for seed, ((lipid, leaflet), value) in enumerate(true_d.items()):
+        ingroup = np.array([diffusion.resid_to_lipid[res] == lipid for res in diffusion.resids]) \
+            & (diffusion.res_to_leaflet.leaflets_of(diffusion.resids) == leaflet)
+        msd[ingroup] = random_walk_msd(ingroup.sum(), nframes, value, dt=10.0, seed=seed)
+
+    coefficients = diffusion.diffusion_coefficients(msd, nboot=200, seed=0, parallel=False)
+
+    assert len(coefficients) == 4
+    assert coefficients["nlipids"].sum() == len(diffusion.resids)
+    for row in coefficients.itertuples():
+        expected = true_d[(row.type, row.leaflet)] * NM2_PER_PS_IN_1E5_CM2_PER_S
+        assert row.D_low < row.D < row.D_high
+        assert row.D == pytest.approx(expected, rel=0.3)
+    lipids = diffusion.lipid_diffusion(msd)
+    assert list(lipids["resid"]) == list(diffusion.resids)
+    grouped = lipids.groupby(["type", "leaflet"])["D"].mean()
+    for row in coefficients.itertuples():
+        assert grouped[(row.type, row.leaflet)] == pytest.approx(row.D)
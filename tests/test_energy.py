@@ -0,0 +1,90 @@
+''' Energy workflow on the synthetic bilayer with the fake gmx (see conftest.py) '''
+import os
+import io
+import glob
+import numpy as np
+import pandas as pd
+
+from bilana.analysis.energy import Energy, read_xvg
+from bilana.analysis.energy_storage import archive_location
+
+
+def _energy(**kwargs):
+    return Energy("complete", inputfilename="inputfile", denominator=3, verbosity="WARNING", **kwargs)
+
+def _xvgfile(energy, resid, fragment=0):
+    return "{}xvgtables/energies_residue{}_{}{}.xvg".format(energy.energypath, resid, fragment, energy.part)
+
+def test_xvg_is_regenerated_from_archived_edr(energy_workdir):
+    energy = _energy(overwrite=False)
+    res = energy.MOLRANGE[0]
+    xvgfiles = sorted(glob.glob(energy.energypath+"xvgtables/energies_residue{}_*.xvg".format(res)))
+    expected = {xvgfile:read_xvg(xvgfile) for xvgfile in xvgfiles}
+    energy.compact_storage(policy={"pack":["edr"], "delete_inputs":False, "compress_logs":False}, parallel=False)
+    edrfile = energy.energypath+"edrfiles/energyfile_resid{}_0.edr".format(res)
+    assert not os.path.isfile(edrfile)
+    assert os.path.isfile(archive_location(edrfile)[0])
+    for xvgfile in xvgfiles:
+        os.remove(xvgfile)
+
+    energy.run_calculation([res])
+
+    # The rerun is skipped, gmx energy reads the edr extracted from the archive
+    assert not os.path.isfile(edrfile)
+    assert not any(fname.endswith(".edr") for fname in os.listdir(energy.temppath))
+    for xvgfile in xvgfiles:
+        legend, data = read_xvg(xvgfile)
+        assert legend == expected[xvgfile][0]
+        np.testing.assert_array_equal(data, expected[xvgfile][1])
+
+def test_energyfile_rows_follow_xvg_tables(energy_workdir):
+    energy = _energy()
+    assert energy.write_energyfile(submit_missing_data=False, parallel=False) == []
+    with open(energy.all_energies) as energyfile:
+        serial = energyfile.read()
+    assert energy.write_energyfile(submit_missing_data=False, parallel=True) == []
+    with open(energy.all_energies) as energyfile:
+        assert energyfile.read() == serial
+
+    # Rows are ordered by host, fragment, time and neighbor
+    expected = []
+    for resid in energy.MOLRANGE:
+        all_neibs_of_res = list(set([neib for t in energy.neiblist[resid] for neib in energy.neiblist[resid][t]]))
+        fragments = [all_neibs_of_res[i:i+energy.denominator] for i in range(0, len(all_neibs_of_res), energy.denominator)]
+        for fragment, neibs in enumerate(fragments):
+            legend, data = read_xvg(_xvgfile(energy, resid, fragment))
+            for row in data[data[:, 0] % energy.dt == 0]:
+                for neib in neibs:
+                    expected.append((row[0], resid, neib,
+                        row[legend.index('"LJ-SR:resid_{}-resid_{}"'.format(resid, neib))],
+                        row[legend.index('"Coul-SR:resid_{}-resid_{}"'.format(resid, neib))]))
+    expected = pd.DataFrame(expected, columns=["Time", "Host", "Neighbor", "VdW", "Coul"])
+    table = pd.read_csv(io.StringIO(serial), sep=r'\s+')
+    assert len(table) == len(expected)
+    for column in ["Time", "Host", "Neighbor"]:
+        np.testing.assert_array_equal(table[column].to_numpy(), expected[column].to_numpy())
+    # VdW and Coul are written with 5 decimals
+    for column in ["VdW", "Coul"]:
+        np.testing.assert_allclose(table[column].to_numpy(), expected[column].to_numpy(), rtol=0, atol=6e-6)
+    np.testing.assert_allclose(table["Etot"].to_numpy(), (expected["VdW"] + expected["Coul"]).to_numpy(), rtol=0, atol=2e-5)
+    assert (table["Molparts"] == "w_w").all()
+
+def test_missing_and_truncated_xvg_are_reported(energy_workdir):
+    energy = _energy()
+    missing, truncated, broken = energy.MOLRANGE[:3]
+    os.remove(_xvgfile(energy, missing))
+    with open(_xvgfile(energy, truncated)) as xvgfile:
+        lines = xvgfile.readlines()
+    with open(_xvgfile(energy, truncated), "w") as xvgfile:
+        xvgfile.writelines(lines[:-1])
+    with open(_xvgfile(energy, broken)) as xvgfile:
+        text = xvgfile.read()
+    with open(_xvgfile(energy, broken), "w") as xvgfile:
+        xvgfile.write(text[:-20])
+
+    issues = energy.write_energyfile(submit_missing_data=False, parallel=False)
+
+    assert sorted([(issue["resid"], issue["fragment"], issue["issue"]) for issue in issues]) == sorted([
+        (missing, 0, "unreadable"), (truncated, 0, "truncated"), (broken, 0, "unreadable")])
+    table = pd.read_csv(energy.all_energies, sep=r'\s+')
+    assert sorted(set(table["Host"])) == sorted(set(energy.MOLRANGE) - {missing, truncated, broken})
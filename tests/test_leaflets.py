@@ -0,0 +1,51 @@
+''' The static leaflet assignment gives the leaflets of the former gro file based implementation '''
+import types
+import pytest
+import MDAnalysis as mda
+
+import synthetic_system
+from bilana.definitions import lipidmolecules
+from bilana.systeminfo import LeafletAssignment
+from bilana.analysis.leaflets import (create_leaflet_assignment_file, leaflet_reference_index,
+    leaflets_of_positions, molecule_leaflet_orientation)
+
+MOLECULES = ["DPPC", "CHL1"]
+
+
+def reference_leaflets(atoms, positions):
+    ''' Leaflet of the vector from the last tail atom of the first chain to the central atom, as
+        calculated by the former create_leaflet_assignment_file
+    '''
+    leaflets = {}
+    for residue in atoms.select_atoms("resname {}".format(' '.join(MOLECULES))).residues:
+        mask = atoms.resids == residue.resid
+        head = positions[mask & (atoms.names == lipidmolecules.central_atom_of(residue.resname))][0]
+        base = positions[mask & (atoms.names == lipidmolecules.scd_tail_atoms_of(residue.resname)[0][-1])][0]
+        leaflets[residue.resid] = molecule_leaflet_orientation(head, base)
+    return leaflets
+
+@pytest.fixture(scope="module")
+def bilayer(tmp_path_factory):
+    root = tmp_path_factory.mktemp("bilayer")
+    synthetic_system.write_system(str(root), ngrid=3, nframes=3)
+    gropath = str(root / "mdfiles" / "initial_coords" / "{}.gro".format(synthetic_system.SYSTEM))
+    trjname = root / "mdfiles" / "md_trj" / "{}_{}.xtc".format(synthetic_system.SYSTEM, synthetic_system.TEMPERATURE)
+    return gropath, mda.Universe(gropath, str(trjname))
+
+def test_assignment_file_matches_reference(bilayer, tmp_path):
+    gropath, universe = bilayer
+    sysinfo = types.SimpleNamespace(gropath=gropath, molecules=MOLECULES)
+    outputfilename = str(tmp_path / "leaflet_assignment.dat")
+    assignment = create_leaflet_assignment_file(sysinfo, verbosity="WARNING", outputfilename=outputfilename)
+    expected = reference_leaflets(universe.atoms, mda.Universe(gropath).atoms.positions)
+    assert dict(assignment) == expected
+    assert dict(LeafletAssignment.from_file(outputfilename)) == expected
+    assert set(expected.values()) == {0, 1}
+
+def test_leaflets_of_wrapped_frames_match_reference(bilayer):
+    _, universe = bilayer
+    resids, _, *refinfo = leaflet_reference_index(universe.atoms, MOLECULES)
+    for ts in universe.trajectory:
+        expected = reference_leaflets(universe.atoms, ts.positions)
+        leaflets = leaflets_of_positions(ts.positions, *refinfo, box=ts.dimensions)
+        assert dict(zip(resids.tolist(), leaflets.tolist())) == expected
@@ -0,0 +1,75 @@
+''' Lateral MSD kernels on random walks with known statistics '''
+import numpy as np
+import pytest
+
+from bilana.analysis.msd import msd_fft, unwrap_lateral, remove_leaflet_drift, DisplacementAccumulator, log_lags
+
+
+def direct_msd(positions):
+    ''' MSD (particle, lag) as O(N^2) sum over all time origins '''
+    nframes = len(positions)
+    msd = np.zeros((positions.shape[1], nframes))
+    for lag in range(1, nframes):
+        msd[:, lag] = ((positions[lag:] - positions[:-lag])**2).sum(axis=2).mean(axis=0)
+    return msd
+
+def random_walk(nframes, nparticles, step=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(0, step, (nframes, nparticles, 2)), axis=0)
+
+@pytest.mark.parametrize("batchsize", [3, 256])
+def test_msd_fft_matches_direct_sum(batchsize):
+    positions = random_walk(57, 10)
+    np.testing.assert_allclose(msd_fft(positions, batchsize=batchsize), direct_msd(positions), rtol=1e-5, atol=1e-6)
+
+def test_non_gaussian_parameter_of_gaussian_steps():
+    nframes, step = 200, 0.1
+    positions = random_walk(nframes, 2000, step=step)
+    groups = np.arange(2000) % 2
+    accumulator = DisplacementAccumulator(groups, nframes, nlags=8)
+    msd = msd_fft(positions, accumulator=accumulator)
+    lags = log_lags(nframes, 8)
+    for group in (0, 1):
+        expected = msd[groups == group][:, lags].mean(axis=0)
+        np.testing.assert_allclose(accumulator.msd()[group], expected, rtol=1e-4)
+    np.testing.assert_allclose(accumulator.msd(), np.broadcast_to(2 * step**2 * lags, (2, len(lags))), rtol=0.1)
+    # Short lags have many independent samples, long lags only a few time origins
+    assert np.abs(accumulator.non_gaussian()[:, lags <= 20]).max() < 0.05
+    vanhove = accumulator.van_hove()
+    ringarea = np.pi * (accumulator.edges[1:]**2 - accumulator.edges[:-1]**2)
+    # Only displacements beyond rmax are missing in the normalization
+    beyond = accumulator.hist[..., -1] / accumulator.count
+    np.testing.assert_allclose((vanhove * ringarea).sum(axis=2), 1 - beyond, rtol=1e-10)
+    assert beyond[:, lags <= 20].max() == 0
+
+def test_unwrap_across_box_edge():
+    nframes, nparticles = 50, 6
+    box = np.array([3.0, 4.0])
+    boxes = np.tile(box, (nframes, 1))
+    # Particles move by up to a third of the box per frame and leave the box several times
+    velocity = np.random.default_rng(1).uniform(-1, 1, (nparticles, 2)) * box / 3
+    true_positions = 0.5 * box + np.arange(nframes)[:, None, None] * velocity
+    wrapped = (true_positions % box).astype(np.float32)
+    unwrapped = unwrap_lateral(wrapped.copy(), boxes, chunksize=7)
+    np.testing.assert_allclose(unwrapped, true_positions - true_positions[0] + wrapped[0], atol=1e-4)
+
+    accumulator = DisplacementAccumulator(np.zeros(nparticles, dtype=int), nframes, nlags=4, rmax=100.0, nbins=10)
+    accumulator.add(unwrapped.transpose(1, 0, 2))
+    expected = (velocity**2).sum(axis=1).mean() * accumulator.lags**2
+    np.testing.assert_allclose(accumulator.msd()[0], expected, rtol=1e-5)
+    assert accumulator.hist[..., -1].sum() == 0
+
+def test_remove_leaflet_drift():
+    nframes, nparticles = 40, 8
+    leaflets = np.arange(nparticles) % 2
+    weights = np.arange(1, nparticles+1, dtype=float)
+    positions = random_walk(nframes, nparticles, seed=2)
+    drift = np.cumsum(np.random.default_rng(3).normal(0, 0.5, (nframes, 2, 2)), axis=0)
+    drifting = positions + drift[:, leaflets]
+    corrected = remove_leaflet_drift(drifting.copy(), leaflets, weights, chunksize=9)
+    for leaflet in (0, 1):
+        inleaflet = leaflets == leaflet
+        com = np.average(corrected[:, inleaflet], axis=1, weights=weights[inleaflet])
+        np.testing.assert_allclose(com, np.broadcast_to(com[0], com.shape), atol=1e-10)
+        expected = positions[:, inleaflet] - np.average(positions[:, inleaflet], axis=1, weights=weights[inleaflet])[:, None]
+        np.testing.assert_allclose(corrected[:, inleaflet] - com[0], expected, atol=1e-10)
@@ -0,0 +1,68 @@
+''' The vectorized order parameter kernels give the numbers of the former per residue implementation '''
+import numpy as np
+import pytest
+import MDAnalysis as mda
+
+import synthetic_system
+from bilana.definitions import lipidmolecules
+from bilana.analysis.order import scd_bond_index, scd_of_bonds, scd_cc, leaflet_axes, ProfileAggregator
+
+
+def reference_profile(res, tailatms, atoms, positions, axis):
+    ''' S of every bond of each chain of res, as calculated by the former Order.get_order_profile '''
+    scds_of_tails = []
+    for tail in tailatms:
+        scds_of_tails.append([])
+        for atomindex in range(len(tail)-1):
+            mask1 = (atoms.names == tail[atomindex]) & (atoms.resids == res)
+            mask2 = (atoms.names == tail[atomindex+1]) & (atoms.resids == res)
+            diffvector = positions[mask2][0] - positions[mask1][0]
+            diffvector /= np.linalg.norm(diffvector)
+            cos_angle = np.dot(diffvector, axis)
+            scds_of_tails[-1].append(0.5 * ((3 * (cos_angle**2)) - 1))
+    return scds_of_tails
+
+def reference_scc(res, tailatms, atoms, positions, axis):
+    ''' Mean over chains of the mean S of the chain, as calculated by the former Order.scc_of_res '''
+    return np.array([np.mean(chain) for chain in reference_profile(res, tailatms, atoms, positions, axis)]).mean()
+
+@pytest.fixture(scope="module")
+def bilayer(tmp_path_factory):
+    root = tmp_path_factory.mktemp("bilayer")
+    synthetic_system.write_system(str(root), ngrid=3, nframes=3)
+    trjname = root / "mdfiles" / "md_trj" / "{}_{}_whole.xtc".format(synthetic_system.SYSTEM, synthetic_system.TEMPERATURE)
+    universe = mda.Universe(str(root / "mdfiles" / "initial_coords" / "{}.gro".format(synthetic_system.SYSTEM)), str(trjname))
+    resids = universe.residues.resids[np.isin(universe.residues.resnames, ["DPPC", "CHL1"])]
+    resid_to_lipid = dict(zip(universe.residues.resids, universe.residues.resnames))
+    return universe, resids, resid_to_lipid
+
+@pytest.mark.parametrize("new_axis", [None, np.array([[0.2, -0.1, 1.0], [-0.1, 0.3, -1.0]])])
+def test_scd_matches_reference(bilayer, new_axis):
+    universe, resids, resid_to_lipid = bilayer
+    bondinfo = scd_bond_index(universe.atoms, resids, resid_to_lipid)
+    bond_resids, resnames, bond_atoms, bond_mask = bondinfo
+    leaflets = (bond_resids > len(resids) // 2).astype(int)
+    if new_axis is not None:
+        new_axis = new_axis / np.linalg.norm(new_axis, axis=1, keepdims=True)
+    axes = leaflet_axes(new_axis, leaflets)
+    carbon_numbers = np.broadcast_to(np.arange(1, bond_mask.shape[2]+1), bond_mask.shape)
+    profile = ProfileAggregator(resnames, leaflets, carbon_numbers, bond_mask)
+    reference_values = {}
+    for ts in universe.trajectory:
+        scds = scd_of_bonds(ts.positions, bond_atoms, bond_mask, axes)
+        profile.add(scds[None])
+        for resndx, res in enumerate(bond_resids):
+            tailatms = lipidmolecules.scd_tail_atoms_of(resnames[resndx])
+            axis = axes[resndx]
+            expected = reference_scc(res, tailatms, universe.atoms, ts.positions, axis)
+            assert scd_cc(scds)[resndx] == pytest.approx(expected, abs=1e-6)
+            for chain, values in enumerate(reference_profile(res, tailatms, universe.atoms, ts.positions, axis)):
+                for bond, value in enumerate(values):
+                    key = (resnames[resndx], leaflets[resndx], chain, bond)
+                    reference_values.setdefault(key, []).append(value)
+    for (resname, leaflet, chain, bond), values in reference_values.items():
+        keyndx = profile.keys.index((resname, leaflet))
+        assert profile.count[keyndx, chain, bond] == len(values)
+        mean = profile.sums[keyndx, chain, bond] / profile.count[keyndx, chain, bond]
+        assert mean == pytest.approx(np.mean(values), abs=1e-6)
+    assert profile.count.sum() == sum([len(values) for values in reference_values.values()])
@@ -0,0 +1,59 @@
+''' Order parameters of bonds that are split by periodic boundaries must equal those of whole molecules '''
+import numpy as np
+import pytest
+
+from bilana.analysis.order import scd_of_bonds, scd_cc
+
+
+def _chains_across_boundary(box, nres=4, nchains=2, natoms=8, seed=0):
+    ''' Random walk chains that start close to the box edges, so most of them leave the box
+        Returns whole positions, bond_atoms and bond_mask as created by scd_bond_index
+    '''
+    rng = np.random.default_rng(seed)
+    starts = box[:3] * (1 - rng.uniform(0, 0.05, size=(nres*nchains, 3)))
+    steps = rng.normal(size=(nres*nchains, natoms, 3))
+    steps *= 1.5 / np.linalg.norm(steps, axis=-1, keepdims=True)
+    positions = (starts[:, None, :] + np.cumsum(steps, axis=1)).reshape(-1, 3)
+    atoms = np.arange(len(positions)).reshape(nres, nchains, natoms)
+    bond_atoms = np.stack([atoms[..., :-1], atoms[..., 1:]], axis=-1)
+    bond_mask = np.ones(bond_atoms.shape[:-1], dtype=bool)
+    # Last chain of first residue is shorter, padding must stay nan
+    bond_mask[0, -1, -2:] = False
+    return positions, bond_atoms, bond_mask
+
+def _wrap(positions, box):
+    ''' Puts positions of an orthorhombic box back into the primary cell '''
+    return positions % box[:3]
+
+@pytest.mark.parametrize("axes", [None, np.array([[0.1, -0.2, 1.0], [0.0, 0.3, -1.0]])])
+def test_scd_of_split_bonds_equals_whole(axes):
+    box = np.array([30., 30., 60., 90., 90., 90.])
+    positions, bond_atoms, bond_mask = _chains_across_boundary(box)
+    wrapped = _wrap(positions, box)
+    split = np.linalg.norm(wrapped[bond_atoms[..., 1]] - wrapped[bond_atoms[..., 0]], axis=-1) > box[:3].min()/2
+    assert split[bond_mask].any(), "Synthetic system contains no split bonds"
+    leaflets = np.arange(bond_atoms.shape[0]) % 2
+    if axes is None:
+        res_axes = np.tile([0., 0., 1.], (len(leaflets), 1))
+    else:
+        axes = axes / np.linalg.norm(axes, axis=-1, keepdims=True)
+        res_axes = axes[leaflets]
+    whole = scd_of_bonds(positions, bond_atoms, bond_mask, res_axes)
+    corrected = scd_of_bonds(wrapped, bond_atoms, bond_mask, res_axes, box=box)
+    uncorrected = scd_of_bonds(wrapped, bond_atoms, bond_mask, res_axes)
+    np.testing.assert_allclose(corrected, whole, atol=1e-10)
+    np.testing.assert_allclose(scd_cc(corrected), scd_cc(whole), atol=1e-10)
+    assert np.isnan(corrected[~bond_mask]).all()
+    assert not np.allclose(uncorrected[bond_mask], whole[bond_mask])
+
+def test_scd_of_split_bonds_triclinic():
+    box = np.array([30., 30., 60., 90., 90., 60.])
+    positions, bond_atoms, bond_mask = _chains_across_boundary(box, seed=1)
+    # Shift every atom by a random lattice vector, this splits bonds like wrapping does
+    vectors = np.array([[30., 0., 0.], [15., 30.*np.sqrt(3)/2, 0.], [0., 0., 60.]])
+    shifts = np.random.default_rng(1).integers(-1, 2, size=(len(positions), 3)) @ vectors
+    res_axes = np.tile([0., 0., 1.], (bond_atoms.shape[0], 1))
+    whole = scd_of_bonds(positions, bond_atoms, bond_mask, res_axes)
+    corrected = scd_of_bonds(positions + shifts, bond_atoms, bond_mask, res_axes, box=box)
+    # MDAnalysis minimizes triclinic vectors in single precision
+    np.testing.assert_allclose(corrected, whole, atol=1e-5)
@@ -0,0 +1,56 @@
+''' Lateral RDF of uniformly distributed atoms is 1 at all distances '''
+import types
+import numpy as np
+import pytest
+import MDAnalysis as mda
+
+from bilana.systeminfo import LeafletAssignment
+from bilana.analysis.rdf import rdf_pairs
+
+BOX, NATOMS, NFRAMES = 50.0, 120, 100
+
+
+@pytest.fixture(scope="module")
+def uniform_system(tmp_path_factory):
+    ''' NATOMS single atom residues at uniform random lateral positions in each frame, odd resids in leaflet 1 '''
+    root = tmp_path_factory.mktemp("uniform")
+    rng = np.random.default_rng(0)
+    u = mda.Universe.empty(NATOMS, n_residues=NATOMS, atom_resindex=np.arange(NATOMS), trajectory=True)
+    u.add_TopologyAttr("names", ["P"]*NATOMS)
+    u.add_TopologyAttr("resnames", ["DPPC"]*NATOMS)
+    u.add_TopologyAttr("resids", np.arange(1, NATOMS+1))
+    u.dimensions = [BOX, BOX, BOX, 90, 90, 90]
+    leaflets = np.arange(1, NATOMS+1) % 2
+    gropath, trjpath = str(root / "uniform.gro"), str(root / "uniform.xtc")
+    with mda.Writer(trjpath, NATOMS) as trj:
+        for frame in range(NFRAMES):
+            u.atoms.positions = np.column_stack([rng.uniform(0, BOX, (NATOMS, 2)), 10 + 30*leaflets])
+            u.trajectory.ts.time = frame * 10.0
+            trj.write(u.atoms)
+            if not frame:
+                u.atoms.write(gropath)
+    return types.SimpleNamespace(universe=mda.Universe(gropath, trjpath), gropath=gropath, t_start=0,
+        t_end=NFRAMES*10.0, res_to_leaflet=LeafletAssignment(np.arange(1, NATOMS+1), leaflets))
+
+@pytest.mark.parametrize("pair", [("name P", "name P"), ("resid 1:60", "resid 61:120"), ("resid 1:80", "resid 41:120")])
+def test_rdf_of_uniform_positions(uniform_system, pair):
+    table = rdf_pairs(uniform_system, [pair], binsize=0.25, parallel=False)[pair]
+    assert table["r_outer"].iloc[-1] == pytest.approx(BOX / 20)
+    # Self pairs are left out, so ref == sel has to be normalized with nsel-1 to average to 1
+    for label in ("_0", "_1", ""):
+        assert table["g"+label].mean() == pytest.approx(1, abs=0.01)
+        assert table["g"+label].std() < 0.05
+    sel = uniform_system.universe.select_atoms(pair[1])
+    ref = uniform_system.universe.select_atoms(pair[0])
+    for leaflet in (0, 1):
+        insel = uniform_system.res_to_leaflet.leaflets_of(sel.resids) == leaflet
+        inref = uniform_system.res_to_leaflet.leaflets_of(ref.resids) == leaflet
+        partners = insel.sum() - np.isin(ref.indices[inref], sel.indices[insel]).sum() / inref.sum()
+        expected = partners * np.pi * table["r_outer"]**2 / (BOX / 10)**2
+        np.testing.assert_allclose(table["cn_{}".format(leaflet)], expected, rtol=0.05, atol=0.02)
+
+def test_parallel_matches_serial(uniform_system):
+    pair = ("name P", "name P")
+    serial = rdf_pairs(uniform_system, [pair], binsize=0.25, parallel=False)[pair]
+    parallel = rdf_pairs(uniform_system, [pair], binsize=0.25, parallel=True)[pair]
+    np.testing.assert_allclose(parallel.to_numpy(), serial.to_numpy(), rtol=1e-12)